@@ -6,62 +6,37 @@ deradonator. You can comment or uncomment the code down bellow to do this or imp
 """
 
 import os
-import pandas as pd
 #import matplotlib
 import matplotlib.pyplot as plt   
 import numpy as np
+import log_ingest
+import log_rotation
+import radon_data
+import decimate
 
 #Radon File Reading
 
 def radon_data_read_txt(directory,file_name):
-    output=np.array([[]],dtype='float32')
-    with open(directory+file_name, encoding='utf8') as f:
-        lines=f.readlines()[6:] #skip the header included in the data files created by radoneye
-        for line in lines:
-            temp_read=line.strip("\n ").split(")\t")    #deals with the funky formating of said log files
-            output=np.append(output,np.array([[float(temp_read[1].strip(" "))]],dtype='float32'),axis=1)
+    # radon_data.read_radoneye_txt skips the radoneye header and pulls every reading out in one pass
+    # use it directly to also get the absolute time of every reading
+    times, values = radon_data.read_radoneye_txt(directory+file_name)
     # add an index to the output, this will be used for the x values of plots
-    output= np.append(output,np.array([np.arange(0,len(output[0]))]),axis=0)
-    return output
+    return np.array([values, np.arange(0,len(values))],dtype='float32')
 #essentialy the same as the previousfunction but used for the log data Nolan provided
 def radon_data_read_csv(directory,file_name):
-    data=pd.read_csv(directory+file_name,header=0)
-    output = np.array([np.ndarray.flatten(data[["mCu/l"]].to_numpy(dtype='float32'))])
-    output= np.append(output,np.array([np.arange(0,len(output[0]))]),axis=0)
-    return output
+    times, values = radon_data.read_radoneye_csv(directory+file_name)
+    return np.array([values, np.arange(0,len(values))],dtype='float32')
 
 #Temp File Reading
 
-def temp_data_read_csv(directory,file_names):
-    output=np.array([[],[],[],[]])
-    time_out=np.array([])
-    prev_head=[]
-    for file in file_names:
-        if file.endswith(".csv") and os.stat(os.path.join(ROOT_DIR, 'Logs', file)).st_size> 0:  # makes sure the file type is correct and there is data in the file
-            if "Rt" not in list(pd.read_csv(directory+file,header=0)) and file!=file_names[0]:  # makes sure thee is a data header and if there isn't re use the previous lines header
-                data=pd.read_csv(directory+file,header=0,names=prev_head)
-            else:
-                data=pd.read_csv(directory+file,header=0)
-                prev_head= list(data)
-            if "temp_hex_b" in list(data):  # check for newer log file where there are 2 temperatures for the heat exchanger
-                # output is a numpy array created by using pandas built in function to export data to numpy arrays then the data is flattened becuase pandas outputs things weird
-                output=np.append(output,np.array([np.ndarray.flatten(data[["temp_ch"]].to_numpy(dtype='float32')),
-                np.ndarray.flatten(data[["temp_hex_f"]].to_numpy(dtype='float32')),
-                np.ndarray.flatten(data[["temp_hex_b"]].to_numpy(dtype='float32')),
-                np.ndarray.flatten(data[["temp_chamber"]].to_numpy(dtype='float32'))]),axis=1)
-                # time out is created because numpy has trouble doing different data types per dimensions of an array
-                # the code also only keeps the HH-MM-SS part of the time stored in the log
-                time_out=np.append(time_out,np.array([item.split(" ",1)[-1] for item in np.ndarray.flatten(data[["Rt"]].to_numpy(dtype='str'))]))
-            else:
-                output=np.append(output,np.array([np.ndarray.flatten(data[["temp_ch"]].to_numpy(dtype='float32')),
-                np.zeros(len(np.ndarray.flatten(data[["temp_ch"]].to_numpy(dtype='float32')))),
-                np.ndarray.flatten(data[["temp_hex"]].to_numpy(dtype='float32')),
-                np.ndarray.flatten(data[["temp_chamber"]].to_numpy(dtype='float32'))]),axis=1)
-                time_out=np.append(time_out,np.array([item.split(" ",1)[-1] for item in np.ndarray.flatten(data[["Rt"]].to_numpy(dtype='str'))]))
-        else:
-            continue
-    # add an index to the output, this will be used for the x values of plots
-    output= np.append(output,np.array([np.arange(0,len(output[0]))]),axis=0)
+def temp_data_read_csv(directory,file_names,workers=None,cache=True):
+    # parsing is done by log_ingest: one read_csv per file in a process pool, with a cached sidecar per file so
+    # only logs that changed since the last call get parsed again. Both the temp_hex and temp_hex_f/temp_hex_b
+    # schemas are handled, and files without a header reuse the previous file's header.
+    parsed=log_ingest.read_logs(directory,file_names,workers=workers,cache=cache)
+    # output rows are cold head, heat exchanger front, heat exchanger back, chamber and an index used for the x values of plots
+    # time_out only keeps the HH:MM:SS part of the time stored in the log
+    output, time_out = log_ingest.temp_arrays(parsed)
     return output, time_out
 
 def convert_pCi(data):
@@ -69,16 +44,18 @@ def convert_pCi(data):
 
 #Temperature Plotting
 def get_tics(data, interval):
-    tics=np.array([[],[]])
-    for count, value in enumerate(data):
-        if count%interval==0:
-            tics=np.append(tics,[[count],[value]],axis=1)
-    return tics
+    # every interval'th position and its label, picked without looping over the samples
+    return decimate.tick_positions(data, interval)
 
-def temp_plot(x_data,y_data,title,lables,tics,cutoff):
+def temp_plot(x_data,y_data,title,lables,tics,cutoff,width_px=2000,method='minmax'):
+    # each line is reduced to what width_px pixel columns can show before plotting, keeping the spikes (see decimate.py)
+    # pass width_px=None to plot every sample
     plt.figure(figsize=(20, 20))
     for count, y_cords in enumerate(y_data):
-        plt.plot(x_data,y_cords,label=lables[count])
+        if width_px:
+            plt.plot(*decimate.decimate(x_data,y_cords,width_px,method),label=lables[count])
+        else:
+            plt.plot(x_data,y_cords,label=lables[count])
     if cutoff[0]:
         plt.ylim(cutoff[1],cutoff[2])
     plt.title(title)
@@ -88,17 +65,24 @@ def temp_plot(x_data,y_data,title,lables,tics,cutoff):
     plt.legend(loc='best')
     plt.show()
 
-def radon_plot(x_data,y_data,titles,multiple):
+def radon_plot(x_data,y_data,titles,multiple,width_px=2000,method='minmax'):
+    # same decimation as temp_plot, width_px=None plots every sample
     plt.figure(figsize=(20, 20))
     if multiple[0]:
         for count, y_cords in enumerate(y_data):
             plt.subplot(multiple[1],multiple[2],count+1)
-            plt.plot(x_data[count],y_cords)
+            if width_px:
+                plt.plot(*decimate.decimate(x_data[count],y_cords,width_px//multiple[2],method))
+            else:
+                plt.plot(x_data[count],y_cords)
             plt.title(titles[count])
             plt.xlabel("Time (Hours)")
             plt.ylabel(r"Radon Level ($\frac{Bq}{m^3}$)")
     else:
-        plt.plot(x_data,y_data)
+        if width_px:
+            plt.plot(*decimate.decimate(x_data,y_data,width_px,method))
+        else:
+            plt.plot(x_data,y_data)
         plt.title(titles)
         plt.xlabel("Time (Hours)")
         plt.ylabel(r"Radon Level ($\frac{Bq}{m^3}$)")
@@ -110,7 +94,7 @@ if __name__ == '__main__':
     ROOT_DIR = os.path.realpath(os.path.join(os.path.dirname("All plot.py")))
     target_dir=ROOT_DIR+"/Logs/"
     dir_list = os.listdir(ROOT_DIR+"/Logs/")
-    dir_list.sort()
+    dir_list.sort(key=log_rotation.log_sort_key)     #by start time, then rotation, so a _10 file follows _2
 
     # radon_data=radon_data_read_txt(ROOT_DIR+"/","radon data 12-1-22 15 11.txt")
     # radon_data2=radon_data_read_txt(ROOT_DIR+"/","last pCi l data 12-1-22 9 19.txt")
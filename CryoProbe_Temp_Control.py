@@ -3,49 +3,23 @@
 Python file to run the temperature control of the CryoProbe
 Need to update PID control values for faster loop exicution
 """
-import time
-import csv
-import keyboard
 import os
-import board
-import digitalio
-import adafruit_max31865
 import PID
 from datetime import datetime as dt
-import numpy as np
+from ledger import SampleLedger
+from log_writer import BackgroundLogWriter
+from rollup import RollupStore
+from stream_stats import StreamStats
+from interlock import InterlockEngine, EventLog, load_rules, outputs_off
+from calibration import load_registry
+from telemetry import TelemetryBuffer, start_telemetry
+from instrumentation import Instruments, MetricsExporter
+from loop_scheduler import DeadlineScheduler, SKIP
+from sensor_backend import backend_from_env, output_directory, EndOfReplay, PT100_PINS, RELAY_PINS
 import signal
 import sys
 import traceback
 
-def log_temps(f_name,header,data):
-    temp_log_w=csv.writer(log_file)
-    temp_log_w.writerow(data)
-
-def open_file(file_name,data_header):
-    log_file = open(os.path.join(ROOT_DIR, 'Logs', file_name),'w',encoding='UTF8', newline='')     #Open the log file in the Log subfolder of the working directory with the specified filename
-    temp_log_w = csv.writer(log_file)
-    temp_log_w.writerow(data_header)     # writes the data header for the csv file
-    
-    return log_file     # returns the log file so it can be saved as a variable and manipulated later
-
-def calibrated_temps(temp, TC):
-    #if temp > 35:
-    #    raise Exception('Temperature has reached too high on TC {}'.format(TC))
-    if 'Tip' in TC:
-        RawRange = 124.8
-        ReferenceRange = 116.3
-        ActualTemp = (((temp + 112.6) * ReferenceRange) / RawRange) - 96.7
-    if 'Ceramic' in TC:
-        RawRange = 179.7
-        ReferenceRange = 169.5
-        ActualTemp = (((temp + 159.9) * ReferenceRange) / RawRange) - 150.9
-    if 'Flange' in TC:
-        RawRange = 179
-        ReferenceRange = 169.1
-        ActualTemp = (((temp + 159.6) * ReferenceRange) / RawRange) - 149.2
-        
-    return ActualTemp
-    
 def signal_handler(signum, frame):
     raise KeyboardInterrupt
 
@@ -54,25 +28,21 @@ signal.signal(signal.SIGINT, signal_handler) # Raspberry Pi had unreliable Ctrl-
 if __name__ == '__main__':
     ROOT_DIR = os.path.realpath(os.path.join(os.path.dirname("CryoProbe_Temp_Control.py")))
 
-    data_f_name='Temp log {}.csv'.format(dt.now().strftime('%m-%d-%Y, %H-%M'))
+    backend = backend_from_env(os.path.join(ROOT_DIR, 'Logs', 'Recordings'))     #sensors and relay, on the Pi unless SLOWCONTROL_BACKEND asks to record or replay a run (see sensor_backend.py)
+    LOG_DIR = output_directory(backend, os.path.join(ROOT_DIR, 'Logs'))     #Logs on the Pi, a new Logs/Replay/Run ... directory for a replayed or fake run
+
     data_header=['Rt', 'temp_tip', 'temp_ceramic', 'temp_flange','Relay']
     # header reads [Real time, Cold head temp, Heat exchander front temp, heat exhchanger back temp, champer temp, Heater 1 status, Heater 2 status]
-    log_file = open_file(data_f_name,data_header)
-
-    # Create sensor object, communicating over the board's default SPI bus
-    spi = board.SPI()
-
-    # allocate a CS pin and set the direction
-    cs16 = digitalio.DigitalInOut(board.D16)
-    cs21 = digitalio.DigitalInOut(board.D21)
-    cs19 = digitalio.DigitalInOut(board.D19)
-    Relay = digitalio.DigitalInOut(board.D17)
-    Relay.direction= digitalio.Direction.OUTPUT
-
-    #Create a thermocouple object with the above pin assignements
-    Tip = adafruit_max31865.MAX31865(spi, cs16, wires=2)
-    Ceramic = adafruit_max31865.MAX31865(spi, cs21, wires=2)   
-    Flange = adafruit_max31865.MAX31865(spi, cs19, wires=2)   
+    logger = BackgroundLogWriter(LOG_DIR, data_header, compress='gzip')     #writes and rotates the 4Mb log files from a background thread, closed files are gzipped
+    rollups = RollupStore(os.path.join(LOG_DIR, 'Rollups'), data_header[1:])     #1s/10s/1min/1h min, mean, max of every channel, the 1min/1h ones kept in files for long history plots
+    instruments = Instruments()     #latency histograms of every loop stage, see instrumentation.py
+    metrics = MetricsExporter(instruments, os.path.join(LOG_DIR, 'metrics.json'), interval=10).start()     #percentiles written every 10 s
+
+    pt100s = backend.max31865(PT100_PINS, wires=2)
+    Tip, Ceramic, Flange = pt100s['Tip'], pt100s['Ceramic'], pt100s['Flange']
+    Relay = backend.outputs(RELAY_PINS)['Relay']
+    calibrate = load_registry().compile(['Tip', 'Ceramic', 'Flange'])     #Callendar-Van Dusen on the PT100 resistances, coefficients in calibrations.json
+    interlocks = InterlockEngine(['temp_tip', 'temp_ceramic', 'temp_flange'], load_rules('cryoprobe'), safe_state=outputs_off(Relay), instruments=instruments, on_event=EventLog(os.path.join(LOG_DIR, 'Interlock events.txt')))     #over temperature, rate, stale and gradient rules from interlocks.json, a trip latches the relay off
     #Chamber = adafruit_max31865.MAX31865(spi, cs19, wires=2)
 
     Relay.value = False
@@ -85,34 +55,46 @@ if __name__ == '__main__':
     #I1 = 1.2*20/0.5
     #D1 = 3*20*0.5/40
 
-    controllerF = PID.PID(P1, I1, D1)        # create pid control
+    controllerF = PID.PID(P1, I1, D1, backend.time())        # create pid control
     controllerF.SetPoint = targetT1             # initialize the controler
     controllerF.setSampleTime(0.25)
 
-    Ledger=np.array([[], [], [], [], []])
+    ledger_len=14400     #number of samples kept in memory
+    itt_len=20 #number of loops that get averaged to the log
+    Ledger=SampleLedger(['temp_tip', 'temp_ceramic', 'temp_flange', 'Relay'], ledger_len)
+    stats = StreamStats(Ledger.channels, windows=(itt_len, 240, 2400))     #mean, std, min, max and slope of every channel over the log interval, 1 and 10 minutes
+    telemetry_buffer = TelemetryBuffer(Ledger.channels, ledger_len)     #live readings for browsers and the Dash front panel, see telemetry.py
+    telemetry = None
+    stage_tip, stage_ceramic, stage_flange, stage_calibrate, stage_pid, stage_relay, stage_ledger, stage_stats, stage_rollups, stage_telemetry, stage_log, stage_tick = [
+        instruments.stage(name) for name in ['acquire Tip', 'acquire Ceramic', 'acquire Flange', 'calibrate', 'pid', 'relay', 'ledger', 'stats', 'rollups', 'telemetry', 'log', 'tick']]
 
     try:     # try and excep statement used to catch error and log them to a specified file
+        telemetry = start_telemetry(telemetry_buffer, instruments=instruments, stats=stats, interlocks=interlocks)     #None if the port is taken, the loop runs without it
         runlen=1
         loop_time = 0.25 #set time for loop in seconds
-        itt_len=20 #number of loops that get averaged to the log
+        loop_timer = DeadlineScheduler(loop_time, overrun=SKIP, clock=backend.monotonic, sleep=backend.sleep)     #paces the loop on monotonic deadlines, overruns skip to the next deadline
         while True:
-            now = time.time() # keep track of when the loop starts so that we keep a consistant loop runtime 
-            if os.stat(os.path.join(ROOT_DIR, 'Logs', data_f_name)).st_size>= 4194304:     #checks if the current log file is 4Mb, if it is it creates a new log file 
-                data_f_name='Temp log {}.csv'.format(dt.now().strftime('%m-%d-%Y, %H-%M'))
-                log_file.close()
-                log_file = open_file(data_f_name, data_header)
             #Reads the tip, ceramic and flange temperatures
-            #t1=time.time()
+            t = tick_start = instruments.clock()     #stage timings go to Logs/metrics.json and /metrics
             #Tip.initiate_one_shot_measurement()
             #Ceramic.initiate_one_shot_measurement()
             #Flange.initiate_one_shot_measurement()
 
             #print(Tip.unpack_temperature(), ' ', Ceramic.unpack_temperature(), ' ', Flange.unpack_temperature())
             #Tip._wait_for_oneshot()
-            print(Tip.temperature, Tip.resistance, Ceramic.temperature, Ceramic.resistance, Flange.temperature, Flange.resistance)
-            temp_Tip= Tip.temperature #calibrated_temps(Tip.temperature, 'Tip')
-            temp_Ceramic= Ceramic.temperature #calibrated_temps(Ceramic.temperature,'Ceramic')
-            temp_Flange=Flange.temperature #calibrated_temps(Flange.temperature,'Flange')
+            resistance_Tip = Tip.resistance
+            t = stage_tip.lap(t)
+            resistance_Ceramic = Ceramic.resistance
+            t = stage_ceramic.lap(t)
+            resistance_Flange = Flange.resistance
+            t = stage_flange.lap(t)
+            resistances = [resistance_Tip, resistance_Ceramic, resistance_Flange]
+            temp_Tip, temp_Ceramic, temp_Flange = calibrate(resistances)
+            t = stage_calibrate.lap(t)
+            sample_time = backend.time()     #every timestamp of the tick comes from the backend clock, which a replay feeds back
+            tripped = interlocks.evaluate(sample_time, [temp_Tip, temp_Ceramic, temp_Flange])     #every rule against this sample, a trip has already turned the relay off
+            t = instruments.clock()     #the evaluation is timed on the 'interlocks' stage
+            print(temp_Tip, resistances[0], temp_Ceramic, resistances[1], temp_Flange, resistances[2])
 
             #if not HeatExF.oneshot_pending:
             #    temp_HeatExF=calibrated_temps(HeatExF.temperature,'HeatExF')
@@ -124,48 +106,51 @@ if __name__ == '__main__':
             #else:
             #    #HeatExB._wait_for_oneshot()
             #    temp_HeatExB=calibrated_temps(HeatExB.temperature,'HeatExB')
-            #t2=time.time()
+            t = instruments.clock()     #the print above is left out of the stages
             
-            controllerF.update(temp_Tip) # update the pid controlers
+            controllerF.update(temp_Tip, backend.time()) # update the pid controlers
+            t = stage_pid.lap(t)
 
             MV1 = 10
             #MV1 = controllerF.output # get the new pid values
-            if MV1 > 0:      #temp too low close valve
+            if MV1 > 0 and not tripped:      #temp too low close valve, never while an interlock is tripped
                 Relay.value = True
                 Rel_status = 11
             else:     #turn heat off
                 Relay.value = False
                 Rel_status = 10
-            time_stamp= dt.now().strftime('%H:%M:%S')     #timestamp used for x axis tick
-            #t3 = time.time()
-            Ledger=np.append(Ledger,[[time_stamp], [temp_Tip], [temp_Ceramic], [temp_Flange], [Rel_status]],axis=1 )
+            t = stage_relay.lap(t)
+            time_stamp= dt.fromtimestamp(sample_time).strftime('%H:%M:%S')     #timestamp used for x axis tick
+            Ledger.append(sample_time, [temp_Tip, temp_Ceramic, temp_Flange, Rel_status])
+            t = stage_ledger.lap(t)
+            stats.add(sample_time, [temp_Tip, temp_Ceramic, temp_Flange, Rel_status])
+            t = stage_stats.lap(t)
+            rollups.add(sample_time, [temp_Tip, temp_Ceramic, temp_Flange, Rel_status])
+            t = stage_rollups.lap(t)
+            telemetry_buffer.publish(sample_time, [temp_Tip, temp_Ceramic, temp_Flange, Rel_status])
+            t = stage_telemetry.lap(t)
             if runlen==itt_len:     #change to be however many itterations you want before updating logs
-                Tip_avg=np.average(Ledger[1,-itt_len:].astype('float32'))
-                Ceramic_avg=np.average(Ledger[2,-itt_len:].astype('float32'))
-                Flange_avg=np.average(Ledger[3,-itt_len:].astype('float32'))
-                log_temps(data_f_name,data_header,[time_stamp, Tip_avg, Ceramic_avg, Flange_avg, Rel_status ])     #write to temp log file
-                log_file.flush() #pushes the data collected this loop to the csv.
+                Tip_avg, Ceramic_avg, Flange_avg = stats.mean(itt_len)[:3]
+                logger.log([time_stamp, Tip_avg, Ceramic_avg, Flange_avg, Rel_status ])     #queue the row for the temp log file, never blocks on the disk
                 runlen = 0
-            if len(Ledger[1])>=itt_len+1:     #only holds onto last itt len +1 temperatures in memory
-                Ledger=np.delete(Ledger, obj=0,axis=1)
-            #t4=time.time()
-            #print(t2-t1,t4-t3,elapsed)
+            t = stage_log.lap(t)
+            stage_tick.record(t - tick_start)
             #print('{}, {}, {}'.format(Tip.temperature, Ceramic.temperature, Flange.temperature))
-            #print(Ledger[:,-1:])
+            #print(Ledger.latest())
             runlen += 1
-            elapsed = time.time() - now # how long was it running?
-            if elapsed < loop_time: time.sleep(loop_time-elapsed) #make loop run every 0.25 seconds
-            else: time.sleep(0.1)
+            loop_timer.wait() #make loop run every 0.25 seconds
             
     #Opens the relay when program interrupted and writes to error log if need be
     except KeyboardInterrupt:
         print('\n')
         print('Interrupted')
+    except EndOfReplay:     #a replayed recording ran out
+        print('End of replay')
     except Exception as e:
-        if not os.path.exists(os.path.join(ROOT_DIR, 'Logs', 'Error Logs')):
-            with open(os.path.join(ROOT_DIR, 'Logs', 'Error Logs'), 'w', encoding='UTF-8') as file:
+        if not os.path.exists(os.path.join(LOG_DIR, 'Error Logs')):
+            with open(os.path.join(LOG_DIR, 'Error Logs'), 'w', encoding='UTF-8') as file:
                 file.write('')
-        with open(os.path.join(ROOT_DIR, 'Logs', 'Error Logs'), 'a', encoding='UTF-8') as file:
+        with open(os.path.join(LOG_DIR, 'Error Logs'), 'a', encoding='UTF-8') as file:
             file.write('-------------------------------------------------'+'\n')
             file.write(dt.now().strftime('%Y-%m-%d %H:%M:%S')+'\n')
             traceback.print_exc(file=file)
@@ -173,5 +158,11 @@ if __name__ == '__main__':
         traceback.print_exc()
     finally:
         Relay.value = False
+        logger.close()     #writes out any queued rows
+        rollups.close()     #writes out the open rollup buckets
+        if telemetry is not None:
+            telemetry.stop()
+        metrics.stop()     #writes the final timings
+        backend.close()     #finishes the recording, if one is made
 
         
@@ -29,6 +29,7 @@
 More information about PID Controller: http://en.wikipedia.org/wiki/PID_controller
 """
 import time
+import numpy as np
 
 class PID:
     """PID Controller
@@ -127,3 +128,97 @@ class PID:
         Based on a pre-determined sampe time, the PID decides if it should compute or return immediately.
         """
         self.sample_time = sample_time
+
+
+class PIDBank:
+    """Bank of independent PID Controllers updated together
+
+    Every coefficient and internal term is stored as a NumPy array with one entry per channel,
+    so update() computes all channels in a single vectorized call with the same semantics as PID.
+    """
+
+    def __init__(self, channels, P=0.2, I=0.0, D=0.0, current_time=None):
+
+        self.channels = channels
+        self.Kp = np.full(channels, P, dtype='float64')
+        self.Ki = np.full(channels, I, dtype='float64')
+        self.Kd = np.full(channels, D, dtype='float64')
+
+        self.sample_time = np.zeros(channels)
+        self.current_time = np.full(channels, current_time if current_time is not None else time.time(), dtype='float64')
+        self.last_time = self.current_time.copy()
+
+        self.clear()
+
+    def clear(self):
+        """Clears PID computations and coefficients of every channel"""
+        self.SetPoint = np.zeros(self.channels)
+
+        self.PTerm = np.zeros(self.channels)
+        self.ITerm = np.zeros(self.channels)
+        self.DTerm = np.zeros(self.channels)
+        self.last_error = np.zeros(self.channels)
+
+        # Windup Guard
+        self.int_error = np.zeros(self.channels)
+        self.windup_guard = np.full(self.channels, 20.0)
+
+        self.output = np.zeros(self.channels)
+
+    def update(self, feedback_values, current_time=None):
+        """Calculates PID values for an array of feedback values, one per channel
+
+        Only channels whose sample time has elapsed are updated, the others keep their last output.
+        current_time may be a scalar or an array with one time per channel.
+        """
+        error = self.SetPoint - np.asarray(feedback_values, dtype='float64')
+
+        self.current_time[:] = current_time if current_time is not None else time.time()
+        delta_time = self.current_time - self.last_time
+        delta_error = error - self.last_error
+
+        due = delta_time >= self.sample_time
+        if due.all():
+            # common case, every channel shares the loop rate so no masking is needed
+            self.PTerm = self.Kp * error
+            self.ITerm = np.clip(self.ITerm + error * delta_time, -self.windup_guard, self.windup_guard)
+            self.DTerm = np.divide(delta_error, delta_time, out=np.zeros(self.channels), where=delta_time > 0)
+            self.last_time = self.current_time.copy()
+            self.last_error = error
+            self.output = self.PTerm + (self.Ki * self.ITerm) + (self.Kd * self.DTerm)
+            return
+        if not due.any():
+            return
+        dt = np.where(due, delta_time, 0.0)
+
+        self.PTerm = np.where(due, self.Kp * error, self.PTerm)
+        self.ITerm = np.where(due, np.clip(self.ITerm + error * dt, -self.windup_guard, self.windup_guard), self.ITerm)
+
+        DTerm = np.divide(delta_error, dt, out=np.zeros(self.channels), where=dt > 0)
+        self.DTerm = np.where(due, DTerm, self.DTerm)
+
+        # Remember last time and last error for next calculation
+        self.last_time = np.where(due, self.current_time, self.last_time)
+        self.last_error = np.where(due, error, self.last_error)
+
+        self.output = np.where(due, self.PTerm + (self.Ki * self.ITerm) + (self.Kd * self.DTerm), self.output)
+
+    def setKp(self, proportional_gain):
+        """Sets the Proportional Gain, either one value for every channel or an array"""
+        self.Kp[:] = proportional_gain
+
+    def setKi(self, integral_gain):
+        """Sets the Integral Gain, either one value for every channel or an array"""
+        self.Ki[:] = integral_gain
+
+    def setKd(self, derivative_gain):
+        """Sets the Derivative Gain, either one value for every channel or an array"""
+        self.Kd[:] = derivative_gain
+
+    def setWindup(self, windup):
+        """Sets the integral windup guard, see PID.setWindup"""
+        self.windup_guard[:] = windup
+
+    def setSampleTime(self, sample_time):
+        """Sets the sample time, see PID.setSampleTime"""
+        self.sample_time[:] = sample_time
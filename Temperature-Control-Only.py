@@ -3,81 +3,41 @@
 Python file to run the temperature control of the small cryostat.
 Need to update PID control values for faster loop exicution
 """
-import time
-import csv
-import keyboard
 import os
-import board
-import digitalio
-import adafruit_max31856
 import PID
 from datetime import datetime as dt
-import numpy as np
-
-def log_temps(f_name,header,data):
-    temp_log_w=csv.writer(log_file)
-    temp_log_w.writerow(data)
-
-def open_file(file_name,data_header):
-    log_file = open(os.path.join(ROOT_DIR, 'Logs', file_name),'w',encoding='UTF8', newline='')     #Open the log file in the Log subfolder of the working directory with the specified filename
-    temp_log_w = csv.writer(log_file)
-    temp_log_w.writerow(data_header)     # writes the data header for the csv file
-    
-    return log_file     # returns the log file so it can be saved as a variable and manipulated later
-
-def calibrated_temps(temp, TC):
-    if 'HeatExB' in TC:
-        RawRange =  121
-        ReferenceRange = 126
-        ActualTemp = (((temp + 117) * ReferenceRange) / RawRange) - 108
-    if 'HeatExF' in TC:
-        RawRange = 184
-        ReferenceRange = 179
-        ActualTemp = (((temp + 174) * ReferenceRange) / RawRange) - 161
-    if 'ColdHead' in TC:
-        #RawRange = 187
-        #ReferenceRange = 185
-        #ActualTemp = (((temp + 167) * ReferenceRange) / RawRange) - 171
-        #Coldhead was consistent in its measurements, atleast at high temps, so leave it alone (pending more testing)
-        ActualTemp = temp
-    if 'Chamber' in TC:
-        #RawRange = 35
-        #ReferenceRange = 35
-        #At both high and low temps, Chamber was consistently 8 degrees colder than the thermometer measured
-        ActualTemp = temp + 7.6
-        
-    return ActualTemp
+from ledger import SampleLedger
+from log_writer import BackgroundLogWriter
+from rollup import RollupStore
+from stream_stats import StreamStats
+from interlock import InterlockEngine, EventLog, load_rules, outputs_off
+from calibration import load_registry
+from telemetry import TelemetryBuffer, start_telemetry
+from instrumentation import Instruments, MetricsExporter
+from acquisition import OneShotScheduler
+from loop_scheduler import DeadlineScheduler, SKIP
+from sensor_backend import backend_from_env, output_directory, EndOfReplay, THERMOCOUPLE_PINS, HEATER_PINS
 
 if __name__ == '__main__':
     ROOT_DIR = os.path.realpath(os.path.join(os.path.dirname("Temperature Control Only.py")))
 
-    data_f_name='Temp log {}.csv'.format(dt.now().strftime('%m-%d-%Y, %H-%M'))
+    backend = backend_from_env(os.path.join(ROOT_DIR, 'Logs', 'Recordings'))     #sensors and heater relays, on the Pi unless SLOWCONTROL_BACKEND asks to record or replay a run (see sensor_backend.py)
+    LOG_DIR = output_directory(backend, os.path.join(ROOT_DIR, 'Logs'))     #Logs on the Pi, a new Logs/Replay/Run ... directory for a replayed or fake run
+
     data_header=['Rt', 'temp_ch', 'temp_hex_f', 'temp_hex_b', 'temp_chamber','Heat F','Heat B']
     # header reads [Real time, Cold head temp, Heat exchander front temp, heat exhchanger back temp, champer temp, PID controler 1 output, Heater 1 status, PID controler 2 output, Heater 2 status]
-    log_file = open_file(data_f_name,data_header)
+    logger = BackgroundLogWriter(LOG_DIR, data_header, compress='gzip')     #writes and rotates the 4Mb log files from a background thread, closed files are gzipped
+    rollups = RollupStore(os.path.join(LOG_DIR, 'Rollups'), data_header[1:])     #1s/10s/1min/1h min, mean, max of every channel, the 1min/1h ones kept in files for long history plots
+    instruments = Instruments()     #latency histograms of every loop stage, see instrumentation.py
+    metrics = MetricsExporter(instruments, os.path.join(LOG_DIR, 'metrics.json'), interval=10).start()     #percentiles written every 10 s
 
-    # Create sensor object, communicating over the board's default SPI bus
-    spi = board.SPI()
-
-    # allocate a CS pin and set the direction
-    cs13 = digitalio.DigitalInOut(board.D13)
-    cs13.direction = digitalio.Direction.OUTPUT
-    cs16 = digitalio.DigitalInOut(board.D16)
-    cs16.direction = digitalio.Direction.OUTPUT
-    cs25 = digitalio.DigitalInOut(board.D25)
-    cs25.direction = digitalio.Direction.OUTPUT
-    cs26 = digitalio.DigitalInOut(board.D26)
-    cs26.direction = digitalio.Direction.OUTPUT
-    HeaterF = digitalio.DigitalInOut(board.D17)
-    HeaterF.direction= digitalio.Direction.OUTPUT
-    HeaterB = digitalio.DigitalInOut(board.D18)
-    HeaterB.direction = digitalio.Direction.OUTPUT
-
-    # create a thermocouple object with the above pin assignements
-    ColdHead = adafruit_max31856.MAX31856(spi, cs13,thermocouple_type=adafruit_max31856.ThermocoupleType.T)
-    HeatExF = adafruit_max31856.MAX31856(spi, cs16,thermocouple_type=adafruit_max31856.ThermocoupleType.T)     #Heat exchanger thermocouple facing the coldhead
-    HeatExB = adafruit_max31856.MAX31856(spi, cs25,thermocouple_type=adafruit_max31856.ThermocoupleType.T)     #Heat exchanger thermocouple facing the chamber
-    Chamber = adafruit_max31856.MAX31856(spi, cs26,thermocouple_type=adafruit_max31856.ThermocoupleType.T)
+    thermocouples = backend.max31856(THERMOCOUPLE_PINS, thermocouple_type='T')     #HeatExF faces the coldhead, HeatExB faces the chamber
+    ColdHead, HeatExF, HeatExB, Chamber = thermocouples['ColdHead'], thermocouples['HeatExF'], thermocouples['HeatExB'], thermocouples['Chamber']
+    heaters = backend.outputs(HEATER_PINS)
+    HeaterF, HeaterB = heaters['HeaterF'], heaters['HeaterB']
+    acquisition = OneShotScheduler({'ColdHead': ColdHead, 'HeatExF': HeatExF, 'HeatExB': HeatExB, 'Chamber': Chamber}, pipeline=False, instruments=instruments)     #pipeline=True starts the next conversions right after each readout
+    calibrate = load_registry().compile(['ColdHead', 'HeatExF', 'HeatExB', 'Chamber'])     #per channel calibrations from calibrations.json
+    interlocks = InterlockEngine(['temp_ch', 'temp_hex_f', 'temp_hex_b', 'temp_chamber'], load_rules('temperature_control'), safe_state=outputs_off(HeaterF, HeaterB), instruments=instruments, on_event=EventLog(os.path.join(LOG_DIR, 'Interlock events.txt')))     #over temperature, rate, stale and gradient rules from interlocks.json, a trip latches both heaters off
 
     HeaterF.value = False
     HeatF_on=False
@@ -89,7 +49,7 @@ if __name__ == '__main__':
     #I1 = 1.2*20/0.5
     #D1 = 3*20*0.5/40
 
-    controllerF = PID.PID(P1, I1, D1)        # create pid control
+    controllerF = PID.PID(P1, I1, D1, backend.time())        # create pid control
     controllerF.SetPoint = targetT1             # initialize the controler
     controllerF.setSampleTime(0.25)
 
@@ -103,85 +63,75 @@ if __name__ == '__main__':
     #I2 = 1.2*20/0.5
     #D2 = 3*20*0.5/40
 
-    controllerB = PID.PID(P2, I2, D2)     #creats the pid control
+    controllerB = PID.PID(P2, I2, D2, backend.time())     #creats the pid control
     controllerB.SetPoint = targetT2     #initialize the controler
     controllerB.setSampleTime(0.25)
 
-    Ledger=np.array([[], [], [], [], [], [], []])
+    ledger_len=3600     #number of samples kept in memory
+    itt_len=2
+    Ledger=SampleLedger(['temp_ch', 'temp_hex_f', 'temp_hex_b', 'temp_chamber', 'Heat F', 'Heat B'], ledger_len)
+    stats = StreamStats(Ledger.channels, windows=(itt_len, 240, 2400), outputs=['Heat F', 'Heat B'])     #mean, std, min, max, slope and heater duty cycle of every channel over the log interval, 1 and 10 minutes
+    telemetry_buffer = TelemetryBuffer(Ledger.channels, ledger_len)     #live readings for browsers and the Dash front panel, see telemetry.py
+    telemetry = None
+    stage_acquire, stage_calibrate, stage_pid, stage_relays, stage_ledger, stage_stats, stage_rollups, stage_telemetry, stage_log, stage_tick = [
+        instruments.stage(name) for name in ['acquire', 'calibrate', 'pid', 'relays', 'ledger', 'stats', 'rollups', 'telemetry', 'log', 'tick']]
 
     try:     # try and excep statement used to catch error and log them to a specified file
+        telemetry = start_telemetry(telemetry_buffer, instruments=instruments, stats=stats, interlocks=interlocks)     #None if the port is taken, the loop runs without it
         runlen=1
-        itt_len=2
+        loop_timer = DeadlineScheduler(0.25, overrun=SKIP, clock=backend.monotonic, sleep=backend.sleep)     #paces the loop on monotonic deadlines, overruns skip to the next deadline
         while True:
-            now = time.time() # keep track of when the loop starts so that we keep a consistant loop runtime 
-            if os.stat(os.path.join(ROOT_DIR, 'Logs', data_f_name)).st_size>= 4194304:     #checks if the current log file is 4Mb, if it is it creates a new log file 
-                data_f_name='Temp log {}.csv'.format(dt.now().strftime('%m-%d-%Y, %H-%M'))
-                log_file.close()
-                log_file = open_file(data_f_name, data_header)
             #reads the coldhead, heat exchanger front and back, chamber temepratures
-            #t1=time.time()
-            ColdHead.initiate_one_shot_measurement()
-            HeatExF.initiate_one_shot_measurement()
-            HeatExB.initiate_one_shot_measurement()
-            Chamber.initiate_one_shot_measurement()
-            ColdHead._wait_for_oneshot()
-            temp_coldhead=calibrated_temps(ColdHead.unpack_temperature(), 'ColdHead')
-            if not HeatExF.oneshot_pending:
-                temp_HeatExF=calibrated_temps(HeatExF.unpack_temperature(),'HeatExF')
-            else:
-                HeatExF._wait_for_oneshot()
-                temp_HeatExF=calibrated_temps(HeatExF.unpack_temperature(),'HeatExF')
-            if not HeatExB.oneshot_pending:
-                temp_HeatExB=calibrated_temps(HeatExB.unpack_temperature(),'HeatExF')
-            else:
-                HeatExB._wait_for_oneshot()
-                temp_HeatExB=calibrated_temps(HeatExB.unpack_temperature(),'HeatExF')
-            if not Chamber.oneshot_pending:
-                temp_chamber=calibrated_temps(Chamber.unpack_temperature(),'HeatExF')
-            else:
-                Chamber._wait_for_oneshot()
-                temp_chamber=calibrated_temps(Chamber.unpack_temperature(),'HeatExF')
-            #t2=time.time()
-            controllerF.update(temp_HeatExF) # update the pid controlers
-            controllerB.update(temp_HeatExB)
+            t = tick_start = instruments.clock()     #stage timings go to Logs/metrics.json and /metrics
+            readings = acquisition.read()     #polls all four conversions together and reads each one out as soon as it is ready
+            t = stage_acquire.lap(t)
+            temp_coldhead, temp_HeatExF, temp_HeatExB, temp_chamber = calibrate([readings['ColdHead'], readings['HeatExF'], readings['HeatExB'], readings['Chamber']])
+            t = stage_calibrate.lap(t)
+            sample_time = backend.time()     #every timestamp of the tick comes from the backend clock, which a replay feeds back
+            tripped = interlocks.evaluate(sample_time, [temp_coldhead, temp_HeatExF, temp_HeatExB, temp_chamber])     #every rule against this sample, a trip has already turned both heaters off
+            t = instruments.clock()     #the evaluation is timed on the 'interlocks' stage
+            controllerF.update(temp_HeatExF, backend.time()) # update the pid controlers
+            controllerB.update(temp_HeatExB, backend.time())
             MV1 = controllerF.output # get the new pid values
             MV2 = controllerB.output
-            if MV1 > 0:      #temp too low turn heater on
+            t = stage_pid.lap(t)
+            if MV1 > 0 and not tripped:      #temp too low turn heater on, never while an interlock is tripped
                 HeaterF.value = True
                 HeatF_status = 1
             else:     #turn heat off
                 HeaterF.value = False
                 HeatF_status = 0
-            if MV2 > 0:     #temp too low turn heater on
+            if MV2 > 0 and not tripped:     #temp too low turn heater on, never while an interlock is tripped
                 HeaterB.value = True
                 HeatB_status = 1
             else:     #turn heat off
                 HeaterB.value = False
                 HeatB_status = 0
-            time_stamp= dt.now().strftime('%H:%M:%S')     #timestamp used for x axis tick
-            #t3 = time.time()
-            Ledger=np.append(Ledger,[[time_stamp], [temp_coldhead], [temp_HeatExF], [temp_HeatExB], [temp_chamber], [HeatF_status], [HeatB_status]],axis=1 )
+            t = stage_relays.lap(t)
+            time_stamp= dt.fromtimestamp(sample_time).strftime('%H:%M:%S')     #timestamp used for x axis tick
+            Ledger.append(sample_time, [temp_coldhead, temp_HeatExF, temp_HeatExB, temp_chamber, HeatF_status, HeatB_status])
+            t = stage_ledger.lap(t)
+            stats.add(sample_time, [temp_coldhead, temp_HeatExF, temp_HeatExB, temp_chamber, HeatF_status, HeatB_status])
+            t = stage_stats.lap(t)
+            rollups.add(sample_time, [temp_coldhead, temp_HeatExF, temp_HeatExB, temp_chamber, HeatF_status, HeatB_status])
+            t = stage_rollups.lap(t)
+            telemetry_buffer.publish(sample_time, [temp_coldhead, temp_HeatExF, temp_HeatExB, temp_chamber, HeatF_status, HeatB_status])
+            t = stage_telemetry.lap(t)
             if runlen==itt_len:     #change to be however many itterations you want before updating logs
-                Coldhead_avg=np.average(Ledger[1,-itt_len:].astype('float32'))
-                HeatExF_avg=np.average(Ledger[2,-itt_len:].astype('float32'))
-                HeatExB_avg=np.average(Ledger[3,-itt_len:].astype('float32'))
-                Chamber_avg=np.average(Ledger[4,-itt_len:].astype('float32'))
-                log_temps(data_f_name,data_header,[time_stamp, Coldhead_avg, HeatExF_avg, HeatExB_avg, Chamber_avg, HeatF_status , HeatB_status])     #write to temp log file
-                log_file.flush() #pushes the data collected this loop to the csv.
+                Coldhead_avg, HeatExF_avg, HeatExB_avg, Chamber_avg = stats.mean(itt_len)[:4]
+                logger.log([time_stamp, Coldhead_avg, HeatExF_avg, HeatExB_avg, Chamber_avg, HeatF_status , HeatB_status])     #queue the row for the temp log file, never blocks on the disk
                 runlen = 0
-            if len(Ledger[1])>=itt_len+1:     #only holds onto last itt len +1 temperatures in memory
-                Ledger=np.delete(Ledger, obj=0,axis=1)
-            #t4=time.time()
-            elapsed = time.time() - now # how long was it running?
-            #print(t2-t1,t4-t3,elapsed)
-            #print(Ledger[:,-1:])
-            try:
-                time.sleep(0.25-elapsed)     # make the loop run every 1 seconds
-            except: 
-                time.sleep(0.1)
+            t = stage_log.lap(t)
+            stage_tick.record(t - tick_start)
+            #print(Ledger.latest())
+            loop_timer.wait()     # make the loop run every 0.25 seconds
             runlen += 1
             
     #Opens the relays (stops the heaters) when program interrupted
+    except EndOfReplay:     #a replayed recording ran out
+        HeaterF.value = False
+        HeaterB.value = False
+        print('End of replay')
     except Exception as e:
         HeaterF.value = False
         HeatF_on = False
@@ -191,12 +141,19 @@ if __name__ == '__main__':
         if e == 'KeyboardInterrupt':
             print('Interrupted')
         else:      #code to write any errors to a specified error log file in the logs subdirectory of the working directory
-            if not os.path.exists(os.path.join(ROOT_DIR, 'Logs', 'Error Logs.txt')):
-                with open(os.path.join(ROOT_DIR, 'Logs', 'Error Logs'), 'w', encoding='UTF-8') as file:
+            if not os.path.exists(os.path.join(LOG_DIR, 'Error Logs.txt')):
+                with open(os.path.join(LOG_DIR, 'Error Logs'), 'w', encoding='UTF-8') as file:
                     file.write('')
-            with open(os.path.join(ROOT_DIR, 'Logs', 'Error Logs'), 'a', encoding='UTF-8') as file:
+            with open(os.path.join(LOG_DIR, 'Error Logs'), 'a', encoding='UTF-8') as file:
                 file.write('-------------------------------------------------'+'\n')
                 file.write(dt.now().strftime('%Y-%m-%d %H:%M:%S')+'\n')
                 traceback.print_exc(file=file)
                 file.write('\n')
             traceback.print_exc()
+    finally:
+        logger.close()     #writes out any queued rows
+        rollups.close()     #writes out the open rollup buckets
+        if telemetry is not None:
+            telemetry.stop()
+        metrics.stop()     #writes the final timings
+        backend.close()     #finishes the recording, if one is made
@@ -6,11 +6,15 @@ import matplotlib
 matplotlib.use("tkAgg")
 import matplotlib.pyplot as plt
 import numpy as np                                                               #Required to use delay functions
+import threading
+from live_plot import LivePlot
+from serial_reader import SerialReader
 
-coldhead = serial.Serial(port='COM3', baudrate=9600)
-heatexchanger = serial.Serial(port='COM6', baudrate=9600)
+coldhead = serial.Serial(port='COM3', baudrate=9600, timeout=0.1)
+heatexchanger = serial.Serial(port='COM6', baudrate=9600, timeout=0.1)
 coldhead.flushInput()
 heatexchanger.flushInput()
+reader = SerialReader({'coldhead': coldhead, 'heatexchanger': heatexchanger}, stale_after=2.0).start()     #reads both ports on their own threads
 
 from tclab import clock, setup, Historian, Plotter
 import PID
@@ -29,68 +33,38 @@ relay = serial.Serial('COM4',9600)       #Create Serial port object called Ardui
 time.sleep(2)
 relay.flush()
 #wait for 2 secounds for the communication to get established
-temp_ch = float(coldhead.readline().strip())
-temp_hex = float(heatexchanger.readline().strip())
+reader.wait_ready(10)
 
 plot_window = 1000
-ch_temps = np.array(np.zeros([plot_window]))
-hex_temps = np.array(np.zeros([plot_window]))
-time_stamps = []
-#np.array(np.zeros([plot_window]))
-for i in range(plot_window):
-    time_stamps.append(dt.now().strftime('%M:%S'))
-    #x_var.append(time.asctime(time.time()))
-plt.ion()
-fig, ax = plt.subplots()
-chline,  = ax.plot(time_stamps, ch_temps, label='Cold Head')
-hexline, = ax.plot(time_stamps, hex_temps, label='Heat Exchanger')
-
-ax.locator_params(tight=True, nbins=4)
-ax.legend()
-ax.set_xlabel('Time (Min:Sec)')
-ax.set_ylabel('Temperature (Celsius)')
+plot = LivePlot(['temp_ch', 'temp_hex'], ['Cold Head', 'Heat Exchanger'], capacity=plot_window, span=plot_window * 0.5)     #ring buffered, blitted plot
 T1 = 40
-t = 0
-while True:
-    t = t + 1
-    T_hex = heatexchanger.readline()
-    #while len(T_hex) < 8:
-    #    T_hex = heatexchanger.readline()
-    #heatexchanger.reset_input_buffer()
-    temp_hex = float(T_hex.strip())
-    T_ch = coldhead.readline()
-    #while len(T_ch) < 8:
-    #    T_ch = coldhead.readline()
-    #coldhead.reset_input_buffer()
-    temp_ch = float(T_ch.strip())
-    controller.update(temp_hex) # compute manipulated variable
-    MV = controller.output # apply
-    print(t, temp_hex, temp_ch, MV)
-    ch_temps = np.append(ch_temps, temp_ch)
-    hex_temps = np.append(hex_temps, temp_hex)
-    time_stamps.append(dt.now().strftime('%M:%S'))
-    ch_temps = ch_temps[1: plot_window + 1]
-    hex_temps = hex_temps[1:plot_window+1]
-    time_stamps = time_stamps[1: plot_window + 1]
-    #print(dt.now().strftime('%M:%S'))
-    chline.set_ydata(ch_temps)
-    hexline.set_ydata(hex_temps)
-    chline.set_xdata(time_stamps)
-    hexline.set_xdata(time_stamps)
-    ax.relim()
-    #ax.set_ylim(0,24)
-    ax.autoscale_view()
-    ax.set_xticks(time_stamps[::100])
-    ax.set_xticklabels(time_stamps[::100])
-    fig.canvas.draw()
-    fig.canvas.flush_events()
-    #heatexchanger.reset_input_buffer()
-    #coldhead.reset_input_buffer()
-    #print(heatexchanger.in_waiting)
-    time.sleep(0.5)
-    #if MV > 0:
-    #    #relay.write(b'11')
-    #    relay.readline()
-    #else:
-    #    #relay.write(b'10')
-    #    relay.readline()
\ No newline at end of file
+stop = threading.Event()
+
+def acquire():
+    #reads the serial ports and updates the controller, runs on its own thread so drawing never delays it
+    t = 0
+    while not stop.is_set():
+        t = t + 1
+        temp_hex = reader.value('heatexchanger')     #freshest reading, None if the port went quiet
+        temp_ch = reader.value('coldhead')
+        if temp_hex is None or temp_ch is None:
+            print(t, 'no fresh data from', reader.stale())
+        else:
+            controller.update(temp_hex) # compute manipulated variable
+            MV = controller.output # apply
+            print(t, temp_hex, temp_ch, MV)
+            plot.push(time.time(), [temp_ch, temp_hex])     #only stores the sample, the GUI thread draws it
+        time.sleep(0.5)
+        #if MV > 0:
+        #    #relay.write(b'11')
+        #    relay.readline()
+        #else:
+        #    #relay.write(b'10')
+        #    relay.readline()
+
+threading.Thread(target=acquire, daemon=True).start()
+try:
+    plot.run(0.5)     #render cadence, independent of the acquisition loop
+finally:
+    stop.set()
+    reader.stop()
\ No newline at end of file
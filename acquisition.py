@@ -0,0 +1,142 @@
+"""
+Ready driven acquisition of MAX31856 one shot conversions.
+
+Instead of blocking on one sensor's _wait_for_oneshot() and then checking the others in a fixed order, the scheduler
+polls every pending sensor in the same sweep and reads each one out as soon as its conversion is done. With
+pipeline=True the next conversion is started right after a readout, so the following read() only waits for
+whatever is left of that conversion. FakeMAX31856 stands in for the chip so the timing can be measured off the Pi.
+Given an instrumentation.Instruments, every readout also goes into an 'acquire <name>' latency histogram.
+"""
+import time
+
+
+class OneShotScheduler:
+    """Collects one shot conversions from a dict of {name: MAX31856} sensors"""
+
+    def __init__(self, sensors, poll_interval=0.002, pipeline=False, timeout=1.0, instruments=None):
+        self.sensors = dict(sensors)
+        self.poll_interval = poll_interval
+        self.pipeline = pipeline
+        self.timeout = timeout
+        self.in_flight = {}     # name: monotonic time the conversion was started
+        self.latency = {name: 0.0 for name in self.sensors}     # start to readout of the last conversion, seconds
+        self.ready_at = {name: 0.0 for name in self.sensors}     # monotonic time of the last readout
+        self.cycle_time = 0.0     # duration of the last read() call
+        self.stages = {name: instruments.stage('acquire ' + name) for name in self.sensors} if instruments else None
+
+    def start(self, names=None):
+        """Starts a one shot conversion on every named sensor that is not already converting"""
+        for name in (self.sensors if names is None else names):
+            if name not in self.in_flight:
+                self.sensors[name].initiate_one_shot_measurement()
+                self.in_flight[name] = time.monotonic()
+
+    def read(self):
+        """Returns {name: temperature} once every sensor has produced a reading"""
+        begin = time.monotonic()
+        self.start()
+        readings = {}
+        pending = list(self.in_flight)
+        while pending:
+            still_pending = []
+            for name in pending:
+                sensor = self.sensors[name]
+                if sensor.oneshot_pending:
+                    still_pending.append(name)
+                    continue
+                readings[name] = sensor.unpack_temperature()
+                now = time.monotonic()
+                self.latency[name] = now - self.in_flight.pop(name)
+                self.ready_at[name] = now
+                if self.stages is not None:
+                    self.stages[name].record(int(self.latency[name] * 1e9))
+                if self.pipeline:     # start the next conversion right away, it is collected on the next read()
+                    sensor.initiate_one_shot_measurement()
+                    self.in_flight[name] = now
+            pending = still_pending
+            if pending:
+                if time.monotonic() - begin > self.timeout:
+                    raise TimeoutError('one shot conversion timed out on {}'.format(', '.join(pending)))
+                time.sleep(self.poll_interval)
+        self.cycle_time = time.monotonic() - begin
+        return readings
+
+
+class FakeMAX31856:
+    """Stand in for adafruit_max31856.MAX31856 with a configurable conversion latency
+
+    temperature is either a number or a function of time returning the value to report.
+    spi_time is added to every register access to mimic the cost of an SPI transaction.
+    """
+
+    def __init__(self, temperature=20.0, conversion_time=0.16, spi_time=0.0):
+        self.temperature_source = temperature
+        self.conversion_time = conversion_time
+        self.spi_time = spi_time
+        self._done_at = None
+        self.conversions = 0
+
+    def _spi(self):
+        if self.spi_time:
+            time.sleep(self.spi_time)
+
+    def initiate_one_shot_measurement(self):
+        self._spi()
+        self._done_at = time.monotonic() + self.conversion_time
+        self.conversions += 1
+
+    @property
+    def oneshot_pending(self):
+        self._spi()
+        return self._done_at is not None and time.monotonic() < self._done_at
+
+    def _wait_for_oneshot(self):
+        while self.oneshot_pending:
+            time.sleep(0.01)
+
+    def unpack_temperature(self):
+        self._spi()
+        source = self.temperature_source
+        return source(time.time()) if callable(source) else source
+
+    @property
+    def temperature(self):
+        self.initiate_one_shot_measurement()
+        self._wait_for_oneshot()
+        return self.unpack_temperature()
+
+
+def sequential_read(sensors):
+    """The acquisition pattern of Temperature_Control_Only.py, kept for comparison"""
+    names = list(sensors)
+    for name in names:
+        sensors[name].initiate_one_shot_measurement()
+    sensors[names[0]]._wait_for_oneshot()
+    readings = {names[0]: sensors[names[0]].unpack_temperature()}
+    for name in names[1:]:
+        if sensors[name].oneshot_pending:
+            sensors[name]._wait_for_oneshot()
+        readings[name] = sensors[name].unpack_temperature()
+    return readings
+
+
+if __name__ == '__main__':
+    # compare the acquisition time per loop of the current pattern with the scheduler, without hardware
+    def fake_sensors():
+        return {name: FakeMAX31856(conversion_time=latency, spi_time=0.0002)
+                for name, latency in [('ColdHead', 0.155), ('HeatExF', 0.16), ('HeatExB', 0.17), ('Chamber', 0.165)]}
+    cycles = 10
+    sensors = fake_sensors()
+    start = time.monotonic()
+    for _ in range(cycles):
+        sequential_read(sensors)
+    print('sequential _wait_for_oneshot: {:.1f} ms per read'.format((time.monotonic() - start) / cycles * 1e3))
+    for pipeline in [False, True]:
+        scheduler = OneShotScheduler(fake_sensors(), pipeline=pipeline)
+        scheduler.read()     # with pipelining the first read primes the next conversions
+        start = time.monotonic()
+        for _ in range(cycles):
+            scheduler.read()
+            time.sleep(0.1)     # rest of the control loop, pipelined conversions keep running meanwhile
+        per_read = ((time.monotonic() - start) / cycles - 0.1) * 1e3
+        print('scheduler pipeline={}: {:.1f} ms per read'.format(pipeline, per_read))
@@ -0,0 +1,47 @@
+"""
+Benchmark of the vectorized PID.PIDBank against one PID.PID object per channel.
+
+Run from the repository root:  python benchmarks/bench_pid.py
+"""
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import PID
+
+
+def bench_scalar(channels, steps):
+    controllers = [PID.PID(0.2*0.6, 1.2*0.2/60, 3*0.2*60/40, current_time=0.0) for _ in range(channels)]
+    for controller in controllers:
+        controller.SetPoint = -115
+        controller.setSampleTime(0.25)
+    feedback = np.random.default_rng(0).normal(-115, 2, size=(steps, channels)).tolist()
+    start = time.perf_counter()
+    for step in range(steps):
+        now = 0.25 * (step + 1)
+        row = feedback[step]
+        for k, controller in enumerate(controllers):
+            controller.update(row[k], now)
+    return (time.perf_counter() - start) / steps
+
+
+def bench_bank(channels, steps):
+    bank = PID.PIDBank(channels, 0.2*0.6, 1.2*0.2/60, 3*0.2*60/40, current_time=0.0)
+    bank.SetPoint[:] = -115
+    bank.setSampleTime(0.25)
+    feedback = np.random.default_rng(0).normal(-115, 2, size=(steps, channels))
+    start = time.perf_counter()
+    for step in range(steps):
+        bank.update(feedback[step], 0.25 * (step + 1))
+    return (time.perf_counter() - start) / steps
+
+
+if __name__ == '__main__':
+    steps = 2000
+    print('{:>8} {:>14} {:>14} {:>8}'.format('channels', 'PID (us/tick)', 'bank (us/tick)', 'speedup'))
+    for channels in [1, 2, 4, 8, 16, 32, 64, 128, 256]:
+        scalar = bench_scalar(channels, steps)
+        bank = bench_bank(channels, steps)
+        print('{:>8} {:>14.2f} {:>14.2f} {:>8.1f}'.format(channels, scalar * 1e6, bank * 1e6, scalar / bank))
@@ -0,0 +1,52 @@
+"""
+Render time of All_plot.temp_plot style figures against the raw sample count, with and without decimation.
+
+Run from the repository root:  python benchmarks/bench_plot.py
+"""
+import os
+import sys
+import time
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import decimate
+
+
+def synthetic_series(n, channels=4, seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.arange(n)
+    y = np.cumsum(rng.normal(0, 0.05, size=(channels, n)), axis=1) - 100
+    y[:, rng.integers(0, n, size=20)] += 15     # spikes that decimation must keep
+    return x, y
+
+
+def render(x, y, width_px=None, method='minmax'):
+    start = time.perf_counter()
+    fig = plt.figure(figsize=(20, 20))
+    for series in y:
+        if width_px:
+            plt.plot(*decimate.decimate(x, series, width_px, method))
+        else:
+            plt.plot(x, series)
+    fig.canvas.draw()
+    plt.close(fig)
+    return time.perf_counter() - start
+
+
+def time_ticks(n, interval=1000):
+    labels = np.array(['12:00:00'] * n)
+    start = time.perf_counter()
+    decimate.tick_positions(labels, interval)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    print('{:>10} {:>10} {:>12} {:>10} {:>10}'.format('samples', 'raw (s)', 'minmax (s)', 'lttb (s)', 'ticks (ms)'))
+    for n in [10**4, 10**5, 10**6, 3 * 10**6]:
+        x, y = synthetic_series(n)
+        raw = render(x, y)
+        print('{:>10} {:>10.2f} {:>12.2f} {:>10.2f} {:>10.2f}'.format(n, raw, render(x, y, 2000, 'minmax'),
+                                                                      render(x, y, 2000, 'lttb'), time_ticks(n) * 1e3))
@@ -0,0 +1,398 @@
+"""
+Benchmark suite for the control loop, logging and log analysis hot paths, compared against stored baselines.
+
+Every benchmark reports one or more metrics where lower is better (time per operation, seconds per read, jitter):
+
+    pid          PID.PID.update per call
+    ledger       SampleLedger.append and average(6) per tick
+    stream_stats StreamStats.add per tick (8 channels, the 6 tick, 1 and 10 minute windows of
+                 Temperature_Control_Only.py) and mean(6) for the log row
+    interlock    InterlockEngine.evaluate per tick with the rule set of Temperature_Control_Only.py and with 400
+                 generated rules of every type on 16 channels
+    log_writer   BackgroundLogWriter.log per row on the loop side, and the writer thread's cost per row with and
+                 without log rotation (small max_bytes forces a new file every few thousand rows)
+    all_plot     All_plot.temp_data_read_csv cold (no sidecars) and warm (sidecars current) and
+                 All_plot.radon_data_read_txt, on synthetic logs of 1e4 to 1e6 rows (1e7 with --full)
+    loop         one control tick without the sensor wait (calibration, interlocks, both PIDs, relays, ledger,
+                 stream statistics, rollups, telemetry, log row) and a real time run of the paced loop on FakeBackend sensors, reporting the
+                 period error and the DeadlineScheduler jitter
+
+The synthetic logs are written once into a data directory (the system temp directory by default) and reused by
+later runs. Results are compared with benchmarks/baseline.json: a metric slower than its baseline by more than its
+tolerance is flagged as a regression and the exit status is 1. The millisecond loop timings also have to be off by
+an absolute slack, a scheduler hiccup of a fraction of a millisecond is not a regression. Baselines are only
+meaningful on the machine they were recorded on, rerun with --save on the Pi (or the analysis machine) to record
+its own.
+
+Run from the repository root:  python benchmarks/run_benchmarks.py [--full] [--only loop] [--save]
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime as dt
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import PID
+import All_plot
+from ledger import SampleLedger
+from log_writer import BackgroundLogWriter
+from rollup import RollupStore
+from stream_stats import StreamStats
+from interlock import InterlockEngine, load_rules, generated_rules, outputs_off
+from calibration import load_registry
+from telemetry import TelemetryBuffer
+from acquisition import OneShotScheduler
+from loop_scheduler import DeadlineScheduler, SKIP
+from sensor_backend import FakeBackend, THERMOCOUPLE_PINS, HEATER_PINS
+
+BASELINE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'baseline.json')
+SIZES = [10**4, 10**5, 10**6]
+FULL_SIZES = SIZES + [10**7]
+TOLERANCE = 0.5     # default allowed slowdown before a metric counts as a regression, timings on a busy Pi scatter by ~30%
+LOG_HEADER = ['Rt', 'temp_ch', 'temp_hex_f', 'temp_hex_b', 'temp_chamber', 'Heat F', 'Heat B']
+ROWS_PER_LOG = 60000     # about one 4 MB log file of the control scripts
+
+
+def best_of(function, repeat=5):
+    """Smallest of `repeat` timings, the least disturbed by the rest of the machine"""
+    return min(function() for _ in range(repeat))
+
+
+def metric(value, unit, tolerance=TOLERANCE, slack=0.0):
+    """A result, slower than baseline * (1 + tolerance) and by more than `slack` units counts as a regression"""
+    return {'value': float(value), 'unit': unit, 'tolerance': tolerance, 'slack': slack}
+
+
+def size_label(n):
+    return '1e{}'.format(int(round(np.log10(n))))
+
+
+# synthetic logs
+
+def write_temp_logs(directory, rows, seed=0):
+    """Writes `rows` log rows in the format of BackgroundLogWriter, split like the rotated 4 MB files"""
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    names = []
+    template = '%s,%.6f,%.6f,%.6f,%.6f,%d,%d'
+    for start in range(0, rows, ROWS_PER_LOG):
+        n = min(ROWS_PER_LOG, rows - start)
+        seconds = (start + np.arange(n)) * 6
+        clock = ['{:02d}:{:02d}:{:02d}'.format(s // 3600 % 24, s // 60 % 60, s % 60) for s in seconds.tolist()]
+        temps = np.cumsum(rng.normal(0, 0.05, size=(4, n)), axis=1) + np.array([[-101], [-115], [-94.5], [22]])
+        heat = rng.integers(0, 2, size=(2, n))
+        name = 'Temp log {:05d}.csv'.format(start // ROWS_PER_LOG)
+        with open(os.path.join(directory, name), 'w', encoding='UTF8', newline='') as f:
+            f.write(','.join(LOG_HEADER) + '\r\n')
+            f.write('\r\n'.join(template % row for row in zip(clock, *temps.tolist(), *heat.tolist())) + '\r\n')
+        names.append(name)
+    return names
+
+
+def write_radon_txt(path, rows, seed=0):
+    """Writes a RadonEye text export with `rows` readings"""
+    values = np.abs(np.random.default_rng(seed).normal(0.3, 0.1, size=rows))
+    header = ['RadonEye export', 'Serial: RE00000', 'Unit: pCi/L', 'Download time: 2022-12-01 15:11',
+              'Interval: 60 min', 'Data']
+    with open(path, 'w', encoding='utf8') as f:
+        f.write('\n'.join(header) + '\n')
+        f.write('\n'.join('{})\t {:.2f}'.format(k + 1, v) for k, v in enumerate(values.tolist())) + '\n')
+
+
+def synthetic_data(data_dir, rows):
+    """Directory with `rows` rows of temperature logs and a radon export of the same length, made on first use"""
+    directory = os.path.join(data_dir, 'rows {}'.format(rows))
+    done = os.path.join(directory, 'complete')
+    if not os.path.exists(done):
+        shutil.rmtree(directory, ignore_errors=True)
+        write_temp_logs(directory, rows)
+        write_radon_txt(os.path.join(directory, 'radon.txt'), rows)
+        open(done, 'w').close()
+    names = sorted(name for name in os.listdir(directory) if name.endswith('.csv'))
+    return directory + os.sep, names
+
+
+# benchmarks
+
+def bench_pid(args, steps=20000):
+    feedback = np.random.default_rng(0).normal(-115, 2, size=steps).tolist()
+
+    def run():
+        # a fresh controller every repeat, a reused one would see times before its last_time and skip every update
+        controller = PID.PID(0.2*0.6, 1.2*0.2/60, 3*0.2*60/40, current_time=0.0)
+        controller.SetPoint = -115
+        controller.setSampleTime(0.25)
+        start = time.perf_counter()
+        for step in range(steps):
+            controller.update(feedback[step], 0.25 * (step + 1))
+        return (time.perf_counter() - start) / steps
+    return {'pid.update': metric(best_of(run) * 1e6, 'us')}
+
+
+def bench_ledger(args, steps=20000):
+    ledger = SampleLedger(['temp_ch', 'temp_hex_f', 'temp_hex_b', 'temp_chamber', 'MV1', 'Heat F', 'MV2', 'Heat B'], 3600)
+    rows = np.random.default_rng(0).normal(-100, 5, size=(steps, 8)).tolist()
+
+    def append():
+        start = time.perf_counter()
+        for step in range(steps):
+            ledger.append(step, rows[step])
+        return (time.perf_counter() - start) / steps
+
+    def average():
+        start = time.perf_counter()
+        for _ in range(steps):
+            ledger.average(6)
+        return (time.perf_counter() - start) / steps
+    return {'ledger.append': metric(best_of(append) * 1e6, 'us'),
+            'ledger.average': metric(best_of(average) * 1e6, 'us')}
+
+
+def bench_stream_stats(args, steps=20000):
+    channels = ['temp_ch', 'temp_hex_f', 'temp_hex_b', 'temp_chamber', 'MV1', 'Heat F', 'MV2', 'Heat B']
+    stats = StreamStats(channels, windows=(6, 60, 600), outputs=['Heat F', 'Heat B'])
+    rows = np.random.default_rng(0).normal(-100, 5, size=(steps, 8)).tolist()
+
+    def add():
+        start = time.perf_counter()
+        for step in range(steps):
+            stats.add(step, rows[step])
+        return (time.perf_counter() - start) / steps
+
+    def mean():
+        start = time.perf_counter()
+        for _ in range(steps):
+            stats.mean(6)
+        return (time.perf_counter() - start) / steps
+    return {'stream_stats.add': metric(best_of(add) * 1e6, 'us'),
+            'stream_stats.mean': metric(best_of(mean) * 1e6, 'us')}
+
+
+def bench_interlock(args, steps=20000):
+    readings = np.random.default_rng(0).normal(-100, 1, size=(steps, 16)).tolist()
+    results = {}
+    for label, channels, rules in [
+            ('stand', ['temp_ch', 'temp_hex_f', 'temp_hex_b', 'temp_chamber'], load_rules('temperature_control')),
+            ('400', ['ch{}'.format(k) for k in range(16)], None)]:
+        engine = InterlockEngine(channels, rules or generated_rules(channels, 400))
+        rows = [row[:len(channels)] for row in readings]
+
+        def evaluate():
+            start = time.perf_counter()
+            for step in range(steps):
+                engine.evaluate(step * 0.25, rows[step])
+            return (time.perf_counter() - start) / steps
+        results['interlock.evaluate[{}]'.format(label)] = metric(best_of(evaluate) * 1e6, 'us')
+    return results
+
+
+def _drain(directory, rows, max_bytes):
+    # rows queued up front, then the time the writer thread needs to write them all and close
+    counter = iter(range(10**9))
+    writer = BackgroundLogWriter(directory, LOG_HEADER, max_bytes=max_bytes, queue_size=len(rows) + 1,
+                                 file_namer=lambda: 'Temp log {:05d}.csv'.format(next(counter)))
+    start = time.perf_counter()
+    for row in rows:
+        writer.log(row)
+    queued = time.perf_counter()
+    writer.close(timeout=60)
+    end = time.perf_counter()
+    return (queued - start) / len(rows), (end - start) / len(rows), next(counter)
+
+
+def bench_log_writer(args, count=50000):
+    rng = np.random.default_rng(0)
+    rows = [['12:00:00'] + list(values) + [1, 0] for values in rng.normal(-100, 5, size=(count, 4)).tolist()]
+    directory = tempfile.mkdtemp(prefix='bench log writer ')
+    try:
+        log_calls, plain, rotating, files = [], [], [], 0
+        for _ in range(3):
+            for sub in os.listdir(directory):
+                os.remove(os.path.join(directory, sub))
+            log_call, per_row, _ = _drain(directory, rows, max_bytes=4194304)
+            log_calls.append(log_call)
+            plain.append(per_row)
+            for sub in os.listdir(directory):
+                os.remove(os.path.join(directory, sub))
+            _, per_row, files = _drain(directory, rows, max_bytes=65536)
+            rotating.append(per_row)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    print('    {} rows, {} files with 64 kB rotation'.format(count, files))
+    return {'log_writer.log': metric(min(log_calls) * 1e6, 'us'),
+            'log_writer.row': metric(min(plain) * 1e6, 'us'),
+            'log_writer.row_rotating': metric(min(rotating) * 1e6, 'us')}
+
+
+def bench_all_plot(args):
+    results = {}
+    for rows in (FULL_SIZES if args.full else SIZES):
+        directory, names = synthetic_data(args.data, rows)
+        label = size_label(rows)
+        repeat = 3 if rows <= 10**6 else 1
+
+        def cold():
+            start = time.perf_counter()
+            All_plot.temp_data_read_csv(directory, names, cache=False)
+            return time.perf_counter() - start
+
+        def warm():
+            start = time.perf_counter()
+            All_plot.temp_data_read_csv(directory, names, cache=True)
+            return time.perf_counter() - start
+
+        def radon():
+            start = time.perf_counter()
+            All_plot.radon_data_read_txt(directory, 'radon.txt')
+            return time.perf_counter() - start
+
+        shutil.rmtree(os.path.join(directory, '.cache'), ignore_errors=True)
+        results['all_plot.temp_csv_cold[{}]'.format(label)] = metric(best_of(cold, repeat), 's')
+        All_plot.temp_data_read_csv(directory, names, cache=True)     # writes the sidecars
+        results['all_plot.temp_csv_warm[{}]'.format(label)] = metric(best_of(warm, repeat), 's')
+        results['all_plot.radon_txt[{}]'.format(label)] = metric(best_of(radon, repeat), 's')
+        print('    {} rows in {} files'.format(rows, len(names)))
+    return results
+
+
+def bench_loop(args, ticks=5000, period=0.05, cycles=100):
+    # one tick of Temperature_Control_Only.py without the conversion wait and the prints
+    calibrate = load_registry().compile(['ColdHead', 'HeatExF', 'HeatExB', 'Chamber'])
+    controllers = [PID.PID(0.2*0.6, 1.2*0.2/60, 3*0.2*60/40, 0.0) for _ in range(2)]
+    for controller, target in zip(controllers, [-115, -94.5]):
+        controller.SetPoint = target
+        controller.setSampleTime(0.5)
+    heaters = FakeBackend().outputs(HEATER_PINS)
+    relays = [heaters['HeaterF'], heaters['HeaterB']]
+    interlocks = InterlockEngine(['temp_ch', 'temp_hex_f', 'temp_hex_b', 'temp_chamber'], load_rules('temperature_control'),
+                                 safe_state=outputs_off(*relays))
+    channels = ['temp_ch', 'temp_hex_f', 'temp_hex_b', 'temp_chamber', 'MV1', 'Heat F', 'MV2', 'Heat B']
+    ledger = SampleLedger(channels, 3600)
+    stats = StreamStats(channels, windows=(6, 60, 600), outputs=['Heat F', 'Heat B'])
+    telemetry = TelemetryBuffer(channels, 3600)
+    rollups = RollupStore(None, LOG_HEADER[1:], persist=False)
+    raw = np.random.default_rng(0).normal([-101, -115, -94.5, 22], 1, size=(ticks, 4)).tolist()
+    directory = tempfile.mkdtemp(prefix='bench loop ')
+    logger = BackgroundLogWriter(directory, LOG_HEADER)
+    try:
+        start = time.perf_counter()
+        for tick in range(ticks):
+            now = 1.0 + tick
+            temps = calibrate(raw[tick])
+            tripped = interlocks.evaluate(now, temps)
+            row = list(temps)
+            for k, controller in enumerate(controllers):
+                controller.update(temps[1 + k], now)
+                relays[k].value = controller.output > 0 and not tripped
+                row += [controller.output, int(relays[k].value)]
+            ledger.append(now, row)
+            stats.add(now, row)
+            rollups.add(now, row[:4] + [row[5], row[7]])
+            telemetry.publish(now, row)
+            if tick % 6 == 5:
+                logger.log([dt.fromtimestamp(now).strftime('%H:%M:%S')] + stats.mean(6)[:4].tolist() + [row[5], row[7]])
+        tick_time = (time.perf_counter() - start) / ticks
+    finally:
+        logger.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    # the paced loop in real time, conversions take 40% of the period
+    backend = FakeBackend(conversion_time=0.4 * period)
+    acquisition = OneShotScheduler(backend.max31856(THERMOCOUPLE_PINS), pipeline=False)
+    scheduler = DeadlineScheduler(period, overrun=SKIP, clock=backend.monotonic, sleep=backend.sleep)
+    stamps = []
+    for _ in range(cycles):
+        calibrate(list(acquisition.read().values()))
+        scheduler.wait()
+        stamps.append(backend.monotonic())
+    stats = scheduler.stats()
+    period_error = abs(np.mean(np.diff(stamps)) - period) * 1e3
+    print('    paced loop: {} cycles of {} ms, {} overruns'.format(stats['cycles'], period * 1e3, stats['overruns']))
+    return {'loop.tick': metric(tick_time * 1e6, 'us'),
+            'loop.period_error': metric(period_error, 'ms', tolerance=1.0, slack=0.5),
+            'loop.jitter_mean': metric(stats['jitter_mean_ms'], 'ms', tolerance=1.0, slack=1.0),
+            'loop.jitter_p99': metric(stats['jitter_p99_ms'], 'ms', tolerance=1.0, slack=5.0)}
+
+
+BENCHMARKS = [('pid', bench_pid), ('ledger', bench_ledger), ('stream_stats', bench_stream_stats),
+              ('interlock', bench_interlock), ('log_writer', bench_log_writer), ('all_plot', bench_all_plot),
+              ('loop', bench_loop)]
+
+
+# baselines
+
+def machine():
+    return {'node': platform.node(), 'machine': platform.machine(), 'processor': platform.processor(),
+            'python': platform.python_version(), 'numpy': np.__version__}
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf8') as f:
+        return json.load(f)
+
+
+def save_baseline(path, results, previous=None):
+    """Stores the results, metrics not measured in this run keep their previous baseline"""
+    merged = dict(previous['results']) if previous else {}
+    merged.update(results)
+    with open(path, 'w', encoding='utf8') as f:
+        json.dump({'recorded': dt.now().strftime('%Y-%m-%d %H:%M:%S'), 'machine': machine(),
+                   'results': dict(sorted(merged.items()))}, f, indent=1)
+        f.write('\n')
+
+
+def compare(results, baseline, tolerance=None):
+    """Prints every metric against its baseline, returns the names of the regressed ones"""
+    regressions = []
+    print('{:<36} {:>12} {:>12} {:>8}'.format('metric', 'current', 'baseline', 'ratio'))
+    for name, result in results.items():
+        reference = (baseline or {}).get('results', {}).get(name)
+        if reference is None:
+            print('{:<36} {:>9.3f} {:<2} {:>12}'.format(name, result['value'], result['unit'], 'none'))
+            continue
+        ratio = result['value'] / reference['value'] if reference['value'] > 0 else float('inf')
+        allowed = result['tolerance'] if tolerance is None else tolerance
+        slower = ratio > 1 + allowed and result['value'] - reference['value'] > result.get('slack', 0.0)
+        flag = 'REGRESSION' if slower else ''
+        if flag:
+            regressions.append(name)
+        print('{:<36} {:>9.3f} {:<2} {:>9.3f} {:<2} {:>8.2f} {}'.format(
+            name, result['value'], result['unit'], reference['value'], reference['unit'], ratio, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the control loop, logging and log analysis')
+    parser.add_argument('--only', nargs='*', default=None, help='benchmarks to run: ' + ', '.join(b[0] for b in BENCHMARKS))
+    parser.add_argument('--full', action='store_true', help='also read 1e7 row logs (about 600 MB of csv)')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--tolerance', type=float, default=None, help='allowed slowdown for every metric, e.g. 0.25')
+    parser.add_argument('--data', default=os.path.join(tempfile.gettempdir(), 'slowcontrol benchmark data'),
+                        help='directory for the synthetic logs, kept between runs')
+    args = parser.parse_args()
+
+    results = {}
+    for name, bench in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        print('{} ...'.format(name))
+        results.update(bench(args))
+    baseline = load_baseline(args.baseline)
+    if baseline and baseline.get('machine', {}).get('node') != machine()['node']:
+        print('baseline was recorded on {}, comparisons with this machine are rough'.format(baseline['machine']))
+    regressions = compare(results, baseline, args.tolerance)
+    if args.save:
+        save_baseline(args.baseline, results, baseline)
+        print('baseline written to', args.baseline)
+    elif regressions:
+        print('{} regression(s): {}'.format(len(regressions), ', '.join(regressions)))
+        sys.exit(1)
@@ -0,0 +1,184 @@
+"""
+Append only binary temperature log with fixed size records.
+
+File layout: the magic bytes b'SCPLOG01', a little endian uint32 with the length of a JSON header, the JSON header
+(padded with spaces so records start on an 8 byte boundary) and then one packed record per sample. The header
+carries the csv data_header the record was built from and the NumPy dtype of a record: float64 epoch time for 'Rt',
+uint8 for relay/heater states and float32 for every other channel. read_binlog memory maps the records straight into
+a NumPy structured array, so nothing is parsed when loading.
+
+Usage from the command line:
+    python binlog.py import "Logs/Temp log 09-30-2022, 09-24.csv" ...     # writes a .bin next to every csv
+    python binlog.py export "Logs/Temp log 09-30-2022, 09-24.bin" ...     # writes a .csv next to every bin
+"""
+import csv
+import json
+import os
+import re
+import struct
+import sys
+import time
+from datetime import datetime as dt, timedelta
+import numpy as np
+from log_rotation import split_compression, open_log
+
+MAGIC = b'SCPLOG01'
+STATE_PREFIXES = ('Heat', 'Relay')     # columns holding relay or heater on/off states
+
+
+def schema_from_header(data_header):
+    """NumPy record dtype for a csv data_header, e.g. ['Rt', 'temp_ch', ..., 'Heat F', 'Heat B']"""
+    fields = []
+    for name in data_header:
+        if name == 'Rt':
+            fields.append((name, '<f8'))
+        elif name.startswith(STATE_PREFIXES):
+            fields.append((name, 'u1'))
+        else:
+            fields.append((name, '<f4'))
+    return np.dtype(fields)
+
+
+def _header_bytes(data_header, dtype, meta=None):
+    fields = {'version': 1, 'columns': list(data_header), 'dtype': dtype.descr,
+              'record_size': dtype.itemsize, 'created': time.time()}
+    if meta is not None:
+        fields['meta'] = meta
+    header = json.dumps(fields).encode('UTF8')
+    pad = -(len(MAGIC) + 4 + len(header)) % 8
+    header += b' ' * pad
+    return MAGIC + struct.pack('<I', len(header)) + header
+
+
+def read_header(path):
+    """Returns (header dict, byte offset of the first record)"""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a binary temperature log'.format(path))
+        length = struct.unpack('<I', f.read(4))[0]
+        header = json.loads(f.read(length).decode('UTF8'))
+    return header, len(MAGIC) + 4 + length
+
+
+class BinaryLogWriter:
+    """Appends fixed size records to a binary log, writing the header if the file is new.
+    dtype overrides the schema derived from data_header, meta is any JSON value stored in a new file's header."""
+
+    def __init__(self, path, data_header, dtype=None, meta=None):
+        self.path = path
+        self.dtype = np.dtype(dtype) if dtype is not None else schema_from_header(data_header)
+        self._struct = struct.Struct('<' + ''.join({'<f8': 'd', '<f4': 'f', '|u1': 'B'}[t] for _, t in self.dtype.descr))
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            header, _ = read_header(path)
+            if header['columns'] != list(data_header):
+                raise ValueError('{} was written with columns {}'.format(path, header['columns']))
+            self._file = open(path, 'ab')
+        else:
+            self._file = open(path, 'wb')
+            self._file.write(_header_bytes(data_header, self.dtype, meta))
+
+    def write(self, row):
+        """row holds epoch time followed by every channel, in data_header order"""
+        self._file.write(self._struct.pack(*row))
+
+    def write_array(self, records):
+        """Appends a structured array of records with this log's dtype"""
+        self._file.write(np.ascontiguousarray(records, dtype=self.dtype).tobytes())
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_binlog(path, mode='r'):
+    """Memory maps a binary log, returns (structured array of records, header dict).
+    A partially written last record (e.g. after a power cut) is left out."""
+    header, offset = read_header(path)
+    dtype = np.dtype([tuple(field) for field in header['dtype']])
+    count = (os.path.getsize(path) - offset) // dtype.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=dtype), header
+    return np.memmap(path, dtype=dtype, mode=mode, offset=offset, shape=(count,)), header
+
+
+def export_csv(bin_path, csv_path):
+    """Writes a binary log back out as csv with 'Rt' as local time 'YYYY-mm-dd HH:MM:SS'"""
+    records, header = read_binlog(bin_path)
+    with open(csv_path, 'w', encoding='UTF8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header['columns'])
+        stamps = [dt.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S') for t in records['Rt']]
+        columns = [stamps] + [records[name] for name in header['columns'][1:]]
+        writer.writerows(zip(*columns))
+
+
+def date_from_log_name(file_name):
+    """Start date and time of a 'Temp log MM-DD-YYYY, HH-MM.csv' file, also of its '_2' rotations and compressed copies"""
+    stem = os.path.splitext(split_compression(os.path.basename(file_name))[0])[0]
+    stem = re.sub(r'_\d+$', '', stem)
+    return dt.strptime(stem.replace('Temp log ', ''), '%m-%d-%Y, %H-%M')
+
+
+def csv_rows_to_records(rows, data_header, start):
+    """Converts csv rows whose 'Rt' is '%H:%M:%S' (or '%Y-%m-%d %H:%M:%S') to records.
+    The date comes from start and a day is added every time the clock wraps past midnight."""
+    dtype = schema_from_header(data_header)
+    records = np.zeros(len(rows), dtype=dtype)
+    if not rows:
+        return records
+    columns = list(zip(*rows))
+    day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    epoch = np.empty(len(rows))
+    previous = None
+    for i, stamp in enumerate(columns[0]):
+        stamp = stamp.strip()
+        if ' ' in stamp:     # already carries its date
+            when = dt.strptime(stamp, '%Y-%m-%d %H:%M:%S')
+        else:
+            clock = dt.strptime(stamp, '%H:%M:%S')
+            when = day.replace(hour=clock.hour, minute=clock.minute, second=clock.second)
+            if previous is not None and when < previous:
+                day += timedelta(days=1)
+                when += timedelta(days=1)
+        previous = when
+        epoch[i] = when.timestamp()
+    records['Rt'] = epoch
+    for k, name in enumerate(data_header[1:], 1):
+        records[name] = np.asarray(columns[k], dtype='float64')
+    return records
+
+
+def import_csv(csv_path, bin_path, data_header=None):
+    """Converts an existing csv temperature log, plain or compressed. Files written without a header need data_header."""
+    with open_log(csv_path) as f:
+        rows = [row for row in csv.reader(f) if row]
+    if rows and rows[0][0] == 'Rt':
+        data_header = rows.pop(0)
+    if data_header is None:
+        raise ValueError('{} has no header, pass data_header'.format(csv_path))
+    records = csv_rows_to_records(rows, data_header, date_from_log_name(csv_path))
+    if os.path.exists(bin_path):
+        os.remove(bin_path)
+    with BinaryLogWriter(bin_path, data_header) as writer:
+        writer.write_array(records)
+    return records
+
+
+if __name__ == '__main__':
+    command, paths = sys.argv[1], sys.argv[2:]
+    for path in paths:
+        if command == 'import':
+            records = import_csv(path, os.path.splitext(split_compression(path)[0])[0] + '.bin')
+            print('{}: {} records'.format(path, len(records)))
+        elif command == 'export':
+            export_csv(path, os.path.splitext(path)[0] + '.csv')
+        else:
+            raise SystemExit('usage: python binlog.py import|export FILE...')
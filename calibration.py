@@ -0,0 +1,308 @@
+"""
+Per channel sensor calibrations, applied to whole arrays.
+
+calibrations.json maps a channel ID (ColdHead, HeatExF, HeatExB, Chamber for the MAX31856 thermocouples, Tip,
+Ceramic, Flange for the MAX31865 PT100s) to one of three models:
+
+    affine               temperature = scale * raw + offset, what the old calibrated_temps two point corrections were
+    polynomial           temperature = c0 + c1 * raw + c2 * raw**2 + ...
+    callendar_van_dusen  PT100 resistance in ohms to temperature, with the sensor's own R0, A, B, C
+
+Every model also has an inverse, which is what lets recalibrate() undo the calibration a log was recorded with and
+apply a corrected one. The control loops compile the channels they read once and then calibrate the whole reading
+vector in one call; the affine channels share a single fused multiply-add.
+
+recalibrate() rewrites archived logs in a process pool, one file per worker. Binary logs (binlog.py) are converted a
+million records at a time, close to disk speed; csv logs are streamed in chunks and are bound by float formatting.
+
+    python calibration.py recalibrate --out Logs/recalibrated --applied temp_hex_b=HeatExF Logs/*.csv
+"""
+import json
+import os
+import sys
+from datetime import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from log_rotation import open_log, is_csv_log, split_compression
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'calibrations.json')
+COLUMN_CHANNELS = {'temp_ch': 'ColdHead', 'temp_hex_f': 'HeatExF', 'temp_hex_b': 'HeatExB', 'temp_chamber': 'Chamber',
+                   'temp_hex': 'HeatExB',     # logs from before the front/back split, see log_ingest.temp_arrays
+                   'temp_tip': 'Tip', 'temp_ceramic': 'Ceramic', 'temp_flange': 'Flange'}     # log column -> channel ID
+
+
+class Affine:
+    """temperature = scale * raw + offset"""
+    kind = 'affine'
+
+    def __init__(self, scale=1.0, offset=0.0):
+        self.scale = float(scale)
+        self.offset = float(offset)
+
+    @classmethod
+    def from_ranges(cls, raw_shift, raw_range, reference_range, reference_shift):
+        """The ((raw + raw_shift) * reference_range / raw_range) - reference_shift form of the old calibrated_temps"""
+        scale = reference_range / raw_range
+        return cls(scale, raw_shift * scale - reference_shift)
+
+    @classmethod
+    def fit(cls, raw, reference):
+        scale, offset = np.polyfit(raw, reference, 1)
+        return cls(scale, offset)
+
+    def __call__(self, raw):
+        return np.asarray(raw, dtype='float64') * self.scale + self.offset
+
+    def inverse(self, temperature):
+        return (np.asarray(temperature, dtype='float64') - self.offset) / self.scale
+
+    def to_dict(self):
+        return {'model': self.kind, 'scale': self.scale, 'offset': self.offset}
+
+
+class Polynomial:
+    """temperature = sum(coefficients[k] * raw**k)"""
+    kind = 'polynomial'
+
+    def __init__(self, coefficients):
+        self.coefficients = np.asarray(coefficients, dtype='float64')
+        self.derivative = np.polynomial.polynomial.polyder(self.coefficients)
+
+    @classmethod
+    def fit(cls, raw, reference, degree=2):
+        return cls(np.polynomial.polynomial.polyfit(raw, reference, degree))
+
+    def __call__(self, raw):
+        return np.polynomial.polynomial.polyval(np.asarray(raw, dtype='float64'), self.coefficients)
+
+    def inverse(self, temperature, iterations=20, tolerance=1e-9):
+        # Newton's method started from the reading itself, calibrations are close to the identity
+        temperature = np.asarray(temperature, dtype='float64')
+        raw = temperature.copy()
+        for _ in range(iterations):
+            step = (self(raw) - temperature) / np.polynomial.polynomial.polyval(raw, self.derivative)
+            raw -= step
+            if np.nanmax(np.abs(step), initial=0.0) < tolerance:
+                break
+        return raw
+
+    def to_dict(self):
+        return {'model': self.kind, 'coefficients': self.coefficients.tolist()}
+
+
+class CallendarVanDusen:
+    """PT100 (or PT1000) resistance to temperature, IEC 60751 coefficients unless the sensor was calibrated"""
+    kind = 'callendar_van_dusen'
+
+    def __init__(self, R0=100.0, A=3.9083e-3, B=-5.775e-7, C=-4.183e-12):
+        self.R0, self.A, self.B, self.C = float(R0), float(A), float(B), float(C)
+
+    def resistance(self, temperature):
+        """R(T), the C term only applies below 0 C"""
+        t = np.asarray(temperature, dtype='float64')
+        c = np.where(t < 0, self.C, 0.0)
+        return self.R0 * (1 + self.A * t + self.B * t**2 + c * (t - 100) * t**3)
+
+    def __call__(self, resistance):
+        ratio = np.asarray(resistance, dtype='float64') / self.R0
+        # closed form above 0 C, also the starting point of the Newton steps below it
+        t = np.atleast_1d((-self.A + np.sqrt(self.A**2 - 4 * self.B * (1 - ratio))) / (2 * self.B))
+        cold = t < 0
+        if cold.any():
+            tc, target = t[cold], np.atleast_1d(ratio)[cold]
+            for _ in range(4):
+                f = 1 + self.A * tc + self.B * tc**2 + self.C * (tc - 100) * tc**3 - target
+                df = self.A + 2 * self.B * tc + self.C * (4 * tc**3 - 300 * tc**2)
+                tc = tc - f / df
+            t[cold] = tc
+        return t.reshape(ratio.shape)[()]
+
+    def inverse(self, temperature):
+        return self.resistance(temperature)
+
+    def to_dict(self):
+        return {'model': self.kind, 'R0': self.R0, 'A': self.A, 'B': self.B, 'C': self.C}
+
+
+MODELS = {cls.kind: cls for cls in [Affine, Polynomial, CallendarVanDusen]}
+
+
+def model_from_dict(spec):
+    spec = dict(spec)
+    kind = spec.pop('model')
+    spec.pop('note', None)
+    if kind not in MODELS:
+        raise ValueError('unknown calibration model {}'.format(kind))
+    return MODELS[kind](**spec)
+
+
+class CalibrationRegistry:
+    """Channel ID -> calibration model. Channels without an entry pass through unchanged"""
+
+    def __init__(self, models=None, notes=None):
+        self.models = dict(models or {})
+        self.notes = dict(notes or {})
+
+    def __getitem__(self, channel):
+        return self.models.get(channel, Affine())
+
+    def __contains__(self, channel):
+        return channel in self.models
+
+    def register(self, channel, model, note=None):
+        self.models[channel] = model
+        if note:
+            self.notes[channel] = note
+
+    def apply(self, channel, raw):
+        """Calibrated temperatures of one channel, raw is a number or any array"""
+        return self[channel](raw)
+
+    def compile(self, channels):
+        """Returns f(raw values, one per channel in this order) -> calibrated numpy array"""
+        return CompiledCalibration(self, channels)
+
+    def to_dict(self):
+        channels = {}
+        for channel, model in self.models.items():
+            channels[channel] = model.to_dict()
+            if channel in self.notes:
+                channels[channel]['note'] = self.notes[channel]
+        return {'channels': channels}
+
+    def save(self, path=DEFAULT_PATH):
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf8') as f:
+            json.dump(self.to_dict(), f, indent=4)
+        os.replace(tmp, path)
+
+
+class CompiledCalibration:
+    """Calibration of a fixed channel vector. Affine channels are folded into one scale/offset pair of arrays"""
+
+    def __init__(self, registry, channels):
+        self.channels = list(channels)
+        models = [registry[c] for c in self.channels]
+        self.scale = np.array([m.scale if isinstance(m, Affine) else 1.0 for m in models])
+        self.offset = np.array([m.offset if isinstance(m, Affine) else 0.0 for m in models])
+        self.others = [(k, m) for k, m in enumerate(models) if not isinstance(m, Affine)]
+
+    def __call__(self, raw):
+        """raw has the channels along its first axis, e.g. one reading per channel or (channels, samples)"""
+        raw = np.asarray(raw, dtype='float64')
+        shape = (-1,) + (1,) * (raw.ndim - 1)
+        out = raw * self.scale.reshape(shape) + self.offset.reshape(shape)
+        for k, model in self.others:
+            out[k] = model(raw[k])
+        return out
+
+
+def load_registry(path=DEFAULT_PATH):
+    with open(path, encoding='utf8') as f:
+        spec = json.load(f)
+    registry = CalibrationRegistry()
+    for channel, model in spec['channels'].items():
+        registry.register(channel, model_from_dict(model), model.get('note'))
+    return registry
+
+
+def _recalibrate_columns(frame, header, new, applied, channels):
+    for column in header[1:]:
+        channel = channels.get(column)
+        if channel is None:
+            continue
+        values = frame[column].to_numpy(dtype='float64')
+        frame[column] = new[channel](applied[channel].inverse(values))
+    return frame
+
+
+def recalibrate_file(path, out_path, header, new, applied, channels=COLUMN_CHANNELS, chunk_rows=1000000):
+    """Rewrites one log with every calibrated column converted from the `applied` calibration to the `new` one.
+    applied and new are registries or {channel: model}. csv logs are streamed in chunks, binary logs memory mapped."""
+    if path.endswith('.bin'):
+        from binlog import read_binlog, BinaryLogWriter
+        records, meta = read_binlog(path)
+        with BinaryLogWriter(out_path, meta['columns']) as writer:
+            for start in range(0, len(records), chunk_rows):
+                out = np.array(records[start:start + chunk_rows])
+                for column in meta['columns'][1:]:
+                    channel = channels.get(column)
+                    if channel is not None:
+                        out[column] = new[channel](applied[channel].inverse(out[column]))
+                writer.write_array(out)
+        return len(records)
+    with open_log(path, 'rb') as f:     # rotated segments may be gzip or zstd compressed
+        first = f.readline()
+    has_header = first.startswith(b'Rt')
+    newline = '\r\n' if first.endswith(b'\r\n') else '\n'     # keep csv.writer's line ends
+    line = ','.join(['%s'] * len(header)) + newline     # str() of a float is its shortest repr, as csv.writer writes it
+    rows = 0
+    with open(out_path, 'w', encoding='utf8', newline='') as f:
+        if has_header:
+            f.write(','.join(header) + newline)
+        for chunk in pd.read_csv(path, header=0 if has_header else None, names=None if has_header else header,
+                                 dtype={'Rt': str}, chunksize=chunk_rows):
+            chunk = _recalibrate_columns(chunk, header, new, applied, channels)
+            f.write(''.join(map(line.__mod__, zip(*[chunk[c].tolist() for c in chunk.columns]))))
+            rows += len(chunk)
+    return rows
+
+
+def recalibrate(paths, out_dir, new=None, applied=None, column_overrides=None, workers=None):
+    """Recalibrates many logs in a process pool, returns {path: rows}.
+
+    applied is the registry the logs were recorded with (default: the current one), column_overrides maps a log
+    column to the channel whose calibration was actually applied to it, e.g. {'temp_hex_b': 'HeatExF'} for logs
+    from before the HeatExB/Chamber label fix. Headerless rotated csv files inherit the previous file's header."""
+    new = new if new is not None else load_registry()
+    applied = applied if applied is not None else new
+    applied_models = {channel: applied[channel] for channel in set(COLUMN_CHANNELS.values())}
+    new_models = {channel: new[channel] for channel in set(COLUMN_CHANNELS.values())}
+    for column, channel in (column_overrides or {}).items():
+        applied_models[COLUMN_CHANNELS[column]] = applied[channel]
+    os.makedirs(out_dir, exist_ok=True)
+    headers, previous = [], None
+    for path in paths:
+        if is_csv_log(path):
+            with open_log(path) as f:
+                first = f.readline().strip()
+            previous = first.split(',') if first.startswith('Rt') else previous
+        headers.append(previous)
+    # compressed segments are written out as plain csv
+    jobs = [(p, os.path.join(out_dir, split_compression(os.path.basename(p))[0]), h) for p, h in zip(paths, headers)
+            if p.endswith('.bin') or h is not None]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {p: pool.submit(recalibrate_file, p, o, h, new_models, applied_models) for p, o, h in jobs}
+        return {p: future.result() for p, future in futures.items()}
+
+
+def _log_order(path):
+    # rotated logs in time order, so headerless files follow the file whose header they share
+    from binlog import date_from_log_name
+    try:
+        return date_from_log_name(os.path.basename(path)), path
+    except ValueError:
+        return dt.min, path
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if not args or args[0] != 'recalibrate' or '--out' not in args:
+        raise SystemExit('usage: python calibration.py recalibrate --out DIR [--applied-registry OLD.json] '
+                         '[--applied COLUMN=CHANNEL ...] FILE...')
+    args = args[1:]
+    out_dir, applied, overrides, paths = None, None, {}, []
+    while args:
+        arg = args.pop(0)
+        if arg == '--out':
+            out_dir = args.pop(0)
+        elif arg == '--applied-registry':
+            applied = load_registry(args.pop(0))
+        elif arg == '--applied':
+            column, channel = args.pop(0).split('=')
+            overrides[column] = channel
+        else:
+            paths.append(arg)
+    for path, rows in recalibrate(sorted(paths, key=_log_order), out_dir, applied=applied, column_overrides=overrides).items():
+        print('{}: {} rows'.format(path, rows))
@@ -0,0 +1,73 @@
+"""
+Display aware downsampling for the temperature and radon plots.
+
+A 20 inch wide figure is about 2000 pixels across, so plotting more than a few thousand points per line only costs
+render time. minmax keeps the lowest and highest sample of every pixel column, which preserves every spike and dip
+of the raw data. lttb (Largest Triangle Three Buckets) keeps the one point per bucket that best preserves the visual
+shape, which suits smooth curves.
+"""
+import numpy as np
+
+
+def _buckets(n, n_buckets):
+    # bucket boundaries splitting n samples into n_buckets nearly equal parts
+    return np.linspace(0, n, n_buckets + 1).astype('int64')
+
+
+def minmax(x, y, n_buckets):
+    """Indices of the min and max sample of every bucket, in time order (at most 2*n_buckets points)"""
+    y = np.asarray(y)
+    n = len(y)
+    if n <= 2 * n_buckets:
+        return np.arange(n)
+    size = n // n_buckets
+    body = y[:size * n_buckets].reshape(n_buckets, size)
+    offsets = np.arange(n_buckets) * size
+    lo = offsets + np.argmin(body, axis=1)
+    hi = offsets + np.argmax(body, axis=1)
+    idx = np.concatenate([lo, hi, np.arange(size * n_buckets, n)])     # the remainder is short, keep it whole
+    return np.unique(idx)
+
+
+def lttb(x, y, n_out):
+    """Indices of the n_out points chosen by Largest Triangle Three Buckets, first and last always kept"""
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype('int64')     # n_out - 2 buckets between the fixed end points
+    # mean point of every bucket, used as the third corner of the triangle for the bucket before it
+    counts = np.diff(edges)
+    sums_x = np.add.reduceat(x[1:n - 1], edges[:-1] - 1)
+    sums_y = np.add.reduceat(y[1:n - 1], edges[:-1] - 1)
+    mean_x = np.append(sums_x / counts, x[-1])
+    mean_y = np.append(sums_y / counts, y[-1])
+    selected = np.empty(n_out, dtype='int64')
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for b in range(n_out - 2):
+        lo, hi = edges[b], edges[b + 1]
+        area = np.abs((x[a] - mean_x[b + 1]) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (mean_y[b + 1] - y[a]))
+        a = lo + int(np.argmax(area))
+        selected[b + 1] = a
+    return selected
+
+
+def decimate(x, y, width_px=2000, method='minmax'):
+    """Returns (x, y) reduced to what width_px pixel columns can show"""
+    if method == 'minmax':
+        idx = minmax(x, y, width_px)
+    elif method == 'lttb':
+        idx = lttb(x, y, 2 * width_px)
+    else:
+        raise ValueError('unknown decimation method {}'.format(method))
+    return np.asarray(x)[idx], np.asarray(y)[idx]
+
+
+def tick_positions(labels, interval):
+    """Vectorized tick picking, returns the same 2 row array as All_plot.get_tics: positions and labels"""
+    labels = np.asarray(labels)
+    positions = np.arange(0, len(labels), interval)
+    return np.array([positions.astype('str'), labels[positions].astype('str')])
@@ -0,0 +1,264 @@
+"""
+Alarm and interlock rules evaluated against every sample of the control loop.
+
+Until now the only safety action was turning the relays off in the except/finally handlers, and the over temperature
+check of the old calibrated_temps was commented out. An InterlockEngine is built from a list of rules on the loop's
+channels and evaluate() is called once per tick with the newest calibrated readings:
+
+    threshold  {"channel": c, "above": x} or "below": the reading itself
+    rate       {"channel": c, "above": x, "over": n}: change per second over the last n samples (default 1)
+    stale      {"channel": c, "after": s}: seconds since the reading last changed, NaN counts as no reading. A
+               converter that hangs keeps returning its last value, a live sensor always flickers in the last bit
+    delta      {"channel": c, "minus": d, "above": x}: cross channel difference c - d, e.g. tip vs flange
+
+Every rule has a name, an action ("trip", the default, or "alarm" which is only reported) and "for": the number of
+consecutive samples it has to be violated (default 1) before it counts. Rules are compiled into one array of channel
+indices, limits and signs per rule type, so evaluation is a fixed handful of numpy operations whether there are four
+rules or hundreds. A NaN reading violates no threshold, rate or delta rule, that is what the stale rules are for.
+
+A trip is latched: from the tick that trips, every evaluate() calls the safe_state callable (outputs_off(HeaterF,
+HeaterB) turns the given outputs off, in that order) and `tripped` stays True until reset() is called with no trip
+rule still active, or the process is restarted. The loops also leave their outputs off while tripped, so a PID
+output cannot switch a heater back on between two evaluations. Rule changes are kept as events (EventLog also prints
+them and appends them to a file), and the time of every evaluation goes to an instrumentation Stage ('interlocks'),
+reported by status() next to the active rules.
+
+Rule sets live in interlocks.json, one per stand:
+
+    python interlock.py [cryoprobe]     # checks a rule set and times it with a few hundred generated rules
+"""
+import json
+import os
+import sys
+import time
+from collections import deque
+from datetime import datetime as dt
+import numpy as np
+from instrumentation import Stage
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'interlocks.json')
+TYPES = ['threshold', 'rate', 'stale', 'delta']
+
+
+def load_rules(name, path=DEFAULT_PATH):
+    """The rule set `name` of interlocks.json"""
+    with open(path, encoding='utf8') as f:
+        sets = json.load(f)
+    if name not in sets:
+        raise KeyError('no interlock rule set {!r} in {}, there are {}'.format(name, path, ', '.join(sets)))
+    return sets[name]['rules']
+
+
+def rename_channels(rules, channels):
+    """Copies of the rules with their channel names mapped through {name in the rules: name to use}"""
+    renamed = []
+    for rule in rules:
+        rule = dict(rule)
+        for key in ('channel', 'minus'):
+            if key in rule:
+                rule[key] = channels.get(rule[key], rule[key])
+        renamed.append(rule)
+    return renamed
+
+
+def generated_rules(channels, count):
+    """`count` alarm rules of every type spread over the channels, for timing the engine"""
+    rules = []
+    for k in range(count):
+        kind = TYPES[k % len(TYPES)]
+        rule = {'name': 'rule {}'.format(k), 'type': kind, 'channel': channels[k % len(channels)], 'action': 'alarm', 'for': 3}
+        if kind == 'stale':
+            rule['after'] = 10.0
+        else:
+            rule['above'] = {'threshold': 50.0, 'rate': 5.0, 'delta': 30.0}[kind]
+        if kind == 'rate':
+            rule['over'] = 1 + k % 8
+        if kind == 'delta':
+            rule['minus'] = channels[(k + 1) % len(channels)]
+        rules.append(rule)
+    return rules
+
+
+def outputs_off(*outputs):
+    """Safe state callable that turns the given outputs (anything with a .value) off, always in the same order"""
+    def safe_state():
+        for output in outputs:
+            output.value = False
+    return safe_state
+
+
+class EventLog:
+    """on_event callable that prints every rule change and appends it to a text file"""
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def __call__(self, event):
+        line = '{} {:<6} {:<5} {} (value {:.3f}, limit {:g}){}'.format(
+            dt.fromtimestamp(event['time']).strftime('%Y-%m-%d %H:%M:%S'), event['state'], event['action'],
+            event['rule'], event['value'], event['limit'], ' TRIPPED' if event.get('tripped') else '')
+        print(line)
+        with open(self.path, 'a', encoding='utf8') as f:     # rare, opened per event so nothing is lost on a crash
+            f.write(line + '\n')
+
+
+class InterlockEngine:
+    """Vectorized evaluation of alarm and interlock rules on one vector of channels"""
+
+    def __init__(self, channels, rules, safe_state=None, instruments=None, on_event=None, max_events=1000):
+        self.channels = list(channels)
+        self.index = {name: k for k, name in enumerate(self.channels)}
+        self.safe_state = safe_state
+        self.on_event = on_event
+        self.timing = instruments.stage('interlocks') if instruments is not None else Stage('interlocks')
+        self.events = deque(maxlen=max_events)
+        self.rules = []
+        groups = {kind: [] for kind in TYPES}
+        for rule in rules:
+            kind = rule.get('type', 'threshold')
+            if kind not in groups:
+                raise ValueError('rule {!r} has unknown type {!r}, use one of {}'.format(rule.get('name'), kind, ', '.join(TYPES)))
+            groups[kind].append(self._check(rule, kind))
+        for kind in TYPES:     # rules are kept grouped by type, every group is one slice of the arrays below
+            self.rules += groups[kind]
+        self._compile(groups)
+        n = len(self.rules)
+        self.count = np.zeros(n, dtype='int64')     # consecutive violations
+        self.active = np.zeros(n, dtype=bool)
+        self.values = np.full(n, np.nan)     # what every rule compared with its limit at the last evaluation
+        self.tripped = False
+        self.cause = []
+        self.evaluations = 0
+
+    def _check(self, rule, kind):
+        rule = dict(rule, type=kind)
+        rule.setdefault('name', '{} {}'.format(kind, rule.get('channel')))
+        for key in ['channel'] + (['minus'] if kind == 'delta' else []):
+            if rule.get(key) not in self.index:
+                raise ValueError('rule {!r}: unknown channel {!r}, the channels are {}'.format(rule['name'], rule.get(key), self.channels))
+        if kind == 'stale':
+            rule['above'] = rule['after']
+        if ('above' in rule) == ('below' in rule):
+            raise ValueError('rule {!r} needs one of above or below'.format(rule['name']))
+        if rule.setdefault('action', 'trip') not in ('trip', 'alarm'):
+            raise ValueError('rule {!r}: action must be trip or alarm'.format(rule['name']))
+        return rule
+
+    def _compile(self, groups):
+        rules = self.rules
+        self.limit = np.array([r['above'] if 'above' in r else r['below'] for r in rules], dtype='float64')
+        self.sign = np.array([1.0 if 'above' in r else -1.0 for r in rules])
+        self.need = np.array([max(int(r.get('for', 1)), 1) for r in rules], dtype='int64')
+        self.trips = np.array([r['action'] == 'trip' for r in rules], dtype=bool)
+        start = 0
+        self.slices = {}
+        for kind in TYPES:
+            self.slices[kind] = slice(start, start + len(groups[kind]))
+            start += len(groups[kind])
+        channel = lambda kind, key='channel': np.array([self.index[r[key]] for r in groups[kind]], dtype='int64')
+        self.threshold_channel = channel('threshold')
+        self.rate_channel = channel('rate')
+        self.stale_channel = channel('stale')
+        self.delta_channel, self.delta_minus = channel('delta'), channel('delta', 'minus')
+        lags = np.array([max(int(r.get('over', 1)), 1) for r in groups['rate']], dtype='int64')
+        self.rate_lag = lags
+        # readings of the last max(over) ticks for the rate rules, times start at -inf so early rates come out 0
+        self.history = np.zeros((int(lags.max()) + 1 if len(lags) else 1, len(self.channels)))
+        self.history_time = np.full(len(self.history), -np.inf)
+        self.last = np.full(len(self.channels), np.nan)
+        self.fresh_time = np.full(len(self.channels), np.nan)     # when each reading last changed
+
+    def evaluate(self, time_stamp, values):
+        """Checks every rule against one sample, returns True while tripped. time_stamp in seconds, values in the
+        order of self.channels"""
+        start = time.perf_counter_ns()
+        x = np.asarray(values, dtype='float64')
+        v = self.values
+        slices = self.slices
+        v[slices['threshold']] = x[self.threshold_channel]
+        if len(self.rate_channel):
+            k = self.evaluations % len(self.history)
+            self.history[k] = x
+            self.history_time[k] = time_stamp
+            before = (k - self.rate_lag) % len(self.history)
+            v[slices['rate']] = (x[self.rate_channel] - self.history[before, self.rate_channel]) / (time_stamp - self.history_time[before])
+        if len(self.stale_channel):
+            fresh = (x != self.last) & (x == x)
+            self.fresh_time[fresh] = time_stamp
+            self.fresh_time[np.isnan(self.fresh_time)] = time_stamp     # the first tick starts the clock, a channel
+            # that stays NaN from there on goes stale like a frozen one
+            self.last = x
+            v[slices['stale']] = time_stamp - self.fresh_time[self.stale_channel]
+        if len(self.delta_channel):
+            v[slices['delta']] = x[self.delta_channel] - x[self.delta_minus]
+        violated = (v - self.limit) * self.sign > 0
+        self.count += 1
+        self.count *= violated
+        active = self.count >= self.need
+        changed = active != self.active
+        self.active = active
+        self.evaluations += 1
+        if changed.any():
+            self._changes(time_stamp, np.flatnonzero(changed))
+        if self.tripped and self.safe_state is not None:
+            self.safe_state()
+        self.timing.lap(start)
+        return self.tripped
+
+    def _changes(self, time_stamp, rows):
+        for k in rows:
+            rule = self.rules[k]
+            event = {'time': time_stamp, 'rule': rule['name'], 'action': rule['action'],
+                     'state': 'active' if self.active[k] else 'clear', 'value': float(self.values[k]),
+                     'limit': float(self.limit[k])}
+            self.events.append(event)
+            if self.active[k] and self.trips[k]:
+                if not self.tripped:
+                    self.tripped = True
+                    event['tripped'] = True
+                if rule['name'] not in self.cause:
+                    self.cause.append(rule['name'])
+            if self.on_event is not None:
+                self.on_event(event)
+
+    def reset(self):
+        """Clears the trip latch unless a trip rule is still active, returns whether it was cleared"""
+        if (self.active & self.trips).any():
+            return False
+        self.tripped = False
+        self.cause = []
+        return True
+
+    def active_rules(self):
+        return [self.rules[k]['name'] for k in np.flatnonzero(self.active)]
+
+    def status(self):
+        """Json ready state: trip latch and cause, active rules, recent events and evaluation time"""
+        return {'tripped': self.tripped, 'cause': list(self.cause), 'active': self.active_rules(),
+                'rules': len(self.rules), 'evaluations': self.evaluations, 'events': list(self.events)[-20:],
+                'evaluation': self.timing.summary()}
+
+
+if __name__ == '__main__':
+    name = sys.argv[1] if len(sys.argv) > 1 else 'temperature_control'
+    rules = load_rules(name)
+    channels = sorted({r['channel'] for r in rules} | {r['minus'] for r in rules if 'minus' in r})
+    print('{}: {} rules on {}'.format(name, len(rules), ', '.join(channels)))
+    engine = InterlockEngine(channels, rules, on_event=print)
+    for tick in range(4):
+        engine.evaluate(tick * 0.25, [-100.0 + tick * 0.01] * len(channels))
+    for tick in range(4, 6):     # everything too hot for two samples
+        engine.evaluate(tick * 0.25, [80.0] * len(channels))
+    print('tripped:', engine.tripped, engine.cause)
+
+    # a few hundred generated rules of every type on 16 channels
+    channels = ['ch{}'.format(k) for k in range(16)]
+    engine = InterlockEngine(channels, generated_rules(channels, 400))
+    readings = np.random.default_rng(0).normal(-100, 1, size=(20000, 16))
+    for tick, row in enumerate(readings):
+        engine.evaluate(tick * 0.25, row)
+    summary = engine.status()['evaluation']
+    print('{} rules: mean {:.1f} us, p99 {:.1f} us per evaluation'.format(len(engine.rules), summary['mean_us'], summary['p99_us']))
@@ -0,0 +1,65 @@
+"""
+Fixed capacity sample ledger used by the temperature control loops.
+
+Replaces the string typed np.append/np.delete Ledger. Timestamps are kept as float64 epoch seconds
+and every channel as float32 so averages never need an .astype() and no array is reallocated per tick.
+"""
+import numpy as np
+
+
+class SampleLedger:
+    """Ring buffer holding the last `capacity` samples of every channel.
+
+    Each sample is written twice (at i and i+capacity) so the newest n samples are always one
+    contiguous slice, which lets window() hand out views instead of copies.
+    """
+
+    def __init__(self, channels, capacity, dtype='float32'):
+        self.channels = list(channels)
+        self.capacity = int(capacity)
+        self.index = {name: k for k, name in enumerate(self.channels)}
+        self._times = np.zeros(2 * self.capacity, dtype='float64')
+        self._data = np.zeros((len(self.channels), 2 * self.capacity), dtype=dtype)
+        self.count = 0     # total number of samples ever appended
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, time_stamp, values):
+        """Stores one sample, values must be in the same order as self.channels"""
+        i = self.count % self.capacity
+        j = i + self.capacity
+        self._times[i] = self._times[j] = time_stamp
+        self._data[:, i] = values
+        self._data[:, j] = self._data[:, i]
+        self.count += 1
+
+    def _end(self):
+        # one past the newest sample inside the mirrored buffer
+        return (self.count - 1) % self.capacity + self.capacity + 1
+
+    def window(self, n=None):
+        """Returns (times, data) views of the newest n samples, oldest first. data has shape (channels, n)"""
+        n = len(self) if n is None else min(int(n), len(self))
+        if n == 0:
+            return self._times[:0], self._data[:, :0]
+        end = self._end()
+        return self._times[end - n:end], self._data[:, end - n:end]
+
+    def channel(self, name, n=None):
+        """View of the newest n samples of a single channel"""
+        return self.window(n)[1][self.index[name]]
+
+    def latest(self):
+        """Returns (time, values) of the newest sample"""
+        if self.count == 0:
+            raise IndexError('ledger is empty')
+        times, data = self.window(1)
+        return times[0], data[:, 0]
+
+    def average(self, n):
+        """Per channel mean of the newest n samples"""
+        return self.window(n)[1].mean(axis=1)
+
+    def clear(self):
+        self.count = 0
@@ -0,0 +1,113 @@
+"""
+Blitted live temperature plot fed from a ring buffer.
+
+The acquisition thread only calls LivePlot.push(), which stores the sample in a preallocated SampleLedger and
+returns. The GUI thread calls run(), which renders on its own cadence: the x axis is numeric seconds relative to the
+newest sample, so the axes, ticks and labels stay fixed and every frame only restores the cached background,
+updates the line data and blits the axes. A full redraw happens only when the data leaves the y limits, the window
+is resized or the background has not been captured yet. A slow GUI frame therefore never delays the control loop.
+"""
+import threading
+import time
+import numpy as np
+import matplotlib.pyplot as plt
+from ledger import SampleLedger
+
+
+class LivePlot:
+    """Rolling plot of the newest `capacity` samples of a few channels"""
+
+    def __init__(self, channels, labels=None, capacity=1000, span=500.0, margin=2.0,
+                 ylabel='Temperature (Celsius)'):
+        self.ledger = SampleLedger(channels, capacity, dtype='float64')
+        self.lock = threading.Lock()
+        self.span = span     # seconds shown on the x axis
+        self.margin = margin     # degrees added around the data when the y limits have to move
+        self.fig, self.ax = plt.subplots()
+        self.lines = [self.ax.plot([], [], label=label, animated=True)[0] for label in (labels or channels)]
+        self.ax.set_xlim(-span, 0)
+        self.ax.set_ylim(0, 1)
+        self.ax.legend()
+        self.ax.set_xlabel('Time (s before now)')
+        self.ax.set_ylabel(ylabel)
+        self.background = None
+        self.frames = 0
+        self.full_draws = 0
+        self.fig.canvas.mpl_connect('draw_event', self._on_draw)
+
+    def push(self, time_stamp, values):
+        """Stores one sample, safe to call from the acquisition thread"""
+        with self.lock:
+            self.ledger.append(time_stamp, values)
+
+    def _on_draw(self, event):
+        # a full draw happened (first show, resize, new limits), cache everything but the lines
+        self.background = self.fig.canvas.copy_from_bbox(self.ax.bbox)
+        self.full_draws += 1
+        self._draw_lines()
+
+    def _draw_lines(self):
+        for line in self.lines:
+            self.ax.draw_artist(line)
+
+    def _needs_rescale(self, data):
+        lo, hi = np.nanmin(data), np.nanmax(data)
+        if not np.isfinite(lo) or not np.isfinite(hi):
+            return False
+        bottom, top = self.ax.get_ylim()
+        too_small = lo < bottom or hi > top
+        too_large = (hi - lo + 2 * self.margin) < 0.25 * (top - bottom)     # data shrank to a sliver, zoom back in
+        if too_small or too_large:
+            self.ax.set_ylim(lo - self.margin, hi + self.margin)
+            return True
+        return False
+
+    def render(self):
+        """Draws one frame from the newest samples, call from the GUI thread"""
+        with self.lock:
+            times, data = self.ledger.window()
+            times, data = times.copy(), data.copy()
+        if len(times) == 0:
+            return
+        x = times - times[-1]
+        for line, row in zip(self.lines, data):
+            line.set_data(x, row)
+        canvas = self.fig.canvas
+        if self._needs_rescale(data) or self.background is None or not canvas.supports_blit:
+            canvas.draw()     # recaptures the background through _on_draw
+        else:
+            canvas.restore_region(self.background)
+            self._draw_lines()
+            canvas.blit(self.ax.bbox)
+        canvas.flush_events()
+        self.frames += 1
+
+    def run(self, interval=0.5, stop=None):
+        """Renders every `interval` seconds until the window is closed or `stop` (a threading.Event) is set"""
+        plt.show(block=False)
+        while plt.fignum_exists(self.fig.number) and not (stop is not None and stop.is_set()):
+            start = time.monotonic()
+            self.render()
+            remaining = interval - (time.monotonic() - start)
+            if remaining > 0:
+                self.fig.canvas.start_event_loop(remaining)     # keeps the window responsive while waiting
+
+
+if __name__ == '__main__':
+    # synthetic stream at 20 Hz, rendered at 10 Hz
+    plot = LivePlot(['temp_ch', 'temp_hex'], ['Cold Head', 'Heat Exchanger'], capacity=2000, span=100)
+    stop = threading.Event()
+
+    def acquire():
+        start = time.time()
+        while not stop.is_set():
+            now = time.time() - start
+            plot.push(time.time(), [20 - now * 0.5 + np.random.normal(0, 0.2), 25 + 3 * np.sin(now / 5)])
+            time.sleep(0.05)
+
+    threading.Thread(target=acquire, daemon=True).start()
+    try:
+        plot.run(0.1)
+    finally:
+        stop.set()
+    print('{} frames, {} full redraws'.format(plot.frames, plot.full_draws))
@@ -0,0 +1,218 @@
+"""
+Time range catalog of the rotated csv temperature logs.
+
+For every log file the catalog records its absolute start and end time, row count, column schema, the file it was
+rotated from / into and a sparse index of (epoch time, byte offset) every `stride` rows. The catalog is kept in
+Logs/.cache/catalog.json and refresh() only scans what is new: unseen files, and the tail of a file that has grown
+since the last scan. query() then opens only the files overlapping the requested interval, seeks to the indexed
+byte range around it and parses only the requested columns. Compressed segments (log_rotation) are indexed on their
+decompressed bytes, seeking in them decompresses up to the offset, so they cost more to query than plain ones.
+
+    catalog = LogCatalog(ROOT_DIR + '/Logs/')
+    catalog.refresh()
+    times, data = catalog.query('2022-09-27 14:00', '2022-09-28 02:00', ['temp_ch'])
+"""
+import io
+import json
+import os
+from datetime import datetime as dt
+import numpy as np
+import pandas as pd
+from binlog import date_from_log_name
+from log_ingest import CACHE_DIR
+from log_rotation import open_log, is_csv_log
+
+CATALOG_NAME = 'catalog.json'
+DAY = 86400.0
+
+
+def _to_epoch(when):
+    if isinstance(when, str):
+        when = dt.fromisoformat(when)
+    if isinstance(when, dt):
+        return when.timestamp()
+    return float(when)
+
+
+def _clock_seconds(stamp):
+    # seconds since midnight of an 'HH:MM:SS' or 'YYYY-mm-dd HH:MM:SS' stamp, and the date part if there is one
+    date, _, clock = stamp.strip().rpartition(' ')
+    h, m, s = clock.split(':')
+    return int(h) * 3600 + int(m) * 60 + float(s), date
+
+
+class LogCatalog:
+    """Incrementally maintained index of the log files in one directory"""
+
+    def __init__(self, directory, stride=512, gap=120.0):
+        self.directory = directory
+        self.stride = stride
+        self.gap = gap     # seconds between two files above which they are not considered one rotation chain
+        self.path = os.path.join(directory, CACHE_DIR, CATALOG_NAME)
+        self.files = {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf8') as f:
+                saved = json.load(f)
+            if saved.get('stride') == stride:
+                self.files = saved['files']
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf8') as f:
+            json.dump({'stride': self.stride, 'files': self.files}, f)
+        os.replace(tmp, self.path)
+
+    def refresh(self):
+        """Scans new and grown log files, drops removed ones and rebuilds the rotation chain"""
+        names = [name for name in os.listdir(self.directory) if name.startswith('Temp log') and is_csv_log(name)]
+        for name in list(self.files):
+            if name not in names:
+                del self.files[name]
+        for name in names:
+            stat = os.stat(os.path.join(self.directory, name))
+            entry = self.files.get(name)
+            if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+                continue
+            if entry is None or stat.st_size < entry['scanned_bytes']:
+                entry = self._new_entry(name)
+            self._scan(name, entry)
+            entry['size'] = stat.st_size
+            entry['mtime_ns'] = stat.st_mtime_ns
+            self.files[name] = entry
+        self._link()
+        self.save()
+        return self
+
+    def _new_entry(self, name):
+        start = date_from_log_name(name)
+        return {'columns': None, 'has_header': False, 'rows': 0, 'scanned_bytes': 0, 'start': None, 'end': None,
+                'day': start.replace(hour=0, minute=0, second=0).timestamp(), 'last_clock': None, 'index': [],
+                'previous': None, 'next': None, 'size': 0, 'mtime_ns': 0}
+
+    def _scan(self, name, entry):
+        # reads only the bytes after the last complete line seen so far
+        with open_log(os.path.join(self.directory, name), 'rb') as f:
+            f.seek(entry['scanned_bytes'])
+            offset = entry['scanned_bytes']
+            for line in f:
+                if not line.endswith(b'\n'):     # row still being written
+                    break
+                text = line.decode('utf8').strip()
+                if offset == 0 and text.startswith('Rt'):
+                    entry['columns'] = text.split(',')
+                    entry['has_header'] = True
+                    offset += len(line)
+                    continue
+                if text:
+                    when = self._row_time(entry, text.split(',', 1)[0])
+                    if entry['rows'] % self.stride == 0:
+                        entry['index'].append([when, offset])
+                    if entry['start'] is None:
+                        entry['start'] = when
+                        if entry['columns'] is None:
+                            entry['ncols'] = text.count(',') + 1
+                    entry['end'] = when
+                    entry['rows'] += 1
+                offset += len(line)
+            entry['scanned_bytes'] = offset
+
+    @staticmethod
+    def _row_time(entry, stamp):
+        seconds, date = _clock_seconds(stamp)
+        if date:
+            return dt.fromisoformat(date).timestamp() + seconds
+        if entry['last_clock'] is not None and seconds < entry['last_clock']:     # wrapped past midnight
+            entry['day'] += DAY
+        entry['last_clock'] = seconds
+        return entry['day'] + seconds
+
+    def _link(self):
+        ordered = sorted((e for e in self.files.values() if e['start'] is not None), key=lambda e: e['start'])
+        names = {id(e): n for n, e in self.files.items()}
+        previous = None
+        for entry in ordered:
+            entry['previous'] = entry['next'] = None
+            if entry['columns'] is None and previous is not None:     # headerless files reuse the previous header
+                entry['columns'] = previous['columns']
+            if previous is not None and entry['start'] - previous['end'] <= self.gap:
+                entry['previous'] = names[id(previous)]
+                previous['next'] = names[id(entry)]
+            previous = entry
+
+    def overlapping(self, start, end):
+        """Names of the files holding data between start and end, in time order"""
+        start, end = _to_epoch(start), _to_epoch(end)
+        hits = [(e['start'], n) for n, e in self.files.items()
+                if e['start'] is not None and e['start'] <= end and e['end'] >= start]
+        return [n for _, n in sorted(hits)]
+
+    def chain(self, name):
+        """The rotation chain a file belongs to, oldest first"""
+        while self.files[name]['previous'] is not None:
+            name = self.files[name]['previous']
+        chain = [name]
+        while self.files[name]['next'] is not None:
+            name = self.files[name]['next']
+            chain.append(name)
+        return chain
+
+    def _byte_range(self, entry, start, end):
+        times = [t for t, _ in entry['index']]
+        offsets = [o for _, o in entry['index']]
+        first = max(np.searchsorted(times, start, side='right') - 1, 0)
+        last = np.searchsorted(times, end, side='right')
+        stop = offsets[last] if last < len(offsets) else entry['scanned_bytes']
+        return offsets[first], stop, times[first]
+
+    def query(self, start, end, columns=None):
+        """Returns (epoch times, {column: values}) for every row between start and end.
+        start and end are datetimes, ISO strings or epoch seconds. Every column has one value per time, NaN in rows
+        of files that do not have that column."""
+        start, end = _to_epoch(start), _to_epoch(end)
+        # a headerless file with no earlier file in its chain has no known columns, its rows cannot be parsed
+        names = [name for name in self.overlapping(start, end) if self.files[name]['columns'] is not None]
+        if columns is None:     # every column of any file in the interval, in order of appearance
+            columns = []
+            for name in names:
+                columns += [c for c in self.files[name]['columns'][1:] if c not in columns]
+        times, data = [], {c: [] for c in columns}
+        for name in names:
+            entry = self.files[name]
+            header = entry['columns']
+            wanted = [c for c in columns if c in header]
+            lo, hi, reference = self._byte_range(entry, start, end)
+            if hi <= lo:
+                continue
+            with open_log(os.path.join(self.directory, name), 'rb') as f:
+                f.seek(lo)
+                chunk = f.read(hi - lo)
+            usecols = [0] + [header.index(c) for c in wanted]
+            frame = pd.read_csv(io.BytesIO(chunk), header=None, usecols=usecols, names=header)
+            row_times = self._chunk_times(frame['Rt'].astype(str).to_numpy(), reference)
+            keep = (row_times >= start) & (row_times <= end)
+            times.append(row_times[keep])
+            for c in columns:     # columns this file does not have (e.g. temp_hex before the f/b split) are NaN
+                if c in header:
+                    data[c].append(frame[c].to_numpy(dtype='float32')[keep])
+                else:
+                    data[c].append(np.full(int(keep.sum()), np.nan, dtype='float32'))
+        if not times:
+            return np.array([]), {c: np.array([], dtype='float32') for c in columns}
+        return np.concatenate(times), {c: np.concatenate(v) for c, v in data.items()}
+
+    @staticmethod
+    def _chunk_times(stamps, reference):
+        # absolute times of a run of rows whose first row is at the epoch time `reference`
+        state = {'day': reference - _clock_seconds(stamps[0])[0], 'last_clock': None}
+        return np.array([LogCatalog._row_time(state, s) for s in stamps])
+
+
+if __name__ == '__main__':
+    ROOT_DIR = os.path.realpath(os.path.join(os.path.dirname("log_catalog.py")))
+    catalog = LogCatalog(ROOT_DIR + '/Logs/').refresh()
+    for name in sorted(catalog.files, key=lambda n: catalog.files[n]['start'] or 0):
+        entry = catalog.files[name]
+        if entry['start'] is not None:
+            print('{}  {} -> {}  {:>7} rows  prev: {}'.format(name, dt.fromtimestamp(entry['start']), dt.fromtimestamp(entry['end']),
+                                                             entry['rows'], entry['previous']))
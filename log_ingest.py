@@ -0,0 +1,119 @@
+"""
+Parallel, cached ingestion of the csv temperature logs for All_plot.py.
+
+Every log is parsed once with a single pd.read_csv call, in a process pool when several files need parsing, and the
+parsed columns are kept in a .npz sidecar under Logs/.cache keyed on the file's path, size and mtime. Re-plotting
+weeks of logs then only parses the files that changed since the last run (usually just the one still being written).
+Both log schemas are handled in the same pass: the older single heat exchanger column 'temp_hex' and the newer
+'temp_hex_f'/'temp_hex_b' pair. Segments compressed by log_rotation ('.csv.gz', '.csv.zst') are read like plain ones.
+"""
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from log_rotation import open_log, is_csv_log, log_sort_key
+
+CACHE_DIR = '.cache'
+TEMP_COLUMNS = ['temp_ch', 'temp_hex_f', 'temp_hex_b', 'temp_chamber']     # rows of temp_data_read_csv's output
+
+
+def _has_header(path):
+    with open_log(path) as f:
+        return f.readline().startswith('Rt')
+
+
+def parse_log(path):
+    """Parses one csv log into {'header': [...] or None, 'columns': [arrays in file order]}.
+    'Rt' (always the first column) is returned as strings with any date part removed."""
+    header = _has_header(path)
+    with open_log(path) as f:
+        data = pd.read_csv(f, header=0 if header else None)
+    columns = [data.iloc[:, 0].astype(str).str.rsplit(' ', n=1).str[-1].to_numpy(dtype='str')]
+    columns += [data.iloc[:, k].to_numpy(dtype='float32') for k in range(1, data.shape[1])]
+    return {'header': list(data.columns) if header else None, 'columns': columns}
+
+
+def _cache_path(path):
+    directory, name = os.path.split(os.path.realpath(path))
+    return os.path.join(directory, CACHE_DIR, name + '.npz')
+
+
+def _key(path):
+    stat = os.stat(path)
+    return {'path': os.path.realpath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def load_cached(path):
+    """Returns the parsed log from its sidecar if the sidecar matches the file's path, size and mtime"""
+    try:
+        with np.load(_cache_path(path)) as cached:
+            meta = json.loads(str(cached['meta']))
+            if meta['key'] != _key(path):
+                return None
+            return {'header': meta['header'], 'columns': [cached['c{}'.format(k)] for k in range(meta['ncols'])]}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def store_cached(path, parsed, key):
+    cache = _cache_path(path)
+    os.makedirs(os.path.dirname(cache), exist_ok=True)
+    meta = json.dumps({'key': key, 'header': parsed['header'], 'ncols': len(parsed['columns'])})
+    arrays = {'c{}'.format(k): column for k, column in enumerate(parsed['columns'])}
+    tmp = cache + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, meta=np.array(meta), **arrays)
+    os.replace(tmp, cache)     # readers never see a half written sidecar
+
+
+def _parse_and_cache(path, cache=True):
+    key = _key(path)
+    parsed = parse_log(path)
+    if cache:
+        store_cached(path, parsed, key)
+    return parsed
+
+
+def read_logs(directory, file_names, workers=None, cache=True):
+    """Parses the given log files in time order (log_rotation.log_sort_key, so '_10' rotations follow '_2'), reusing
+    sidecars where they are current.
+    Empty and non csv files are skipped, compressed csv segments are decompressed as they are parsed. A file written without a header inherits the previous file's header."""
+    paths = [os.path.join(directory, name) for name in sorted(file_names, key=log_sort_key)
+             if is_csv_log(name) and os.stat(os.path.join(directory, name)).st_size > 0]
+    parsed = [load_cached(path) if cache else None for path in paths]
+    missing = [i for i, p in enumerate(parsed) if p is None]
+    if len(missing) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for i, result in zip(missing, pool.map(_parse_and_cache, [paths[i] for i in missing], [cache] * len(missing))):
+                parsed[i] = result
+    else:
+        for i in missing:
+            parsed[i] = _parse_and_cache(paths[i], cache)
+    previous = None
+    for p in parsed:
+        if p['header'] is None:
+            p['header'] = previous
+        previous = p['header']
+    return [p for p in parsed if p['header'] is not None]     # like All_plot, a headerless first file cannot be read
+
+
+def temp_arrays(parsed):
+    """Stacks parsed logs into the (output, time_out) pair returned by All_plot.temp_data_read_csv.
+    Logs with a single 'temp_hex' column are placed in the back heat exchanger row with zeros for the front."""
+    rows = [[] for _ in TEMP_COLUMNS]
+    times = []
+    for p in parsed:
+        columns = dict(zip(p['header'], p['columns']))
+        n = len(p['columns'][0])
+        if 'temp_hex_b' not in columns:
+            columns['temp_hex_f'] = np.zeros(n, dtype='float32')
+            columns['temp_hex_b'] = columns['temp_hex']
+        for row, name in zip(rows, TEMP_COLUMNS):
+            row.append(columns[name])
+        times.append(p['columns'][0])
+    if not times:
+        return np.zeros((len(TEMP_COLUMNS) + 1, 0)), np.array([], dtype='str')
+    output = np.array([np.concatenate(row) for row in rows])
+    output = np.vstack([output, np.arange(output.shape[1])])     # add an index, used for the x values of plots
+    return output, np.concatenate(times)
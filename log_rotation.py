@@ -0,0 +1,162 @@
+"""
+Rotation naming, background compression and transparent reading of the csv log segments.
+
+BackgroundLogWriter already counts the bytes it writes, so rotating needs no os.stat per tick. What this module
+adds:
+
+    unique_name       log names have minute resolution, a second rotation within the same minute gets '_2', '_3'
+                      ... appended instead of truncating the first one ('Temp log 10-17-2026, 22-26_2.csv')
+    SegmentCompressor a daemon thread at the lowest CPU priority that gzips (or, with the zstandard package, zstd
+                      compresses) closed segments into 'name.csv.gz' / 'name.csv.zst', streaming in 1 MB chunks,
+                      and removes the original once the compressed copy is complete
+    open_log          opens a plain or compressed segment by its suffix, compressed ones are decompressed as they
+                      are read. log_ingest, log_catalog and radon_data read through it, so All_plot reads compressed
+                      history without any change on the caller's side
+
+The csv logs compress about 4-5x with gzip, closed segments of earlier runs can be compressed in place with
+
+    python log_rotation.py compress Logs [--method zstd] [--keep 1]
+"""
+import gzip
+import io
+import os
+import queue
+import re
+import shutil
+import sys
+import threading
+from datetime import datetime as dt
+
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+CHUNK = 1 << 20
+_SEQUENCE = re.compile(r'_(\d+)$')
+
+
+def _zstd():
+    try:
+        import zstandard     # optional, pip install zstandard
+    except ImportError:
+        raise ImportError('zstd compression needs the zstandard package, use gzip or pip install zstandard')
+    return zstandard
+
+
+def split_compression(name):
+    """(name without a compression suffix, method or None)"""
+    for method, suffix in SUFFIXES.items():
+        if name.endswith(suffix):
+            return name[:-len(suffix)], method
+    return name, None
+
+
+def is_csv_log(name):
+    """True for 'x.csv', 'x.csv.gz' and 'x.csv.zst'"""
+    return split_compression(name)[0].endswith('.csv')
+
+
+def log_sort_key(name):
+    """Orders log names by their start minute, then by rotation within the minute. Names without a date go first"""
+    stem = os.path.splitext(split_compression(os.path.basename(name))[0])[0]
+    match = _SEQUENCE.search(stem)
+    sequence = int(match.group(1)) if match else 1
+    if match:
+        stem = stem[:match.start()]
+    try:
+        start = dt.strptime(stem.replace('Temp log ', ''), '%m-%d-%Y, %H-%M')
+    except ValueError:
+        start = dt.min
+    return start, sequence, name
+
+
+def unique_name(directory, name):
+    """`name`, or with '_2', '_3', ... before the extension if it, or a compressed copy of it, already exists"""
+    stem, extension = os.path.splitext(name)
+    candidate, k = name, 1
+    while any(os.path.exists(os.path.join(directory, candidate + suffix)) for suffix in ('',) + tuple(SUFFIXES.values())):
+        k += 1
+        candidate = '{}_{}{}'.format(stem, k, extension)
+    return candidate
+
+
+def open_log(path, mode='rt'):
+    """Opens a plain, .gz or .zst log for reading ('rt' with utf8, or 'rb'), decompressing as it is read"""
+    method = split_compression(path)[1]
+    if method is None:
+        return open(path, mode, encoding='utf8') if 't' in mode else open(path, mode)
+    if method == 'gzip':
+        return gzip.open(path, mode, encoding='utf8') if 't' in mode else gzip.open(path, mode)
+    stream = _zstd().ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return io.TextIOWrapper(io.BufferedReader(stream), encoding='utf8') if 't' in mode else io.BufferedReader(stream)
+
+
+def compress_file(path, method='gzip', level=None):
+    """Compresses `path` into path + suffix and removes it, returns the new path. The mtime is kept"""
+    target = path + SUFFIXES[method]
+    tmp = target + '.tmp'
+    with open(path, 'rb') as source:
+        if method == 'gzip':
+            with gzip.open(tmp, 'wb', compresslevel=6 if level is None else level) as out:
+                shutil.copyfileobj(source, out, CHUNK)
+        else:
+            with open(tmp, 'wb') as out:
+                _zstd().ZstdCompressor(level=3 if level is None else level).copy_stream(source, out, read_size=CHUNK)
+    stat = os.stat(path)
+    os.utime(tmp, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(tmp, target)     # a reader sees either the plain file or the complete compressed one
+    os.remove(path)
+    return target
+
+
+class SegmentCompressor:
+    """Compresses closed log segments on a low priority daemon thread"""
+
+    def __init__(self, method='gzip', level=None, nice=19):
+        if method not in SUFFIXES:
+            raise ValueError('unknown compression {!r}, use one of {}'.format(method, ', '.join(SUFFIXES)))
+        if method == 'zstd':
+            _zstd()     # fail now rather than on the first rotation
+        self.method = method
+        self.level = level
+        self.nice = nice
+        self.queue = queue.Queue()
+        self.compressed = []
+        self.errors = []
+        self._thread = threading.Thread(target=self._run, name='log compressor', daemon=True)
+        self._thread.start()
+
+    def submit(self, path):
+        self.queue.put(path)
+
+    def _run(self):
+        try:     # on Linux the priority of a thread id only applies to that thread
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.nice)
+        except (AttributeError, OSError):
+            pass
+        while True:
+            path = self.queue.get()
+            if path is None:
+                return
+            try:
+                self.compressed.append(compress_file(path, self.method, self.level))
+            except OSError as error:     # the plain file is left as it is
+                self.errors.append((path, repr(error)))
+
+    def close(self, timeout=None):
+        """Compresses what is still queued and stops the thread"""
+        self.queue.put(None)
+        self._thread.join(timeout)
+
+
+def compress_logs(directory, method='gzip', keep=1, level=None):
+    """Compresses the plain csv logs of a directory except the `keep` newest, which may still be written"""
+    names = sorted((n for n in os.listdir(directory) if n.endswith('.csv')), key=log_sort_key)
+    return [compress_file(os.path.join(directory, n), method, level) for n in names[:max(len(names) - keep, 0)]]
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) < 2 or args[0] != 'compress':
+        raise SystemExit('usage: python log_rotation.py compress DIR [--method gzip|zstd] [--keep N]')
+    method = args[args.index('--method') + 1] if '--method' in args else 'gzip'
+    keep = int(args[args.index('--keep') + 1]) if '--keep' in args else 1
+    for path in compress_logs(args[1], method, keep):
+        print(path)
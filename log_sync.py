@@ -0,0 +1,436 @@
+"""
+Incremental upload of the Logs directory to a remote store, replacing the hourly loop of gdrive_uploader.ipynb.
+
+Every file is split into fixed size chunks (1 MB by default) and a manifest in Logs/.cache/sync_manifest.json keeps,
+per file, the size and mtime it was last hashed at, the sha256 of every chunk, the chunk hashes the remote copy
+already has, the remote id and an open upload session. A sync round:
+
+    scan      os.stat of every log, also in subdirectories such as Rollups/ (not Replay/ or hidden ones), only files whose size or mtime changed are hashed again, and since logs only
+              grow, a grown file only from its last chunk on. A file whose mtime changed at the same size was
+              rewritten in place and is hashed in full, as is every file with append_only=False
+    plan      a chunk is sent when its hash differs from what the remote holds
+    upload    files are uploaded concurrently on a small worker pool, every chunk call is retried with exponential
+              backoff and jitter, and the manifest is saved as chunks are acknowledged, so an interrupted upload
+              resumes where it stopped instead of starting over
+
+Backends decide how much of that delta they can use:
+
+    LocalDirectoryBackend  a directory (USB stick, NAS or NFS mount, or a test folder), chunks are written at their
+                           offset, so a growing log only sends its new tail
+    GoogleDriveBackend     Drive's resumable upload protocol, chunks go in order and an interrupted session is
+                           resumed from the byte Drive confirms. Drive cannot patch a file, so a changed file is
+                           uploaded again as a whole (as a new revision of the same file id)
+
+When log_rotation compresses a closed segment X.csv into X.csv.gz, the .gz is uploaded as a new file and the remote
+X.csv is deleted once that upload has finished, so the remote copy never holds the rows twice.
+
+A backend is any object with partial, begin(name, size, remote_id, session), put(session, offset, data),
+received(session), finish(session) and delete(name, remote_id); see the two above. Names are paths relative to the
+synced directory, with '/' between directories. run() repeats sync rounds, waking up early on file
+changes when the inotify_simple package is installed and otherwise every `interval` seconds.
+
+    python log_sync.py Logs /media/usb/Logs            # one round to a local directory
+    python log_sync.py Logs --drive FOLDER_ID --watch  # keep Google Drive in sync
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from log_ingest import CACHE_DIR
+from log_rotation import is_csv_log, split_compression
+
+MANIFEST_NAME = 'sync_manifest.json'
+SKIPPED_DIRECTORIES = ['Replay']     # fake and replayed runs, see sensor_backend.output_directory
+CHUNK_SIZE = 1 << 20     # a multiple of 256 kB, which Drive requires of every chunk but the last
+
+
+class TransientError(Exception):
+    """A remote failure worth retrying, e.g. HTTP 429 or 5xx"""
+
+
+class SessionExpired(Exception):
+    """The remote no longer knows the upload session, the upload starts over"""
+
+
+def default_include(name):
+    # log segments (plain or compressed), binary logs, rollups and radon exports, not the cache or temp files.
+    # name is the file name, without its directory
+    return not name.startswith('.') and not name.endswith('.tmp') and (
+        is_csv_log(name) or name.endswith(('.bin', '.txt', '.txt.gz')))
+
+
+def retry(call, retries=5, backoff=1.0, max_backoff=60.0, sleep=time.sleep):
+    """call(), retried on OSError and TransientError with exponential backoff and jitter"""
+    for attempt in range(retries + 1):
+        try:
+            return call()
+        except (OSError, TransientError):
+            if attempt == retries:
+                raise
+            sleep(min(backoff * 2 ** attempt, max_backoff) * random.uniform(0.5, 1.5))
+
+
+class Manifest:
+    """Sync state of every file, saved atomically as json"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = {}
+        self._saved = 0.0
+        if os.path.exists(path):
+            with open(path, encoding='utf8') as f:
+                self.files = json.load(f)['files']
+
+    def save(self, min_interval=0.0):
+        """Writes the manifest, at most every min_interval seconds"""
+        with self.lock:
+            now = time.monotonic()
+            if now - self._saved < min_interval:
+                return
+            self._saved = now
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w', encoding='utf8') as f:
+                json.dump({'files': self.files}, f)
+            os.replace(tmp, self.path)
+
+
+class LogSync:
+    """Keeps a remote copy of a directory of logs up to date"""
+
+    def __init__(self, directory, backend, manifest_path=None, include=default_include, chunk_size=CHUNK_SIZE,
+                 workers=3, retries=5, backoff=1.0, append_only=True, settle=0.0):
+        self.directory = directory
+        self.backend = backend
+        self.manifest = Manifest(manifest_path or os.path.join(directory, CACHE_DIR, MANIFEST_NAME))
+        self.include = include
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.append_only = append_only
+        # seconds a csv log segment must be left alone before it is uploaded, 0 syncs the growing segment too. Other
+        # files (rollups, recordings) are appended to for as long as the stand runs and are synced every round
+        self.settle = settle
+        self.stats = {'rounds': 0, 'files': 0, 'chunks': 0, 'bytes': 0, 'failed': 0}
+        self.errors = {}
+
+    # scanning
+
+    def _hash_chunks(self, path, start, size):
+        hashes = []
+        with open(path, 'rb') as f:
+            f.seek(start * self.chunk_size)
+            for k in range(start, -(-size // self.chunk_size)):     # the file may grow meanwhile, stop at `size`
+                hashes.append(hashlib.sha256(f.read(min(self.chunk_size, size - k * self.chunk_size))).hexdigest())
+        return hashes
+
+    def _list(self):
+        names = []
+        for root, directories, files in os.walk(self.directory):
+            directories[:] = sorted(d for d in directories if not d.startswith('.') and d not in SKIPPED_DIRECTORIES)
+            relative = os.path.relpath(root, self.directory)
+            for name in files:
+                if self.include(name):
+                    names.append(name if relative == os.curdir else '/'.join(relative.split(os.sep) + [name]))
+        return sorted(names)
+
+    def scan(self):
+        """Rehashes new and changed files, returns the names that need an upload"""
+        names = self._list()
+        now = time.time()
+        pending = []
+        for name in names:
+            path = os.path.join(self.directory, *name.split('/'))
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:     # compressed or removed meanwhile
+                continue
+            if not os.path.isfile(path) or (is_csv_log(name) and now - stat.st_mtime < self.settle):
+                continue
+            entry = self.manifest.files.get(name)
+            if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+                entry = self._rehash(path, entry, stat)
+                with self.manifest.lock:
+                    self.manifest.files[name] = entry
+            if self._changed_chunks(entry) or entry.get('replaces'):
+                pending.append(name)
+        with self.manifest.lock:
+            for name in set(self.manifest.files) - set(names):
+                twins = [n for n in names if n != name and split_compression(n)[0] == name]
+                if twins and twins[0] not in self.manifest.files:
+                    continue     # the compressed copy is not scanned yet, it takes over the remote copy later
+                entry = self.manifest.files.pop(name)
+                if twins and entry['remote_id'] is not None:     # compressed: its remote copy goes once the twin is up
+                    self.manifest.files[twins[0]].setdefault('replaces', []).append([name, entry['remote_id']])
+                    if twins[0] not in pending:
+                        pending.append(twins[0])
+                # a deleted file keeps its remote copy
+        return pending
+
+    def _rehash(self, path, entry, stat):
+        if entry is None:
+            entry = {'chunks': [], 'sent': [], 'remote_id': None, 'session': None}
+        chunks = entry['chunks']
+        start = 0
+        if self.append_only and stat.st_size > entry.get('size', 0):
+            start = max(len(chunks) - 1, 0)     # earlier chunks are complete and a growing log never rewrites them
+        size = stat.st_size
+        entry['chunks'] = chunks[:start] + self._hash_chunks(path, start, size)
+        entry['size'] = size
+        entry['mtime_ns'] = stat.st_mtime_ns
+        entry['session'] = None     # an upload session is opened for one size
+        return entry
+
+    @staticmethod
+    def _changed_chunks(entry):
+        sent = entry['sent']
+        changed = [k for k, h in enumerate(entry['chunks']) if k >= len(sent) or sent[k] != h]
+        if entry['size'] == 0 and entry['remote_id'] is None:
+            changed = [0]     # an empty file still gets created remotely
+        elif len(sent) > len(entry['chunks']):     # the file shrank
+            changed = changed or [len(entry['chunks']) - 1]
+        return changed
+
+    # uploading
+
+    def _retry(self, call):
+        return retry(call, self.retries, self.backoff)
+
+    def upload(self, name):
+        """Sends the changed chunks of one file, returns the number of bytes sent"""
+        entry = self.manifest.files[name]
+        path = os.path.join(self.directory, *name.split('/'))
+        size = entry['size']
+        chunks = list(entry['chunks'])
+        session = self._retry(lambda: self.backend.begin(name, size, entry['remote_id'], entry['session']))
+        if self.backend.partial:
+            offsets = [k * self.chunk_size for k in self._changed_chunks(entry) if k < len(chunks)]
+        else:     # the whole file in order, from the first byte the remote has not confirmed
+            try:
+                received = self._retry(lambda: self.backend.received(session))
+            except SessionExpired:
+                session = self._retry(lambda: self.backend.begin(name, size, entry['remote_id'], None))
+                received = 0
+            offsets = range(received, size, self.chunk_size)
+        entry['session'] = session
+        self.manifest.save()
+        sent_bytes = 0
+        with open(path, 'rb') as f:
+            for offset in offsets:
+                f.seek(offset)
+                data = f.read(min(self.chunk_size, size - offset))
+                self._retry(lambda: self.backend.put(session, offset, data))
+                sent_bytes += len(data)
+                with self.manifest.lock:
+                    self.stats['chunks'] += 1
+                    self.stats['bytes'] += len(data)
+                    if self.backend.partial:
+                        sent = entry['sent']
+                        sent.extend([None] * (len(chunks) - len(sent)))
+                        sent[offset // self.chunk_size] = chunks[offset // self.chunk_size]
+                self.manifest.save(min_interval=1.0)
+        remote_id = self._retry(lambda: self.backend.finish(session))
+        with self.manifest.lock:
+            entry['remote_id'] = remote_id
+            entry['session'] = None
+            entry['sent'] = chunks
+            self.stats['files'] += 1
+        self.manifest.save()
+        for stale in list(entry.get('replaces', [])):     # the uncompressed copy this file replaces
+            self._retry(lambda: self.backend.delete(*stale))
+            with self.manifest.lock:
+                entry['replaces'].remove(stale)
+            self.manifest.save()
+        return sent_bytes
+
+    def _upload_logged(self, name):
+        try:
+            self.upload(name)
+            self.errors.pop(name, None)
+        except Exception as error:     # the file stays pending and is tried again next round
+            self.errors[name] = repr(error)
+            with self.manifest.lock:
+                self.stats['failed'] += 1
+
+    def sync_once(self):
+        """One scan and upload round, returns the names that were pending"""
+        pending = self.scan()
+        self.manifest.save()
+        if pending:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='log sync') as pool:
+                list(pool.map(self._upload_logged, pending))
+        self.stats['rounds'] += 1
+        return pending
+
+    def run(self, interval=60.0, stop=None):
+        """Sync rounds until `stop` (a threading.Event) is set, early on file changes when inotify is available"""
+        stop = stop or threading.Event()
+        watcher = _Watcher(self.directory)
+        try:
+            while not stop.is_set():
+                self.sync_once()
+                watcher.wait(interval, stop)
+        finally:
+            watcher.close()
+
+
+class _Watcher:
+    # inotify through the optional inotify_simple package, plain waiting otherwise
+    def __init__(self, directory):
+        self.inotify = None
+        try:
+            from inotify_simple import INotify, flags
+        except ImportError:
+            return
+        self.inotify = INotify()
+        self.inotify.add_watch(directory, flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE)
+
+    def wait(self, timeout, stop):
+        if self.inotify is None:
+            stop.wait(timeout)
+            return
+        deadline = time.monotonic() + timeout
+        while not stop.is_set() and time.monotonic() < deadline:
+            if self.inotify.read(timeout=1000, read_delay=500):     # ms, gathers a burst of events into one round
+                return
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+
+
+class LocalDirectoryBackend:
+    """Remote copies in a local directory, chunks are written in place at their offsets"""
+
+    partial = True
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def begin(self, name, size, remote_id=None, session=None):
+        path = os.path.join(self.root, *name.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        mode = 'r+b' if os.path.exists(path) else 'w+b'
+        with open(path, mode) as f:
+            f.truncate(size)
+        return {'path': path, 'size': size}
+
+    def put(self, session, offset, data):
+        with open(session['path'], 'r+b') as f:
+            f.seek(offset)
+            f.write(data)
+
+    def received(self, session):
+        return 0
+
+    def finish(self, session):
+        with open(session['path'], 'r+b') as f:
+            os.fsync(f.fileno())
+        return session['path']
+
+    def delete(self, name, remote_id):
+        try:
+            os.remove(remote_id)
+        except FileNotFoundError:
+            pass
+
+
+class GoogleDriveBackend:
+    """A Google Drive folder, through Drive's resumable upload protocol. Needs pydrive for the OAuth login"""
+
+    partial = False
+    UPLOAD_URL = 'https://www.googleapis.com/upload/drive/v3/files'
+
+    def __init__(self, folder_id, gauth=None):
+        if gauth is None:
+            from pydrive.auth import GoogleAuth     # only needed for Drive
+            gauth = GoogleAuth()
+            gauth.LocalWebserverAuth()
+        self.gauth = gauth
+        self.folder_id = folder_id
+        self.lock = threading.Lock()
+
+    def _request(self, url, method, data=None, headers=None):
+        import urllib.request
+        import urllib.error
+        with self.lock:
+            if self.gauth.access_token_expired:
+                self.gauth.Refresh()
+            token = self.gauth.credentials.access_token
+        request = urllib.request.Request(url, data=data, method=method,
+                                         headers=dict(headers or {}, Authorization='Bearer ' + token))
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as error:
+            if error.code == 308:     # resume incomplete, the normal answer to a chunk that is not the last
+                return 308, error.headers, b''
+            if error.code in (404, 410):
+                raise SessionExpired(url)
+            if error.code == 429 or error.code >= 500:
+                raise TransientError('{} {}'.format(error.code, error.reason))
+            raise
+
+    def begin(self, name, size, remote_id=None, session=None):
+        if session is not None:
+            return session
+        if remote_id is None:
+            url, method, body = self.UPLOAD_URL + '?uploadType=resumable', 'POST', {'name': name, 'parents': [self.folder_id]}
+        else:     # a new revision of the file uploaded before
+            url, method, body = '{}/{}?uploadType=resumable'.format(self.UPLOAD_URL, remote_id), 'PATCH', {}
+        _, headers, _ = self._request(url, method, json.dumps(body).encode(), {
+            'Content-Type': 'application/json; charset=UTF-8', 'X-Upload-Content-Length': str(size)})
+        return {'uri': headers['Location'], 'size': size, 'id': remote_id}
+
+    def received(self, session):
+        status, headers, body = self._request(session['uri'], 'PUT', b'',
+                                              {'Content-Range': 'bytes */{}'.format(session['size'])})
+        if status in (200, 201):     # the upload completed before a restart, Drive answers with the file
+            session['id'] = json.loads(body)['id']
+            return session['size']
+        confirmed = headers.get('Range')     # 'bytes=0-N'
+        return int(confirmed.rsplit('-', 1)[1]) + 1 if confirmed else 0
+
+    def put(self, session, offset, data):
+        end = offset + len(data) - 1
+        content_range = 'bytes {}-{}/{}'.format(offset, end, session['size']) if data else 'bytes */{}'.format(session['size'])
+        status, _, body = self._request(session['uri'], 'PUT', data, {'Content-Range': content_range})
+        if status in (200, 201):
+            session['id'] = json.loads(body)['id']
+
+    def finish(self, session):
+        if session.get('id') is None:     # an empty file, or every chunk had been confirmed before a restart
+            self.put(session, 0, b'')
+        return session['id']
+
+    def delete(self, name, remote_id):
+        try:
+            self._request('https://www.googleapis.com/drive/v3/files/' + remote_id, 'DELETE')
+        except SessionExpired:     # 404, already gone
+            pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Uploads new and changed logs')
+    parser.add_argument('directory', help='log directory, e.g. Logs')
+    parser.add_argument('target', nargs='?', help='local directory to sync to')
+    parser.add_argument('--drive', metavar='FOLDER_ID', help='sync to this Google Drive folder instead')
+    parser.add_argument('--watch', action='store_true', help='keep syncing')
+    parser.add_argument('--interval', type=float, default=3600.0, help='seconds between rounds with --watch')
+    parser.add_argument('--workers', type=int, default=3)
+    args = parser.parse_args()
+    if (args.target is None) == (args.drive is None):
+        parser.error('give either a target directory or --drive FOLDER_ID')
+    backend = GoogleDriveBackend(args.drive) if args.drive else LocalDirectoryBackend(args.target)
+    sync = LogSync(args.directory, backend, workers=args.workers)
+    if args.watch:
+        sync.run(args.interval)
+    else:
+        print('{} file(s) pending'.format(len(sync.sync_once())), sync.stats, sync.errors or '')
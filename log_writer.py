@@ -0,0 +1,156 @@
+"""
+Background writer for the temperature logs.
+
+The control loop only puts rows on a bounded in-memory queue. A dedicated thread drains it, formats the rows in
+batches, writes them, flushes on a fixed interval and starts a new log file once the current one reaches max_bytes
+(counted as rows are written, no os.stat per tick). If the SD card stalls the queue fills up and rows are dropped
+and counted, the PID update path never waits on the disk. If writing fails (no Logs directory, a full or failing SD
+card) the thread stops, keeps the exception as `error` and log() raises it in the control loop. A new file never overwrites one from the same minute, and
+with compress='gzip' (or 'zstd') every closed file is compressed in the background, see log_rotation.py.
+"""
+import csv
+import io
+import os
+import queue
+import threading
+import time
+from datetime import datetime as dt
+from log_rotation import SegmentCompressor, unique_name
+
+_STOP = object()
+
+
+def log_file_name():
+    """Name of a new log file, same format the control scripts always used"""
+    return 'Temp log {}.csv'.format(dt.now().strftime('%m-%d-%Y, %H-%M'))
+
+
+class BackgroundLogWriter:
+    """Writes csv rows to the Logs directory from a background thread"""
+
+    def __init__(self, directory, header, max_bytes=4194304, queue_size=10000, batch_size=500, flush_interval=1.0,
+                 file_namer=log_file_name, compress=None):
+        self.directory = directory
+        self.header = list(header)
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.file_namer = file_namer
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.compressor = SegmentCompressor(compress) if compress else None
+        self.file_name = None
+        self.rows_written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.flushes = 0
+        self.bytes_written = 0     # bytes in the current file
+        self.last_write_latency = 0.0
+        self.max_write_latency = 0.0
+        self._total_write_time = 0.0
+        self._file = None
+        self.error = None     # what stopped the writer thread, if anything did
+        self._thread = threading.Thread(target=self._run, name='log writer', daemon=True)
+        self._thread.start()
+
+    def log(self, row):
+        """Queues one row without blocking, returns False if the queue is full and the row was dropped.
+        Raises once the writer thread has stopped on an error, rows would only pile up unwritten"""
+        if self.error is not None:
+            raise RuntimeError('log writer stopped: {!r}'.format(self.error)) from self.error
+        try:
+            self.queue.put_nowait(row)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def stats(self):
+        return {
+            'file': self.file_name,
+            'error': None if self.error is None else repr(self.error),
+            'queue_depth': self.queue.qsize(),
+            'rows_written': self.rows_written,
+            'dropped': self.dropped,
+            'batches': self.batches,
+            'flushes': self.flushes,
+            'last_write_ms': self.last_write_latency * 1e3,
+            'max_write_ms': self.max_write_latency * 1e3,
+            'mean_write_ms': self._total_write_time / max(self.batches, 1) * 1e3,
+        }
+
+    def close(self, timeout=5.0):
+        """Writes whatever is still queued, flushes and closes the current file"""
+        if self._thread.is_alive():     # a thread stopped by an error no longer drains the queue
+            try:
+                self.queue.put(_STOP, timeout=timeout)
+            except queue.Full:
+                pass
+        self._thread.join(timeout)
+
+    def _close_file(self):
+        f = self._file
+        self._file = None
+        f.close()
+        if self.compressor is not None:
+            self.compressor.submit(os.path.join(self.directory, self.file_name))
+
+    def _open(self):
+        if self._file is not None:
+            self._close_file()
+        self.file_name = unique_name(self.directory, self.file_namer())
+        self._file = open(os.path.join(self.directory, self.file_name), 'w', encoding='UTF8', newline='')
+        self.bytes_written = 0
+        self._write_rows([self.header])
+
+    def _write_rows(self, rows):
+        text = io.StringIO()
+        csv.writer(text).writerows(rows)
+        data = text.getvalue()
+        self._file.write(data)
+        self.bytes_written += len(data.encode('UTF8'))
+
+    def _run(self):
+        try:
+            self._write()
+        except Exception as error:
+            self.error = error
+        finally:
+            if self._file is not None:
+                try:
+                    self._close_file()
+                except Exception:
+                    pass
+            if self.compressor is not None:
+                self.compressor.close()
+
+    def _write(self):
+        self._open()
+        last_flush = time.monotonic()
+        stopping = False
+        while not stopping:
+            batch = []
+            try:
+                row = self.queue.get(timeout=self.flush_interval)
+                while row is not _STOP:
+                    batch.append(row)
+                    if len(batch) >= self.batch_size:
+                        break
+                    row = self.queue.get_nowait()
+                stopping = row is _STOP
+            except queue.Empty:
+                pass
+            if batch:
+                start = time.monotonic()
+                self._write_rows(batch)
+                self.rows_written += len(batch)
+                self.batches += 1
+                latency = time.monotonic() - start
+                self.last_write_latency = latency
+                self.max_write_latency = max(self.max_write_latency, latency)
+                self._total_write_time += latency
+            if time.monotonic() - last_flush >= self.flush_interval or stopping:
+                self._file.flush()
+                self.flushes += 1
+                last_flush = time.monotonic()
+            if self.bytes_written >= self.max_bytes and not stopping:     # rotate to a new log file
+                self._open()
@@ -0,0 +1,254 @@
+"""
+Drift free pacing of the control loops.
+
+DeadlineScheduler fires on absolute deadlines start + k*period taken from the monotonic clock, so errors in one
+period never carry over into the next and wall clock adjustments (NTP on the Pi) cannot stretch or shrink a loop.
+Overruns are handled by an explicit policy and every cycle's wake up jitter is recorded.
+
+MultiRateScheduler runs many periodic tasks, each on its own period, on one thread: it always runs the task with the
+earliest deadline next and sleeps until then, so a 10 Hz sensor, a 4 Hz PID loop and a 1/6 Hz log group share the
+thread without any of them being paced by the slowest. A task that misses deadlines skips them (the SKIP policy).
+"""
+import asyncio
+import heapq
+import itertools
+import time
+import numpy as np
+
+SKIP = 'skip'     # drop the missed deadlines and wait for the next one in the future
+CATCH_UP = 'catch_up'     # run the missed cycles back to back until the schedule is met again
+DEGRADE = 'degrade'     # lengthen the period after an overrun, recover once cycles fit again
+
+
+class DeadlineScheduler:
+    """Paces a loop to a fixed period on absolute monotonic deadlines
+
+    Call wait() at the end of every cycle, or iterate over the scheduler. jitter is how late the loop woke up
+    relative to its deadline, and it is kept for the last `history` cycles.
+    """
+
+    def __init__(self, period, overrun=SKIP, max_period=None, degrade_factor=2.0, recover_after=20, history=1024,
+                 clock=time.monotonic, sleep=time.sleep):
+        if overrun not in (SKIP, CATCH_UP, DEGRADE):
+            raise ValueError('unknown overrun policy {}'.format(overrun))
+        self.base_period = period
+        self.period = period
+        self.overrun = overrun
+        self.max_period = max_period if max_period is not None else 8 * period
+        self.degrade_factor = degrade_factor
+        self.recover_after = recover_after
+        self.clock = clock
+        self.sleep = sleep
+        self._jitter = np.zeros(history)
+        self.reset()
+
+    def reset(self):
+        """Restarts the schedule from now and clears the statistics"""
+        self.period = self.base_period
+        self.deadline = self.clock() + self.period
+        self.cycle_start = self.clock()
+        self.last_elapsed = 0.0     # work time of the last cycle
+        self.cycles = 0
+        self.overruns = 0
+        self.skipped = 0
+        self._good_cycles = 0
+
+    def wait(self):
+        """Sleeps until the next deadline and applies the overrun policy if it was already missed"""
+        remaining = self._plan()
+        if remaining > 0:
+            self.sleep(remaining)
+        self._fired()
+
+    async def wait_async(self):
+        """wait() for asyncio loops, other tasks keep running while the deadline is pending"""
+        remaining = self._plan()
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+        self._fired()
+
+    def _plan(self):
+        # applies the overrun policy and returns how long to sleep until the deadline
+        now = self.clock()
+        self.last_elapsed = now - self.cycle_start
+        if now > self.deadline:
+            self.overruns += 1
+            self._good_cycles = 0
+            if self.overrun == SKIP:
+                missed = int((now - self.deadline) // self.period) + 1
+                self.skipped += missed
+                self.deadline += missed * self.period
+            elif self.overrun == DEGRADE:
+                self.period = min(self.period * self.degrade_factor, self.max_period)
+                self.deadline = now     # start the slower schedule from this cycle
+            # CATCH_UP returns right away and keeps the original deadlines
+        else:
+            self._good_cycles += 1
+            if self.overrun == DEGRADE and self.period > self.base_period and self._good_cycles >= self.recover_after:
+                self.period = max(self.period / self.degrade_factor, self.base_period)
+                self._good_cycles = 0
+        return self.deadline - self.clock()
+
+    def _fired(self):
+        woke = self.clock()
+        self._jitter[self.cycles % len(self._jitter)] = woke - self.deadline
+        self.cycles += 1
+        self.cycle_start = woke
+        self.deadline += self.period
+
+    def __iter__(self):
+        while True:
+            yield self.cycles
+            self.wait()
+
+    def jitter(self):
+        """Jitter of the recorded cycles in seconds, oldest first"""
+        n = min(self.cycles, len(self._jitter))
+        start = self.cycles % len(self._jitter) if self.cycles > len(self._jitter) else 0
+        return np.roll(self._jitter, -start)[:n]
+
+    def stats(self):
+        """Summary of the schedule health, jitter figures in milliseconds"""
+        jitter = self.jitter() * 1e3
+        if len(jitter) == 0:
+            jitter = np.zeros(1)
+        return {
+            'period_s': self.period,
+            'cycles': self.cycles,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'last_elapsed_ms': self.last_elapsed * 1e3,
+            'jitter_mean_ms': float(np.mean(jitter)),
+            'jitter_p99_ms': float(np.percentile(jitter, 99)),
+            'jitter_max_ms': float(np.max(jitter)),
+        }
+
+
+class Task:
+    """One job of a MultiRateScheduler, period None for a one-off"""
+
+    def __init__(self, name, function, period=None, priority=0):
+        self.name = name
+        self.function = function
+        self.period = period
+        self.priority = priority     # lower runs first when deadlines tie, e.g. sensors before the PID that reads them
+        self.deadline = None
+        self.runs = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.max_late = 0.0     # seconds
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class MultiRateScheduler:
+    """Runs periodic and one-off tasks on absolute monotonic deadlines, earliest deadline first
+
+    With instruments (an instrumentation.Instruments) every task's run time goes into a stage of the task's name and
+    the wake up lateness of all tasks into a 'late' stage.
+    """
+
+    def __init__(self, clock=time.monotonic, sleep=time.sleep, instruments=None):
+        self.clock = clock
+        self.sleep = sleep
+        self.instruments = instruments
+        self.tasks = {}
+        self._queue = []     # heap of (deadline, priority, sequence, task)
+        self._sequence = itertools.count()
+        self._running = False
+        self._late = instruments.stage('late') if instruments else None
+
+    def _push(self, task):
+        heapq.heappush(self._queue, (task.deadline, task.priority, next(self._sequence), task))
+
+    def every(self, period, function, name=None, offset=0.0, priority=0):
+        """Runs function() every `period` seconds, the first time `offset` seconds from now"""
+        if period <= 0:
+            raise ValueError('period must be positive')
+        task = Task(name or function.__name__, function, period, priority)
+        task.deadline = self.clock() + offset
+        self.tasks[task.name] = task
+        self._push(task)
+        return task
+
+    def after(self, delay, function, name=None, priority=0):
+        """Runs function() once, `delay` seconds from now"""
+        task = Task(name or function.__name__, function, None, priority)
+        task.deadline = self.clock() + delay
+        self._push(task)
+        return task
+
+    def stop(self):
+        """Makes run() return after the task that is running now"""
+        self._running = False
+
+    def run(self, duration=None):
+        """Runs the tasks until stop() or for `duration` seconds. Exceptions from a task end the run"""
+        end = None if duration is None else self.clock() + duration
+        self._running = True
+        while self._running and self._queue:
+            deadline, _, _, task = self._queue[0]
+            if end is not None and deadline > end:
+                break
+            remaining = deadline - self.clock()
+            if remaining > 0:
+                self.sleep(remaining)
+                continue     # a task may have been added or stop() called meanwhile, look again
+            heapq.heappop(self._queue)
+            if task.cancelled:
+                continue
+            self._run_task(task)
+
+    def _run_task(self, task):
+        start = self.clock()
+        late = start - task.deadline
+        task.max_late = max(task.max_late, late)
+        if self._late is not None:
+            self._late.record(int(late * 1e9))
+        task.function()
+        task.runs += 1
+        if self.instruments is not None:
+            self.instruments.stage(task.name).record(int((self.clock() - start) * 1e9))
+        if task.period is None or task.cancelled:
+            return
+        task.deadline += task.period
+        now = self.clock()
+        if task.deadline <= now:     # overrun, skip to the next deadline in the future
+            missed = int((now - task.deadline) // task.period) + 1
+            task.overruns += 1
+            task.skipped += missed
+            task.deadline += missed * task.period
+        self._push(task)
+
+    def stats(self):
+        """Runs, overruns and worst lateness (ms) of every periodic task"""
+        return {name: {'period_s': t.period, 'runs': t.runs, 'overruns': t.overruns, 'skipped': t.skipped,
+                       'max_late_ms': t.max_late * 1e3} for name, t in self.tasks.items()}
+
+
+if __name__ == '__main__':
+    # 4 Hz loop with a simulated 50 ms workload and an occasional 400 ms stall
+    for policy in [SKIP, CATCH_UP, DEGRADE]:
+        scheduler = DeadlineScheduler(0.25, overrun=policy)
+        for cycle in scheduler:
+            time.sleep(0.4 if cycle % 10 == 5 else 0.05)
+            if cycle >= 40:
+                break
+        print(policy, scheduler.stats())
+
+    # three rates on one thread for 3 s
+    scheduler = MultiRateScheduler()
+    counts = {'fast': 0, 'medium': 0, 'slow': 0}
+
+    def tick(name, work):
+        def task():
+            counts[name] += 1
+            time.sleep(work)
+        return task
+    scheduler.every(0.05, tick('fast', 0.002), 'fast', priority=0)
+    scheduler.every(0.25, tick('medium', 0.02), 'medium', priority=1)
+    scheduler.every(1.0, tick('slow', 0.1), 'slow', priority=2)
+    scheduler.run(3.0)
+    print(counts, scheduler.stats())
@@ -0,0 +1,176 @@
+"""
+PID gain sweep and auto tuning for the heat exchanger loops.
+
+Candidate gain sets (Kp, Ki, Kd, windup, sample_time) are scored by running the closed loop against a plant model,
+either the lumped thermal_sim.ThermalPlant or a first order model fitted to a recorded log. Candidates are split into
+chunks spread over a process pool, and inside every worker a whole chunk is simulated at once with PID.PIDBank and a
+batched plant, so thousands of candidates are scored in minutes.
+"""
+import csv
+import os
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import PID
+from thermal_sim import ThermalPlant, HEATERS
+
+PARAMS = ['Kp', 'Ki', 'Kd', 'windup', 'sample_time']
+SETPOINTS = [-115, -94.5]     # HeatExF and HeatExB targets used in Temperature_Control_Only.py
+RESULT_DTYPE = [(name, 'float64') for name in PARAMS] + [('score', 'float64')] + \
+    [('{}_{}'.format(metric, node), 'float64') for node in HEATERS for metric in ['iae', 'settle', 'overshoot', 'switches']]
+
+
+class FirstOrderPlant:
+    """Two independent first order loops, dT/dt = c0 + c1*T + c2*heater, one per heat exchanger thermocouple
+
+    The coefficients usually come from fit_first_order() on a recorded log so candidates can be scored
+    against the measured response of the stand instead of the lumped model.
+    """
+
+    def __init__(self, c0, c1, c2, batch=1, initial=20.0):
+        self.nodes = HEATERS
+        self.c0 = np.asarray(c0, dtype='float64')[:, None]
+        self.c1 = np.asarray(c1, dtype='float64')[:, None]
+        self.c2 = np.asarray(c2, dtype='float64')[:, None]
+        self.temperatures = np.full((len(HEATERS), batch), initial, dtype='float64')
+
+    def step(self, heaters, dt):
+        self.temperatures += dt * (self.c0 + self.c1 * self.temperatures + self.c2 * heaters)
+        return self.temperatures
+
+
+def fit_first_order(times, temps, heater):
+    """Least squares fit of dT/dt = c0 + c1*T + c2*heater for one loop of a recorded log.
+    times in seconds, temps the thermocouple reading and heater the 0/1 relay state logged with it."""
+    times, temps, heater = (np.asarray(a, dtype='float64') for a in (times, temps, heater))
+    rate = np.diff(temps) / np.diff(times)
+    A = np.column_stack([np.ones(len(rate)), temps[:-1], heater[:-1]])
+    return np.linalg.lstsq(A, rate, rcond=None)[0]
+
+
+def grid(Kp, Ki, Kd, windup=(20.0,), sample_time=(1.0,)):
+    """Every combination of the given values as an array of shape (candidates, 5) in PARAMS order"""
+    mesh = np.meshgrid(Kp, Ki, Kd, windup, sample_time, indexing='ij')
+    return np.column_stack([m.ravel() for m in mesh]).astype('float64')
+
+
+def score_chunk(candidates, plant_factory=ThermalPlant, duration=4*3600, loop_time=1.0, band=1.0, weights=(1.0, 0.01, 5.0, 0.001)):
+    """Simulates every candidate at once and returns one RESULT_DTYPE row per candidate
+
+    All metrics are accumulated while stepping so memory stays proportional to the number of candidates.
+    score = sum over loops of w0*IAE/duration + w1*settling time + w2*overshoot + w3*relay switches,
+    a loop that never settles counts as settling at the end of the run.
+    """
+    n = len(candidates)
+    loops = len(HEATERS)
+    plant = plant_factory(batch=n)
+    sensed = [plant.nodes.index(node) for node in HEATERS]
+    bank = PID.PIDBank(loops * n, current_time=0.0)     # channels [0, n) drive HeaterF, [n, 2n) HeaterB
+    bank.setKp(np.tile(candidates[:, 0], loops))
+    bank.setKi(np.tile(candidates[:, 1], loops))
+    bank.setKd(np.tile(candidates[:, 2], loops))
+    bank.setWindup(np.tile(candidates[:, 3], loops))
+    bank.setSampleTime(np.tile(candidates[:, 4], loops))
+    bank.SetPoint = np.repeat(np.asarray(SETPOINTS, dtype='float64'), n)
+    setpoints = bank.SetPoint.reshape(loops, n)
+
+    start = plant.temperatures[sensed]
+    iae = np.zeros((loops, n))
+    low = start.copy()
+    high = start.copy()
+    last_outside = np.zeros((loops, n))
+    switches = np.zeros((loops, n))
+    heaters = np.zeros((loops, n), dtype='bool')
+    steps = int(duration / loop_time)
+    for step in range(steps):
+        now = step * loop_time
+        temps = plant.temperatures[sensed]
+        error = np.abs(temps - setpoints)
+        iae += error * loop_time
+        np.minimum(low, temps, out=low)
+        np.maximum(high, temps, out=high)
+        last_outside[error > band] = now + loop_time     # settled from the next sample on, if it stays inside
+        bank.update(temps.ravel(), now)
+        new_heaters = bank.output.reshape(loops, n) > 0     # temp too low turn heater on
+        switches += new_heaters != heaters
+        heaters = new_heaters
+        plant.step(heaters, loop_time)
+
+    settle = np.where(last_outside >= steps * loop_time, np.nan, last_outside)
+    over = np.where(start > setpoints, setpoints - low, high - setpoints).clip(min=0)
+    score = (weights[0] * iae / duration + weights[1] * np.nan_to_num(settle, nan=duration)
+             + weights[2] * over + weights[3] * switches).sum(axis=0)
+
+    rows = np.zeros(n, dtype=RESULT_DTYPE)
+    for k, name in enumerate(PARAMS):
+        rows[name] = candidates[:, k]
+    rows['score'] = score
+    for k, node in enumerate(HEATERS):
+        rows['iae_' + node] = iae[k]
+        rows['settle_' + node] = settle[k]
+        rows['overshoot_' + node] = over[k]
+        rows['switches_' + node] = switches[k]
+    return rows
+
+
+def evaluate(candidates, workers=None, chunk_size=256, **kwargs):
+    """Scores candidates over a process pool and returns them ranked, best (lowest score) first"""
+    candidates = np.asarray(candidates, dtype='float64').reshape(-1, len(PARAMS))
+    chunks = [candidates[i:i + chunk_size] for i in range(0, len(candidates), chunk_size)]
+    if workers == 1 or len(chunks) == 1:
+        results = [score_chunk(chunk, **kwargs) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(partial(score_chunk, **kwargs), chunks))
+    table = np.concatenate(results)
+    return table[np.argsort(table['score'], kind='stable')]
+
+
+def autotune(initial, iterations=5, population=512, elite=32, seed=None, **kwargs):
+    """Cross entropy search in log space around an initial (Kp, Ki, Kd, windup, sample_time) guess.
+    Every iteration samples a population around the current elite set, scores it with evaluate()
+    and refits the sampling distribution to the best candidates. Returns every scored candidate, ranked."""
+    rng = np.random.default_rng(seed)
+    mean = np.log(np.asarray(initial, dtype='float64'))
+    spread = np.full(len(PARAMS), 1.0)
+    tables = []
+    for _ in range(iterations):
+        candidates = np.exp(rng.normal(mean, spread, size=(population, len(PARAMS))))
+        table = evaluate(candidates, **kwargs)
+        tables.append(table)
+        best = np.log(np.column_stack([table[name][:elite] for name in PARAMS]))
+        mean = best.mean(axis=0)
+        spread = np.maximum(best.std(axis=0), 0.05)
+    table = np.concatenate(tables)
+    return table[np.argsort(table['score'], kind='stable')]
+
+
+def write_table(table, file_name):
+    """Writes a ranked table to a csv file, one candidate per row"""
+    with open(file_name, 'w', encoding='UTF8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['rank'] + list(table.dtype.names))
+        for rank, row in enumerate(table, 1):
+            writer.writerow([rank] + row.tolist())
+
+
+def print_table(table, rows=10):
+    columns = ['Kp', 'Ki', 'Kd', 'windup', 'sample_time', 'score', 'settle_HeatExF', 'settle_HeatExB', 'overshoot_HeatExF', 'overshoot_HeatExB']
+    print(' '.join('{:>12}'.format(c[:12]) for c in ['rank'] + columns))
+    for rank, row in enumerate(table[:rows], 1):
+        print(' '.join(['{:>12}'.format(rank)] + ['{:>12.4g}'.format(row[c]) for c in columns]))
+
+
+if __name__ == '__main__':
+    # sweep around the Ziegler-Nichols gains currently used in Temperature_Control_Only.py
+    P1 = 0.2*0.6
+    I1 = 1.2*0.2/60
+    D1 = 3*0.2*60/40
+    candidates = grid(Kp=P1 * np.logspace(-1, 2, 10), Ki=I1 * np.logspace(-1, 2, 10), Kd=D1 * np.logspace(-2, 1, 8),
+                      windup=[5.0, 20.0, 80.0], sample_time=[1.0, 2.0])     # below the 1 s loop every tick updates anyway
+    start = time.perf_counter()
+    table = evaluate(candidates, duration=4*3600, loop_time=1.0)
+    print('scored {} candidates in {:.1f} s on {} cores'.format(len(table), time.perf_counter() - start, os.cpu_count()))
+    print_table(table)
+    write_table(table, 'pid_tuning_results.csv')
@@ -0,0 +1,126 @@
+"""
+Radon log parsing with absolute timestamps and time alignment with the cryostat temperature logs.
+
+The RadonEye text export is a short header followed by one 'N)<tab> value' line per reading. The values are pulled
+out of the whole file with one regular expression instead of one np.append per line. RadonEye stores one reading
+per interval (an hour by default) and the export only carries the time it was downloaded, so reading times are
+counted back from that time (or from the date in the file name, e.g. 'radon data 12-1-22 15 11.txt'). Exports
+compressed with gzip ('.txt.gz') are read the same way.
+
+asof_join and window_mean line up radon readings with temperatures, e.g. from LogCatalog.query, using sorted
+searches, so months of data are matched in one vectorized pass.
+"""
+import os
+import re
+from datetime import datetime as dt
+import numpy as np
+import pandas as pd
+from log_rotation import open_log
+
+HEADER_LINES = 6     # header lines at the top of the RadonEye text export
+_VALUE = re.compile(r'^\s*\d+\)\s*([-+0-9.eE]+)', re.MULTILINE)
+_NAME_TIME = re.compile(r'(\d{1,2}-\d{1,2}-\d{2})\s+(\d{1,2})\s+(\d{1,2})')
+
+
+def _header_time(header_lines):
+    # first 'key: YYYY-mm-dd HH:MM' style value in the export header
+    for line in header_lines:
+        key, sep, value = line.partition(':')
+        if sep and 'time' in key.lower():
+            try:
+                return pd.Timestamp(value.strip()).to_pydatetime().timestamp()
+            except ValueError:
+                continue
+    return None
+
+
+def _name_time(file_name):
+    match = _NAME_TIME.search(os.path.basename(file_name))
+    if match is None:
+        return None
+    return dt.strptime('{} {} {}'.format(*match.groups()), '%m-%d-%y %H %M').timestamp()
+
+
+def read_radoneye_txt(path, end_time=None, interval=3600.0):
+    """Returns (epoch times, float32 readings) of a RadonEye text export.
+
+    The last reading is placed at end_time, taken from the export header or the file name when not given,
+    and earlier readings every `interval` seconds before it. Without any of those the times start at 0."""
+    with open_log(path) as f:
+        text = f.read()
+    lines = text.split('\n', HEADER_LINES)
+    values = np.array(_VALUE.findall(lines[-1] if len(lines) > HEADER_LINES else ''), dtype='float32')
+    if end_time is None:
+        end_time = _header_time(lines[:HEADER_LINES])
+    if end_time is None:
+        end_time = _name_time(path)
+    if end_time is None:
+        end_time = (len(values) - 1) * interval
+    elif isinstance(end_time, dt):
+        end_time = end_time.timestamp()
+    times = end_time - interval * np.arange(len(values) - 1, -1, -1, dtype='float64')
+    return times, values
+
+
+def read_radoneye_csv(path, value_column='mCu/l', interval=3600.0, end_time=None):
+    """Returns (epoch times, float32 readings) of a csv radon log.
+    Times come from the first column whose name mentions a date or time, otherwise they are spaced by interval.
+    Times without an offset are local time of their own date, as in read_radoneye_txt."""
+    data = pd.read_csv(path, header=0)
+    values = data[value_column].to_numpy(dtype='float32')
+    time_columns = [c for c in data.columns if 'time' in str(c).lower() or 'date' in str(c).lower()]
+    if time_columns:
+        stamps = pd.to_datetime(data[time_columns[0]])
+        if stamps.dt.tz is None:
+            # datetime.timestamp takes the UTC offset of each date, so readings on both sides of a DST change are right
+            times = np.array([stamp.to_pydatetime().timestamp() for stamp in stamps], dtype='float64')
+        else:
+            # total_seconds does not depend on the resolution pandas parsed to (ns before pandas 2, often us after)
+            times = (stamps - pd.Timestamp(0, tz='UTC')).dt.total_seconds().to_numpy()
+    else:
+        end = end_time if end_time is not None else (len(values) - 1) * interval
+        times = end - interval * np.arange(len(values) - 1, -1, -1, dtype='float64')
+    return times, values
+
+
+def asof_join(left_times, right_times, right_values, tolerance=None, direction='backward'):
+    """For every left time, the right value at the closest right time before it ('backward'), after it ('forward')
+    or on either side ('nearest'). right_times must be sorted and right_values may have extra trailing dimensions.
+    Matches further than tolerance seconds away, or with nothing on the requested side, come back as NaN."""
+    left_times = np.asarray(left_times, dtype='float64')
+    right_times = np.asarray(right_times, dtype='float64')
+    right_values = np.asarray(right_values, dtype='float64')
+    n = len(right_times)
+    if n == 0:
+        return np.full((len(left_times),) + right_values.shape[1:], np.nan)
+    if direction == 'backward':
+        idx = np.searchsorted(right_times, left_times, side='right') - 1
+    elif direction == 'forward':
+        idx = np.searchsorted(right_times, left_times, side='left')
+    elif direction == 'nearest':
+        after = np.clip(np.searchsorted(right_times, left_times, side='left'), 0, n - 1)
+        before = np.clip(after - 1, 0, n - 1)
+        idx = np.where(np.abs(right_times[before] - left_times) <= np.abs(right_times[after] - left_times), before, after)
+    else:
+        raise ValueError('unknown direction {}'.format(direction))
+    valid = (idx >= 0) & (idx < n)
+    safe = np.clip(idx, 0, n - 1)
+    if tolerance is not None:
+        valid &= np.abs(right_times[safe] - left_times) <= tolerance
+    joined = right_values[safe].copy()
+    joined[~valid] = np.nan
+    return joined
+
+
+def window_mean(left_times, right_times, right_values, window=3600.0):
+    """Mean of the right values in (t - window, t] for every left time t, NaN where the window is empty.
+    Suits RadonEye readings, which are averages over the interval ending at their timestamp."""
+    left_times = np.asarray(left_times, dtype='float64')
+    right_times = np.asarray(right_times, dtype='float64')
+    right_values = np.asarray(right_values, dtype='float64')
+    cumulative = np.concatenate([np.zeros((1,) + right_values.shape[1:]), np.cumsum(right_values, axis=0)])
+    hi = np.searchsorted(right_times, left_times, side='right')
+    lo = np.searchsorted(right_times, left_times - window, side='right')
+    count = (hi - lo).reshape((-1,) + (1,) * (right_values.ndim - 1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, (cumulative[hi] - cumulative[lo]) / count, np.nan)
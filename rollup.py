@@ -0,0 +1,227 @@
+"""
+Multi resolution min/mean/max/count rollups of the live temperature channels.
+
+The control loop feeds every sample to RollupStore.add(). Only the finest resolution sees raw samples; whenever one
+of its buckets closes, the bucket is written out and merged into the next coarser resolution, and so on. Each sample
+therefore costs a few array operations no matter how many resolutions are kept. Closed buckets of the resolutions of
+at least min_persisted seconds (60 s by default) are appended to one binlog file per resolution
+(Logs/Rollups/rollup 60s.bin, ...) with columns like 'mean:temp_ch', so dashboards and All_plot style reports memory
+map months of history at a suitable resolution instead of rescanning the raw logs. The finer ones only feed the
+coarser ones and current(): a file of 1 s buckets would grow by ~9 MB a day and never be rotated, and the raw logs
+already hold that detail.
+The records of closed buckets are only queued by add(), a background thread writes and flushes them (as
+log_writer.BackgroundLogWriter does for the csv rows), so a stalled SD card never holds up the control loop.
+"""
+import os
+import queue
+import threading
+import time
+import numpy as np
+from binlog import BinaryLogWriter, read_binlog
+
+RESOLUTIONS = [1, 10, 60, 3600]     # seconds
+MIN_PERSISTED = 60     # seconds, finer resolutions are kept in memory only
+PERSISTED = [r for r in RESOLUTIONS if r >= MIN_PERSISTED]
+STATS = ['min', 'mean', 'max', 'count']
+_STOP = object()
+
+
+def rollup_columns(channels):
+    return ['Rt'] + ['{}:{}'.format(stat, channel) for stat in STATS for channel in channels]
+
+
+class _Level:
+    """Open bucket of one resolution"""
+
+    def __init__(self, resolution, channels):
+        self.resolution = resolution
+        self.start = None
+        self.count = np.zeros(channels)
+        self.total = np.zeros(channels)
+        self.low = np.full(channels, np.inf)
+        self.high = np.full(channels, -np.inf)
+
+    def reset(self, start):
+        self.start = start
+        self.count[:] = 0
+        self.total[:] = 0
+        self.low[:] = np.inf
+        self.high[:] = -np.inf
+
+    def record(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.total / self.count
+        return [self.start] + list(self.low) + list(mean) + list(self.high) + list(self.count)
+
+
+class _RecordWriter:
+    # writes (resolution, record) pairs to their BinaryLogWriter from a thread, flushing every flush_interval.
+    # A full queue drops records (counted), an exception stops the thread and is raised by the next put()
+    def __init__(self, writers, queue_size=10000, flush_interval=1.0):
+        self.writers = writers
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.error = None
+        self._thread = threading.Thread(target=self._run, name='rollup writer', daemon=True)
+        self._thread.start()
+
+    def put(self, resolution, record):
+        if self.error is not None:
+            raise RuntimeError('rollup writer stopped: {!r}'.format(self.error)) from self.error
+        try:
+            self.queue.put_nowait((resolution, record))
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=5.0):
+        """Waits until everything queued so far is written and flushed"""
+        done = threading.Event()
+        if self._thread.is_alive():
+            try:
+                self.queue.put(done, timeout=timeout)
+                done.wait(timeout)
+            except queue.Full:
+                pass
+
+    def close(self, timeout=5.0):
+        if self._thread.is_alive():
+            try:
+                self.queue.put(_STOP, timeout=timeout)
+            except queue.Full:
+                pass
+        self._thread.join(timeout)
+
+    def _run(self):
+        try:
+            last_flush = time.monotonic()
+            while True:
+                try:
+                    item = self.queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    item = None
+                if item is _STOP:
+                    break
+                requested = isinstance(item, threading.Event)     # a flush() waiting for it
+                if isinstance(item, tuple):
+                    self.writers[item[0]].write(item[1])
+                if requested or time.monotonic() - last_flush >= self.flush_interval:
+                    for writer in self.writers.values():
+                        writer.flush()
+                    last_flush = time.monotonic()
+                if requested:
+                    item.set()
+        except Exception as error:
+            self.error = error
+        finally:
+            for writer in self.writers.values():
+                try:
+                    writer.close()
+                except Exception:
+                    pass
+
+
+class RollupStore:
+    """Incrementally maintained rollups of a fixed set of channels, the resolutions of at least min_persisted seconds
+    are written to files unless persist is False"""
+
+    def __init__(self, directory, channels, resolutions=RESOLUTIONS, persist=True, min_persisted=MIN_PERSISTED):
+        resolutions = sorted(resolutions)
+        for fine, coarse in zip(resolutions, resolutions[1:]):
+            if coarse % fine:
+                raise ValueError('every resolution must be a multiple of the previous one')
+        self.directory = directory
+        self.channels = list(channels)
+        self.resolutions = resolutions
+        self.levels = [_Level(r, len(self.channels)) for r in resolutions]
+        self.persisted = [r for r in resolutions if r >= min_persisted] if persist else []
+        self.writers = {}
+        self.writer = None
+        if self.persisted:
+            os.makedirs(directory, exist_ok=True)
+            self.writers = {r: BinaryLogWriter(self.path(r), rollup_columns(self.channels)) for r in self.persisted}
+            self.writer = _RecordWriter(self.writers)
+
+    def path(self, resolution):
+        return os.path.join(self.directory, 'rollup {}s.bin'.format(resolution))
+
+    def add(self, time_stamp, values):
+        """Adds one sample (epoch time, one value per channel)"""
+        level = self.levels[0]
+        start = time_stamp - time_stamp % level.resolution
+        if level.start != start:
+            self._close(0, start)
+        values = np.asarray(values, dtype='float64')
+        level.count += 1
+        level.total += values
+        np.minimum(level.low, values, out=level.low)
+        np.maximum(level.high, values, out=level.high)
+
+    def _close(self, k, new_start):
+        # writes out the open bucket of level k, merges it into level k+1 and opens a bucket at new_start
+        level = self.levels[k]
+        if level.start is not None and level.count.any():
+            if level.resolution in self.writers:
+                self.writer.put(level.resolution, level.record())
+            if k + 1 < len(self.levels):
+                parent = self.levels[k + 1]
+                parent_start = level.start - level.start % parent.resolution
+                if parent.start != parent_start:
+                    self._close(k + 1, parent_start)
+                parent.count += level.count
+                parent.total += level.total
+                np.minimum(parent.low, level.low, out=parent.low)
+                np.maximum(parent.high, level.high, out=parent.high)
+        level.reset(new_start)
+
+    def current(self, resolution):
+        """The still open bucket of a resolution as {stat: per channel array}"""
+        level = self.levels[self.resolutions.index(resolution)]
+        record = level.record()[1:]
+        n = len(self.channels)
+        return {'start': level.start, **{stat: np.array(record[k * n:(k + 1) * n]) for k, stat in enumerate(STATS)}}
+
+    def flush(self):
+        """Waits until every closed bucket is written to the files"""
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close(self):
+        """Writes out every open bucket and closes the files"""
+        for k in range(len(self.levels)):
+            self._close(k, None)
+        if self.writer is not None:
+            self.writer.close()
+
+    def query(self, start=None, end=None, max_points=2000):
+        """Records between start and end (epoch seconds) at the finest persisted resolution giving at most max_points
+        buckets. Returns (resolution, structured array), the array is a memory mapped slice of the rollup file."""
+        self.flush()
+        return read_range(self.directory, start, end, max_points, self.persisted)
+
+
+def read_range(directory, start=None, end=None, max_points=2000, resolutions=PERSISTED):
+    """Same as RollupStore.query for a process that only reads the rollup files, e.g. a report or dashboard"""
+    for resolution in sorted(resolutions):
+        path = os.path.join(directory, 'rollup {}s.bin'.format(resolution))
+        if not os.path.exists(path):
+            continue
+        records, _ = read_binlog(path)
+        lo = 0 if start is None else np.searchsorted(records['Rt'], start, side='left')
+        hi = len(records) if end is None else np.searchsorted(records['Rt'], end, side='right')
+        if hi - lo <= max_points or resolution == max(resolutions):
+            return resolution, records[lo:hi]
+    return None, None
+
+
+if __name__ == '__main__':
+    from datetime import datetime as dt
+    ROOT_DIR = os.path.realpath(os.path.join(os.path.dirname("rollup.py")))
+    resolution, records = read_range(os.path.join(ROOT_DIR, 'Logs', 'Rollups'), max_points=48)
+    if records is None:
+        print('no rollups yet')
+    else:
+        print('{} buckets of {} s'.format(len(records), resolution))
+        for record in records:
+            print(dt.fromtimestamp(record['Rt']), ' '.join('{}={:.2f}'.format(name, record[name])
+                                                          for name in records.dtype.names if name.startswith('mean:')))
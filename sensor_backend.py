@@ -0,0 +1,490 @@
+"""
+Pluggable sensor and actuator backends for the control scripts.
+
+The scripts ask a backend for their MAX31856 thermocouples, MAX31865 PT100s and relay outputs by name and pin,
+and take their clocks from it, instead of importing board/digitalio/adafruit at module top:
+
+    HardwareBackend   the Pi, board, digitalio and the adafruit drivers are imported on first use
+    RecordingBackend  wraps another backend and writes every raw reading, the time each SPI call took, one shot
+                      conversion start/ready times and every relay write to a binary recording (binlog format)
+    ReplayBackend     feeds a recording back, each channel gets exactly its recorded values in order. With
+                      pace='recorded' the SPI call, conversion and loop sleep times are slept through; with
+                      pace='fast' nothing sleeps, so hours of loop run in seconds
+    FakeBackend       FakeMAX31856/FakeMAX31865 stand ins, for trying things out without any recording
+
+The control scripts pick one from the SLOWCONTROL_BACKEND environment variable, see backend_from_env(). PID
+updates and the loop scheduler take their time from backend.time()/backend.monotonic(), and those readings are
+recorded too, so a replay (at either pace) makes exactly the controller decisions of the recorded run. That is
+what loop throughput, logging cost and PID behavior are regression tested against on any Linux box. A replayed
+loop has to ask the backend for the time as often as the recorded one did.
+
+Only the Pi (also while it is recorded) writes to the stand's Logs/. output_directory() gives any other backend a
+fresh directory per run under Logs/Replay/, so logs, rollups, metrics and interlock events of a replayed or fake run
+never end up in the stand's history. SLOWCONTROL_LOGS sets the directory explicitly.
+"""
+import os
+import time
+import numpy as np
+from datetime import datetime as dt
+from acquisition import FakeMAX31856
+from binlog import BinaryLogWriter, read_binlog
+
+# pin assignments of the stands
+THERMOCOUPLE_PINS = {'ColdHead': 'D13', 'HeatExF': 'D16', 'HeatExB': 'D25', 'Chamber': 'D26'}     # Temperature Control Only
+HEATER_PINS = {'HeaterF': 'D17', 'HeaterB': 'D18'}
+PT100_PINS = {'Tip': 'D16', 'Ceramic': 'D21', 'Flange': 'D19'}     # CryoProbe
+RELAY_PINS = {'Relay': 'D17'}
+
+# recording events
+START, READY, TEMPERATURE, RESISTANCE, WRITE, WALL_CLOCK, MONOTONIC_CLOCK = range(7)
+CLOCK_CHANNEL = 255     # channel number of the clock readings
+RECORD_COLUMNS = ['t', 'value', 'cost', 'channel', 'event']
+RECORD_DTYPE = np.dtype([('t', '<f8'), ('value', '<f8'), ('cost', '<f4'), ('channel', 'u1'), ('event', 'u1')])
+
+
+class EndOfReplay(Exception):
+    """A replayed channel ran out of recorded readings"""
+
+
+class Backend:
+    """Real time clocks, shared by every backend that runs on the wall clock"""
+    hardware = False     # whether readings come from the stand itself, see output_directory()
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def close(self):
+        pass
+
+
+class HardwareBackend(Backend):
+    """The MAX31856/MAX31865 boards and relays on the Pi's SPI bus and GPIO pins"""
+    hardware = True
+
+    def __init__(self):
+        import board     # only importable on the Pi
+        import digitalio
+        self.board = board
+        self.digitalio = digitalio
+        self._spi = None
+
+    def _pin(self, pin, output=False):
+        io = self.digitalio.DigitalInOut(getattr(self.board, pin))
+        if output:
+            io.direction = self.digitalio.Direction.OUTPUT
+        return io
+
+    @property
+    def spi(self):
+        if self._spi is None:
+            self._spi = self.board.SPI()
+        return self._spi
+
+    def max31856(self, pins, thermocouple_type='T'):
+        import adafruit_max31856
+        kind = getattr(adafruit_max31856.ThermocoupleType, thermocouple_type)
+        return {name: adafruit_max31856.MAX31856(self.spi, self._pin(pin, output=True), thermocouple_type=kind)
+                for name, pin in pins.items()}
+
+    def max31865(self, pins, wires=2):
+        import adafruit_max31865
+        return {name: adafruit_max31865.MAX31865(self.spi, self._pin(pin), wires=wires) for name, pin in pins.items()}
+
+    def outputs(self, pins):
+        return {name: self._pin(pin, output=True) for name, pin in pins.items()}
+
+
+class Output:
+    """Relay or heater pin without hardware behind it"""
+
+    def __init__(self, value=False):
+        self.value = value
+
+
+class FakeMAX31865:
+    """Stand in for adafruit_max31865.MAX31865, temperature is a number or a function of time"""
+
+    def __init__(self, temperature=20.0, R0=100.0):
+        self.temperature_source = temperature
+        self.R0 = R0
+
+    @property
+    def temperature(self):
+        source = self.temperature_source
+        return source(time.time()) if callable(source) else source
+
+    @property
+    def resistance(self):
+        from calibration import CallendarVanDusen
+        return float(CallendarVanDusen(self.R0).resistance(self.temperature))
+
+
+class FakeBackend(Backend):
+    """Fake sensors, temperatures maps a channel name to a number or a function of time"""
+
+    def __init__(self, temperatures=None, conversion_time=0.16, spi_time=0.0002):
+        self.temperatures = temperatures or {}
+        self.conversion_time = conversion_time
+        self.spi_time = spi_time
+
+    def max31856(self, pins, thermocouple_type='T'):
+        return {name: FakeMAX31856(self.temperatures.get(name, 20.0), self.conversion_time, self.spi_time) for name in pins}
+
+    def max31865(self, pins, wires=2):
+        return {name: FakeMAX31865(self.temperatures.get(name, 20.0)) for name in pins}
+
+    def outputs(self, pins):
+        return {name: Output() for name in pins}
+
+
+class _RecordedSensor:
+    """Passes every call through to the real sensor and records what came back and how long it took"""
+
+    def __init__(self, recorder, channel, sensor):
+        self._recorder = recorder
+        self._channel = channel
+        self._sensor = sensor
+        self._converting = False
+
+    def __getattr__(self, name):
+        return getattr(self._sensor, name)
+
+    def _timed(self, event, call):
+        start = time.monotonic()
+        value = call()
+        self._recorder.record(start, self._channel, event, value, time.monotonic() - start)
+        return value
+
+    def initiate_one_shot_measurement(self):
+        self._converting = True
+        self._timed(START, lambda: self._sensor.initiate_one_shot_measurement() or 0.0)
+
+    @property
+    def oneshot_pending(self):
+        pending = self._sensor.oneshot_pending
+        if not pending and self._converting:     # only the first poll that finds the conversion done is kept
+            self._converting = False
+            self._recorder.record(time.monotonic(), self._channel, READY, 0.0, 0.0)
+        return pending
+
+    def unpack_temperature(self):
+        return self._timed(TEMPERATURE, self._sensor.unpack_temperature)
+
+    @property
+    def temperature(self):
+        return self._timed(TEMPERATURE, lambda: self._sensor.temperature)
+
+    @property
+    def resistance(self):
+        return self._timed(RESISTANCE, lambda: self._sensor.resistance)
+
+
+class _RecordedOutput:
+
+    def __init__(self, recorder, channel, output):
+        self._recorder = recorder
+        self._channel = channel
+        self._output = output
+
+    @property
+    def value(self):
+        return self._output.value
+
+    @value.setter
+    def value(self, value):
+        self._output.value = value
+        self._recorder.record(time.monotonic(), self._channel, WRITE, float(value), 0.0)
+
+
+class RecordingBackend(Backend):
+    """Records everything read from and written to another backend.
+
+    The file is created on the first recorded event, so every sensor and output has to be created before the
+    loop starts (as the scripts do)."""
+
+    def __init__(self, inner, path):
+        self.inner = inner
+        self.path = path
+        self.channels = []
+        self.kinds = {}
+        self.writer = None
+        self.start = time.monotonic()
+        self.wall_start = time.time()
+        self.hardware = inner.hardware
+
+    def _add(self, wrap, objects, kind):
+        wrapped = {}
+        for name, obj in objects.items():
+            if self.writer is not None:
+                raise RuntimeError('create every sensor before recording starts')
+            self.channels.append(name)
+            self.kinds[name] = kind
+            wrapped[name] = wrap(self, len(self.channels) - 1, obj)
+        return wrapped
+
+    def max31856(self, pins, thermocouple_type='T'):
+        return self._add(_RecordedSensor, self.inner.max31856(pins, thermocouple_type), 'max31856')
+
+    def max31865(self, pins, wires=2):
+        return self._add(_RecordedSensor, self.inner.max31865(pins, wires), 'max31865')
+
+    def outputs(self, pins):
+        return self._add(_RecordedOutput, self.inner.outputs(pins), 'output')
+
+    def record(self, when, channel, event, value, cost):
+        if self.writer is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            meta = {'channels': self.channels, 'kinds': self.kinds, 'wall_start': self.wall_start}
+            self.writer = BinaryLogWriter(self.path, RECORD_COLUMNS, RECORD_DTYPE, meta)
+        self.writer.write((when - self.start, value, cost, channel, event))
+
+    def time(self):
+        now = self.inner.time()
+        self.record(time.monotonic(), CLOCK_CHANNEL, WALL_CLOCK, now, 0.0)
+        return now
+
+    def monotonic(self):
+        now = self.inner.monotonic()
+        self.record(now, CLOCK_CHANNEL, MONOTONIC_CLOCK, now, 0.0)
+        return now
+
+    def sleep(self, seconds):
+        self.inner.sleep(seconds)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.inner.close()
+
+
+class _ReplayedSensor:
+
+    def __init__(self, backend, channel):
+        self._backend = backend
+        self._channel = channel
+        self._stream = backend.stream(channel)
+        self._conversions = backend.conversion_times(channel)
+        self._conversion = 0
+        self._done_at = None
+
+    def _next(self, event):
+        return self._stream.next(event, self._backend.channels[self._channel])
+
+    def initiate_one_shot_measurement(self):
+        self._next(START)
+        duration = self._conversions[self._conversion] if self._conversion < len(self._conversions) else 0.0
+        self._conversion += 1
+        self._done_at = time.monotonic() + duration
+
+    @property
+    def oneshot_pending(self):
+        # the conversion takes its recorded time at recorded pace and none at all when fast
+        if self._backend.fast or self._done_at is None:
+            return False
+        return time.monotonic() < self._done_at
+
+    def _wait_for_oneshot(self):
+        while self.oneshot_pending:
+            time.sleep(0.01)
+
+    def unpack_temperature(self):
+        return self._next(TEMPERATURE)
+
+    @property
+    def temperature(self):
+        return self._next(TEMPERATURE)
+
+    @property
+    def resistance(self):
+        return self._next(RESISTANCE)
+
+
+class _Stream:
+    """Recorded values and call times of one channel, handed out in order per event type"""
+
+    def __init__(self, backend, records):
+        self.backend = backend
+        self.values = {}
+        for event in np.unique(records['event']):
+            mine = records[records['event'] == event]
+            self.values[event] = (mine['value'].tolist(), mine['cost'].tolist())
+        self.position = {event: 0 for event in self.values}
+
+    def next(self, event, name):
+        values, costs = self.values.get(event, ([], []))
+        k = self.position.get(event, 0)
+        if k >= len(values):
+            raise EndOfReplay('{} has no more recorded readings'.format(name))
+        self.position[event] = k + 1
+        self.backend.spend(costs[k])
+        return values[k]
+
+
+class _ReplayedOutput:
+
+    def __init__(self, backend, name):
+        self._backend = backend
+        self._name = name
+        self._value = False
+
+    @property
+    def value(self):
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+        self._backend.writes[self._name].append(bool(value))
+
+
+class ReplayBackend(Backend):
+    """Feeds a recording back to the control loop. pace is 'recorded' or 'fast'"""
+
+    def __init__(self, path, pace='recorded'):
+        if pace not in ('recorded', 'fast'):
+            raise ValueError('pace must be recorded or fast')
+        self.records, header = read_binlog(path)
+        self.channels = header['meta']['channels']
+        self.kinds = header['meta']['kinds']
+        self.fast = pace == 'fast'
+        self.clocks = self.stream(CLOCK_CHANNEL)
+        self.writes = {name: [] for name, kind in self.kinds.items() if kind == 'output'}
+
+    def stream(self, channel):
+        return _Stream(self, self.records[self.records['channel'] == channel])
+
+    def conversion_times(self, channel):
+        """Start to ready time of every recorded one shot conversion of a channel"""
+        mine = self.records[(self.records['channel'] == channel) & np.isin(self.records['event'], [START, READY])]
+        times, events = mine['t'], mine['event']
+        starts = np.flatnonzero(events == START)
+        follows = starts + 1
+        ok = follows < len(events)
+        ready = np.zeros(len(starts), dtype='bool')
+        ready[ok] = events[follows[ok]] == READY
+        durations = np.zeros(len(starts))
+        durations[ready] = times[follows[ready]] - times[starts[ready]]
+        return durations.tolist()
+
+    def recorded_writes(self, name):
+        """Values written to an output during the recording, to compare against self.writes"""
+        k = self.channels.index(name)
+        mine = self.records[(self.records['channel'] == k) & (self.records['event'] == WRITE)]
+        return [bool(v) for v in mine['value']]
+
+    def _check(self, name, kind):
+        if self.kinds.get(name) != kind:
+            raise KeyError('{} was not recorded as a {}'.format(name, kind))
+        return self.channels.index(name)
+
+    def max31856(self, pins, thermocouple_type='T'):
+        return {name: _ReplayedSensor(self, self._check(name, 'max31856')) for name in pins}
+
+    def max31865(self, pins, wires=2):
+        return {name: _ReplayedSensor(self, self._check(name, 'max31865')) for name in pins}
+
+    def outputs(self, pins):
+        for name in pins:
+            self._check(name, 'output')
+        return {name: _ReplayedOutput(self, name) for name in pins}
+
+    def spend(self, seconds):
+        """Time a replayed call took when recorded, slept through at recorded pace only"""
+        if seconds > 0 and not self.fast:
+            time.sleep(seconds)
+
+    def sleep(self, seconds):
+        self.spend(seconds)
+
+    def monotonic(self):
+        return self.clocks.next(MONOTONIC_CLOCK, 'monotonic clock')
+
+    def time(self):
+        return self.clocks.next(WALL_CLOCK, 'wall clock')
+
+
+def recording_name():
+    return dt.now().strftime('Recording %m-%d-%Y, %H-%M.bin')
+
+
+def output_directory(backend, logs_dir, variable='SLOWCONTROL_LOGS'):
+    """Directory for the logs, rollups, metrics and interlock events of a run: the variable if it is set, logs_dir for
+    a hardware backend, otherwise a new 'Run MM-DD-YYYY, HH-MM-SS' directory under logs_dir/Replay. It is created."""
+    directory = os.environ.get(variable)
+    if not directory:
+        directory = logs_dir if backend.hardware else os.path.join(logs_dir, 'Replay', dt.now().strftime('Run %m-%d-%Y, %H-%M-%S'))
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def backend_from_env(recordings_dir, variable='SLOWCONTROL_BACKEND'):
+    """Backend chosen by an environment variable:
+        unset or 'hardware'          the Pi
+        'record' or 'record:FILE'    the Pi, recorded to FILE (default: a new file in recordings_dir)
+        'replay:FILE'                FILE at recorded pace
+        'replay-fast:FILE'           FILE as fast as possible
+        'fake'                       FakeBackend"""
+    choice = os.environ.get(variable, 'hardware')
+    kind, _, path = choice.partition(':')
+    if kind == 'hardware':
+        return HardwareBackend()
+    if kind == 'record':
+        return RecordingBackend(HardwareBackend(), path or os.path.join(recordings_dir, recording_name()))
+    if kind in ('replay', 'replay-fast'):
+        return ReplayBackend(path, 'fast' if kind == 'replay-fast' else 'recorded')
+    if kind == 'fake':
+        return FakeBackend()
+    raise ValueError('unknown {} {}'.format(variable, choice))
+
+
+if __name__ == '__main__':
+    # record a short run of a fake stand, then replay it at recorded pace and as fast as possible
+    import PID
+    from acquisition import OneShotScheduler
+    from loop_scheduler import DeadlineScheduler, SKIP
+
+    def run(backend, cycles=None):
+        sensors = backend.max31856(THERMOCOUPLE_PINS)
+        heater = backend.outputs({'HeaterF': 'D17'})['HeaterF']
+        acquisition = OneShotScheduler(sensors)
+        controller = PID.PID(0.12, 0.004, 0.9, backend.time())
+        controller.SetPoint = 20.0
+        controller.setSampleTime(0.5)
+        timer = DeadlineScheduler(0.25, overrun=SKIP, clock=backend.monotonic, sleep=backend.sleep)
+        outputs, k = [], 0
+        try:
+            while cycles is None or k < cycles:
+                readings = acquisition.read()
+                controller.update(readings['HeatExF'], backend.time())
+                heater.value = controller.output > 0
+                outputs.append(controller.output)
+                timer.wait()
+                k += 1
+        except EndOfReplay:
+            pass
+        return outputs
+
+    path = '/tmp/sensor_backend_demo.bin'
+    if os.path.exists(path):
+        os.remove(path)
+    t0 = time.time()
+    fake = FakeBackend({'HeatExF': lambda t: 20 + 2 * np.sin((t - t0) / 2)}, conversion_time=0.05)
+    recorder = RecordingBackend(fake, path)
+    start = time.perf_counter()
+    recorded = run(recorder, cycles=40)
+    recorder.close()
+    print('recorded {} loops in {:.2f} s'.format(len(recorded), time.perf_counter() - start))
+    for pace in ['recorded', 'fast']:
+        replay = ReplayBackend(path, pace)
+        start = time.perf_counter()
+        replayed = run(replay)
+        print('{:>8} replay: {} loops in {:.3f} s, PID outputs identical: {}, heater writes identical: {}'.format(
+            pace, len(replayed), time.perf_counter() - start, np.allclose(replayed, recorded),
+            replay.writes['HeaterF'] == replay.recorded_writes('HeaterF')))
@@ -0,0 +1,183 @@
+"""
+Concurrent line reader for the Arduino serial ports of the serial stand (TemperatureControl.py).
+
+Every port gets its own reader thread that pulls whatever bytes are waiting, reassembles complete lines and parses
+them. Only the newest valid value of a bulk read is kept, so a backlog in the OS buffer is skipped instead of being
+worked through one stale line per loop, and a partial or garbled line is counted and dropped instead of raising.
+The first line after the reader starts, after a read error and after an overlong run is always dropped: it is
+usually the tail of a line that was cut off ('5.3' of '35.3') and would still parse.
+The control loop reads the latest-value cache, which is a dict lookup, and gets None for a port that has gone
+quiet for longer than `stale_after` seconds, so a slow or silent port never stalls the other one.
+
+Ports only need read(size) (and optionally in_waiting), e.g. serial.Serial(..., timeout=0.1); the timeout lets
+the threads notice stop(). FdPort and pty_port() wrap a pseudo terminal so the reader can be exercised without
+an Arduino, see the demo at the bottom.
+"""
+import os
+import select
+import threading
+import time
+from collections import namedtuple
+
+Reading = namedtuple('Reading', ['value', 'time', 'count'])     # time is time.monotonic() of the read
+
+
+class SerialReader:
+    """Reads a dict of {name: port} concurrently into a latest-value cache"""
+
+    def __init__(self, ports, stale_after=2.0, chunk=4096, max_line=256, retry=1.0, parse=float):
+        self.ports = dict(ports)
+        self.stale_after = stale_after
+        self.chunk = chunk     # bytes per read for ports that cannot tell how much is waiting
+        self.max_line = max_line     # a longer run without a newline is noise, drop it
+        self.retry = retry     # seconds to wait after a read error
+        self.parse = parse
+        self.cache = {}
+        self.counters = {name: {'bytes': 0, 'lines': 0, 'bad_lines': 0, 'skipped': 0, 'errors': 0} for name in self.ports}
+        self.last_error = {}
+        self.ready = {name: threading.Event() for name in self.ports}
+        self.running = threading.Event()
+        self.threads = []
+
+    def start(self):
+        self.running.set()
+        for name, port in self.ports.items():
+            thread = threading.Thread(target=self._service, args=(name, port), name='serial ' + name, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self, timeout=1.0):
+        self.running.clear()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def _service(self, name, port):
+        counters = self.counters[name]
+        pending = bytearray()
+        synced = False     # whether pending starts at the beginning of a line
+        sized = hasattr(port, 'in_waiting')
+        while self.running.is_set():
+            try:
+                data = port.read(max(1, port.in_waiting) if sized else self.chunk)
+            except (OSError, ValueError) as error:     # unplugged, closed or reset port
+                counters['errors'] += 1
+                self.last_error[name] = (time.monotonic(), repr(error))
+                pending.clear()
+                synced = False
+                time.sleep(self.retry)
+                continue
+            if not data:     # read timed out
+                continue
+            counters['bytes'] += len(data)
+            pending += data
+            if b'\n' not in data:
+                if len(pending) > self.max_line:
+                    counters['bad_lines'] += 1
+                    pending.clear()
+                    synced = False
+                continue
+            *lines, rest = pending.split(b'\n')
+            pending = bytearray(rest)
+            if not synced:     # the part of a line before the first newline
+                synced = True
+                if lines.pop(0).strip():
+                    counters['bad_lines'] += 1
+            self._store(name, lines, counters)
+
+    def _store(self, name, lines, counters):
+        # newest parsable line wins, the ones before it are backlog
+        for k in range(len(lines) - 1, -1, -1):
+            text = lines[k].strip()
+            if not text:
+                continue
+            try:
+                value = self.parse(text)
+            except ValueError:
+                counters['bad_lines'] += 1
+                continue
+            previous = self.cache.get(name)
+            self.cache[name] = Reading(value, time.monotonic(), previous.count + 1 if previous else 1)
+            self.ready[name].set()
+            counters['lines'] += 1
+            counters['skipped'] += sum(1 for line in lines[:k] if line.strip())
+            return
+
+    def latest(self, name):
+        """Newest Reading of a port, None before the first one"""
+        return self.cache.get(name)
+
+    def value(self, name, max_age=None):
+        """Newest value of a port, None if there is none or it is older than max_age (default stale_after)"""
+        reading = self.cache.get(name)
+        max_age = self.stale_after if max_age is None else max_age
+        if reading is None or time.monotonic() - reading.time > max_age:
+            return None
+        return reading.value
+
+    def stale(self):
+        """Names of the ports without a reading younger than stale_after"""
+        return [name for name in self.ports if self.value(name) is None]
+
+    def wait_ready(self, timeout=None):
+        """Blocks until every port delivered a first value, returns False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for event in self.ready.values():
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if not event.wait(remaining):
+                return False
+        return True
+
+    def stats(self):
+        return {name: dict(c, age=None if name not in self.cache else time.monotonic() - self.cache[name].time)
+                for name, c in self.counters.items()}
+
+
+class FdPort:
+    """Minimal port on a file descriptor, e.g. the slave side of a pty"""
+
+    def __init__(self, fd, timeout=0.1):
+        self.fd = fd
+        self.timeout = timeout
+
+    def read(self, size):
+        readable, _, _ = select.select([self.fd], [], [], self.timeout)
+        return os.read(self.fd, size) if readable else b''
+
+    def close(self):
+        os.close(self.fd)
+
+
+def pty_port(timeout=0.1):
+    """Returns (master fd, FdPort), bytes written to the master fd come out of the port as from a serial device"""
+    import tty
+    master, slave = os.openpty()
+    tty.setraw(slave)     # no echo or newline translation, like a serial line
+    return master, FdPort(slave, timeout)
+
+
+if __name__ == '__main__':
+    # two fake Arduinos: a fast one sending bursts with partial and garbled lines, and one that goes silent
+    fast_master, fast_port = pty_port()
+    slow_master, slow_port = pty_port()
+    reader = SerialReader({'heatexchanger': fast_port, 'coldhead': slow_port}, stale_after=0.5).start()
+
+    def arduino(fd, period, count):
+        for i in range(count):
+            os.write(fd, '{:.2f}\n'.format(20 + i * 0.01).encode())
+            if i % 10 == 0:
+                os.write(fd, b'12.3')     # line split across two writes
+                time.sleep(period / 2)
+                os.write(fd, b'4\n1x.5\n')     # and a garbled one
+            time.sleep(period)
+
+    threading.Thread(target=arduino, args=(fast_master, 0.01, 300), daemon=True).start()
+    threading.Thread(target=arduino, args=(slow_master, 0.1, 10), daemon=True).start()
+    print('ready:', reader.wait_ready(2.0))
+    for _ in range(8):
+        time.sleep(0.5)
+        print({name: reader.value(name) for name in reader.ports}, 'stale:', reader.stale())
+    reader.stop()
+    for name, counters in reader.stats().items():
+        print(name, counters)
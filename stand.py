@@ -0,0 +1,362 @@
+"""
+Config driven runtime for a slow control stand.
+
+Instead of one script per stand with hard coded pins, channels, setpoints and a single loop rate, a stand is
+described in a json file (see stands/) and run with
+
+    python stand.py stands/temperature_control.json
+    SLOWCONTROL_BACKEND=fake python stand.py stands/cryoprobe.json --duration 60
+
+The description has these sections, every one but sensors optional:
+
+    sensors      name: {type max31856|max31865, pin, period, calibration (channel ID in calibrations.json, default
+                 the name), thermocouple_type, conversion_time, wires, quantity temperature|resistance}
+    outputs      name: {pin, on_status, off_status}, the status is what gets logged (the scripts used 1/0 and 11/10)
+    controllers  name: {input sensor, output, setpoint, P, I, D, period, sample_time, stale_after, manual}
+    logs         name: {columns {log column: channel}, period, average, directory, prefix, rollups,
+                 compress gzip|zstd|null for closed log files, default gzip}
+    interlocks   {set (rule set of interlocks.json) and channels {rule channel: stand channel}, or rules [...] on the
+                 stand's channel names, period, events (text file of rule changes)}
+    telemetry    {port, host, period}, SLOWCONTROL_TELEMETRY_PORT/_HOST override them. A port that cannot be bound
+                 only turns telemetry off
+    metrics      {path, interval}
+    calibrations path of the calibrations file
+
+Relative paths are taken from the repository root, where the scripts keep Logs/ and calibrations.json. Logs, rollups,
+metrics and interlock events of a replayed or fake run go to a run directory under Logs/Replay/ instead (see
+sensor_backend.output_directory), paths under Logs/ keep their place inside it.
+
+Every sensor, controller, log group and the telemetry feed is a task with its own period on one
+loop_scheduler.MultiRateScheduler, so each runs at its natural rate. A MAX31856 task starts a one shot conversion
+and a one-off task collects it conversion_time later, so the thread is free while the chip converts. MAX31865 reads
+block inside the driver and run on a single worker thread (which also serializes them on the SPI bus); the reading
+lands in the channel table when it is done. Calibrated readings, controller outputs and output states all live in
+one table of latest values, which is what controllers, log groups and telemetry read.
+
+A controller whose input is older than stale_after turns its output off. The interlock rules (see interlock.py) are
+checked on the channel table every interlocks period, before the controllers of the same tick; a trip turns every
+output off and keeps the controllers from turning them back on. Any exception, Ctrl-C or the end of a replay turns
+every output off before the logs are closed.
+"""
+import argparse
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime as dt
+import numpy as np
+import PID
+from calibration import load_registry, DEFAULT_PATH
+from instrumentation import Instruments, MetricsExporter
+from interlock import InterlockEngine, EventLog, load_rules, rename_channels, DEFAULT_PATH as INTERLOCKS_PATH
+from log_writer import BackgroundLogWriter
+from loop_scheduler import MultiRateScheduler
+from rollup import RollupStore
+from sensor_backend import backend_from_env, output_directory, EndOfReplay
+from telemetry import TelemetryBuffer, start_telemetry, DEFAULT_HOST, DEFAULT_PORT
+
+ROOT_DIR = os.path.dirname(os.path.realpath(__file__))
+CONVERSION_TIME = 0.16     # MAX31856 one shot conversion, 1 sample averaging
+POLL_INTERVAL = 0.005     # how often a conversion that is not ready yet is polled again
+# priorities when deadlines tie: readings first, then the interlocks and controllers using them, then logs and telemetry
+SENSOR, INTERLOCK, CONTROLLER, LOG, TELEMETRY = range(5)
+
+
+def load_stand(path):
+    with open(path, encoding='utf8') as f:
+        return json.load(f)
+
+
+class Channels:
+    """Latest value and monotonic time of every named channel"""
+
+    def __init__(self, names, clock):
+        self.names = list(names)
+        self.clock = clock
+        self.values = {name: float('nan') for name in self.names}
+        self.times = {name: None for name in self.names}
+
+    def set(self, name, value):
+        self.values[name] = value
+        self.times[name] = self.clock()
+
+    def get(self, name, max_age=None):
+        """Latest value, None if there is none yet or it is older than max_age seconds"""
+        updated = self.times[name]
+        if updated is None or (max_age is not None and self.clock() - updated > max_age):
+            return None
+        return self.values[name]
+
+    def row(self, names):
+        return [self.values[name] for name in names]
+
+
+class _LogGroup:
+    # samples its columns every period and writes the mean of every `average` samples (last value for outputs),
+    # a sensor without a reading yet leaves its samples out of the mean
+    def __init__(self, name, spec, stand):
+        self.name = name
+        self.columns = list(spec['columns'])
+        self.sources = [spec['columns'][c] for c in self.columns]
+        self.average = spec.get('average', 1)
+        self.averaged = np.array([source in stand.sensors for source in self.sources])
+        self.sums = np.zeros(len(self.columns))
+        self.counts = np.zeros(len(self.columns))
+        self.samples = 0
+        self.stand = stand
+        directory = stand.output_path(spec.get('directory', 'Logs'))
+        os.makedirs(directory, exist_ok=True)
+        prefix = spec.get('prefix')
+        namer = {} if prefix is None else {
+            'file_namer': lambda: '{} {}.csv'.format(prefix, dt.now().strftime('%m-%d-%Y, %H-%M'))}
+        self.writer = BackgroundLogWriter(directory, ['Rt'] + self.columns, compress=spec.get('compress', 'gzip'), **namer)
+        self.rollups = None
+        if spec.get('rollups'):
+            self.rollups = RollupStore(stand.output_path(spec['rollups']), self.columns)
+
+    def sample(self):
+        latest = self.stand.channels.row(self.sources)
+        values = np.array(latest, dtype='float64')
+        now = self.stand.backend.time()
+        if self.rollups is not None:
+            self.rollups.add(now, values)
+        valid = values == values
+        self.sums[valid] += values[valid]
+        self.counts += valid
+        self.samples += 1
+        if self.samples >= self.average:
+            with np.errstate(invalid='ignore'):
+                means = (self.sums / self.counts).tolist()
+            row = [mean if averaged else value for mean, averaged, value in zip(means, self.averaged, latest)]
+            self.writer.log([dt.fromtimestamp(now).strftime('%H:%M:%S')] + row)
+            self.sums[:] = 0
+            self.counts[:] = 0
+            self.samples = 0
+
+    def close(self):
+        self.writer.close()
+        if self.rollups is not None:
+            self.rollups.close()
+
+
+class Stand:
+    """A stand built from its description, run() runs it until stopped"""
+
+    def __init__(self, config, backend, instruments=None):
+        self.config = config
+        self.backend = backend
+        self.base_dir = config.get('base_dir', ROOT_DIR)
+        self.output_dir = output_directory(backend, self.path('Logs'))
+        self.instruments = instruments if instruments is not None else Instruments()
+        self.scheduler = MultiRateScheduler(clock=backend.monotonic, sleep=backend.sleep, instruments=self.instruments)
+        self.registry = load_registry(self.path(config['calibrations']) if 'calibrations' in config else DEFAULT_PATH)
+        self.sensors = dict(config['sensors'])
+        self.outputs_spec = dict(config.get('outputs', {}))
+        self.controllers_spec = dict(config.get('controllers', {}))
+        names = list(self.sensors) + list(self.outputs_spec) + [name + ' MV' for name in self.controllers_spec]
+        self.channels = Channels(names, backend.monotonic)
+        self.worker = None     # thread for blocking sensor reads, made when a sensor needs it
+        self.errors = []     # exceptions raised on the worker thread, re-raised on the scheduler thread
+        self.devices = self._make_sensors()
+        self.outputs = self._make_outputs()
+        self.controllers = {}
+        self.interlocks = None
+        self.log_groups = []
+        self.telemetry_buffer = None
+        self.telemetry = None     # the server, started by run()
+        self.metrics = None
+        self._schedule()
+
+    def path(self, relative):
+        return os.path.join(self.base_dir, relative)
+
+    def output_path(self, relative):
+        """Path of a log, rollup, metrics or events file, moved into output_dir unless that is Logs/ itself"""
+        path = self.path(relative)
+        logs = self.path('Logs')
+        if self.output_dir == logs:
+            return path
+        inside = os.path.relpath(path, logs)
+        return os.path.join(self.output_dir, relative if inside.startswith(os.pardir) else inside)
+
+    # building
+
+    def _make_sensors(self):
+        devices = {}
+        for name, spec in self.sensors.items():
+            kind = spec.get('type')
+            if kind == 'max31856':
+                devices.update(self.backend.max31856({name: spec['pin']}, spec.get('thermocouple_type', 'T')))
+            elif kind == 'max31865':
+                devices.update(self.backend.max31865({name: spec['pin']}, spec.get('wires', 2)))
+            else:
+                raise ValueError('sensor {} has unknown type {!r}'.format(name, kind))
+        return devices
+
+    def _make_outputs(self):
+        outputs = self.backend.outputs({name: spec['pin'] for name, spec in self.outputs_spec.items()})
+        for name in outputs:
+            self._set_output(name, False, outputs)
+        return outputs
+
+    def _set_output(self, name, on, outputs=None):
+        (outputs or self.outputs)[name].value = on
+        spec = self.outputs_spec[name]
+        self.channels.set(name, spec.get('on_status', 1) if on else spec.get('off_status', 0))
+
+    def _schedule(self):
+        for name, spec in self.sensors.items():
+            calibration = self.registry[spec.get('calibration', name)]
+            if spec['type'] == 'max31856':
+                task = self._max31856_task(name, self.devices[name], calibration, spec.get('conversion_time', CONVERSION_TIME))
+            else:
+                task = self._max31865_task(name, self.devices[name], calibration, spec.get('quantity', 'resistance'))
+            self.scheduler.every(spec.get('period', 1.0), task, name, priority=SENSOR)
+        if 'interlocks' in self.config:
+            spec = self.config['interlocks']
+            if 'rules' in spec:
+                rules = spec['rules']
+            else:
+                rules = rename_channels(load_rules(spec['set'], self.path(spec.get('file', INTERLOCKS_PATH))), spec.get('channels', {}))
+            self.interlocks = InterlockEngine(self.channels.names, rules, safe_state=self.safe_state, instruments=self.instruments,
+                                              on_event=EventLog(self.output_path(spec.get('events', 'Logs/Interlock events.txt'))))
+            self.scheduler.every(spec.get('period', 0.25), self._interlock_task, 'check interlocks',
+                                 priority=INTERLOCK)
+        for name, spec in self.controllers_spec.items():
+            if spec['input'] not in self.sensors or spec['output'] not in self.outputs:
+                raise ValueError('controller {} needs a known input sensor and output'.format(name))
+            controller = PID.PID(spec.get('P', 0.2), spec.get('I', 0.0), spec.get('D', 0.0), self.backend.time())
+            controller.SetPoint = spec['setpoint']
+            controller.setSampleTime(spec.get('sample_time', spec.get('period', 1.0)))
+            self.controllers[name] = controller
+            period = spec.get('period', 1.0)
+            stale_after = spec.get('stale_after', 3 * max(period, self.sensors[spec['input']].get('period', 1.0)))
+            self.scheduler.every(period, self._controller_task(name, controller, spec, stale_after), name,
+                                 priority=CONTROLLER)
+        for name, spec in self.config.get('logs', {}).items():
+            group = _LogGroup(name, spec, self)
+            self.log_groups.append(group)
+            self.scheduler.every(spec.get('period', 1.0), group.sample, 'log ' + name, priority=LOG)
+        if 'telemetry' in self.config:
+            spec = self.config['telemetry']
+            self.telemetry_buffer = TelemetryBuffer(self.channels.names, spec.get('capacity', 3600))
+            self.scheduler.every(spec.get('period', 1.0), self._publish, 'telemetry', priority=TELEMETRY)
+        if 'metrics' in self.config:
+            spec = self.config['metrics']
+            self.metrics = MetricsExporter(self.instruments, self.output_path(spec.get('path', 'Logs/metrics.json')),
+                                           spec.get('interval', 10.0))
+
+    # tasks
+
+    def _max31856_task(self, name, sensor, calibration, conversion_time):
+        started = []
+
+        def collect():
+            if sensor.oneshot_pending:
+                if self.backend.monotonic() - started[0] > 10 * conversion_time:
+                    raise TimeoutError('one shot conversion timed out on {}'.format(name))
+                self.scheduler.after(POLL_INTERVAL, collect, 'collect ' + name, priority=SENSOR)
+                return
+            self.channels.set(name, float(calibration(sensor.unpack_temperature())))
+            started.clear()
+
+        def start():
+            if started:     # the previous conversion is still being collected
+                return
+            sensor.initiate_one_shot_measurement()
+            started.append(self.backend.monotonic())
+            self.scheduler.after(conversion_time, collect, 'collect ' + name, priority=SENSOR)
+        return start
+
+    def _max31865_task(self, name, sensor, calibration, quantity):
+        if self.worker is None:
+            self.worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sensor reads')
+        busy = threading.Event()
+
+        def read():
+            try:
+                self.channels.set(name, float(calibration(getattr(sensor, quantity))))
+            except Exception as error:
+                self.errors.append(error)
+            finally:
+                busy.clear()
+
+        def submit():
+            if self.errors:
+                raise self.errors[0]
+            if not busy.is_set():     # a read still queued or running is not doubled up
+                busy.set()
+                self.worker.submit(read)
+        return submit
+
+    def _controller_task(self, name, controller, spec, stale_after):
+        source, output = spec['input'], spec['output']
+        manual = spec.get('manual')
+
+        def update():
+            if self.interlocks is not None and self.interlocks.tripped:
+                self._set_output(output, False)     # latched off until the interlock is reset
+                return
+            value = self.channels.get(source, stale_after)
+            if value is None or value != value:
+                self._set_output(output, False)     # no fresh reading, fail safe
+                return
+            controller.update(value, self.backend.time())
+            mv = controller.output if manual is None else manual
+            self.channels.set(name + ' MV', mv)
+            self._set_output(output, mv > 0)
+        return update
+
+    def _interlock_task(self):
+        self.interlocks.evaluate(self.backend.time(), self.channels.row(self.channels.names))
+
+    def _publish(self):
+        self.telemetry_buffer.publish(self.backend.time(), self.channels.row(self.channels.names))
+
+    # running
+
+    def safe_state(self):
+        for name in self.outputs:
+            self._set_output(name, False)
+
+    def run(self, duration=None):
+        """Runs until Ctrl-C, the end of a replay or `duration` seconds, then turns the outputs off and closes"""
+        if self.metrics is not None:
+            self.metrics.start()
+        try:
+            if self.telemetry_buffer is not None:
+                spec = self.config['telemetry']
+                self.telemetry = start_telemetry(self.telemetry_buffer, spec.get('port', DEFAULT_PORT),
+                                                 spec.get('host', DEFAULT_HOST), instruments=self.instruments,
+                                                 interlocks=self.interlocks)
+            self.scheduler.run(duration)
+        except (KeyboardInterrupt, EndOfReplay):
+            pass
+        finally:
+            self.safe_state()
+            self.close()
+
+    def close(self):
+        if self.worker is not None:
+            self.worker.shutdown(wait=True)
+        for group in self.log_groups:
+            group.close()
+        if self.telemetry is not None:
+            self.telemetry.stop()
+        if self.metrics is not None:
+            self.metrics.stop()
+        self.backend.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs a stand from its json description')
+    parser.add_argument('config', help='stand description, e.g. stands/temperature_control.json')
+    parser.add_argument('--duration', type=float, default=None, help='seconds to run, default until Ctrl-C')
+    args = parser.parse_args()
+    config = load_stand(args.config)
+    # the Pi unless SLOWCONTROL_BACKEND asks to record, replay or fake the sensors (see sensor_backend.py)
+    backend = backend_from_env(os.path.join(ROOT_DIR, config.get('recordings', 'Logs/Recordings')))
+    stand = Stand(config, backend)
+    stand.run(args.duration)
+    for name, stats in stand.scheduler.stats().items():
+        print(name, stats)
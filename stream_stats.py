@@ -0,0 +1,235 @@
+"""
+Sliding window statistics of every channel, updated in O(1) per sample.
+
+The loops used to log `np.average` of the last itt_len ledger samples of each channel and nothing else. StreamStats
+keeps, for several windows at once (counted in samples, e.g. the itt_len of the log, a minute and ten minutes of
+ticks), the mean, standard deviation, min, max and slope (per second, least squares against the sample times) of
+every channel, and the duty cycle of the heater/relay outputs, which is the mean of their 0/1 status. add() is
+called once per tick and the figures can be read at any time by the log, alarms, telemetry or a display.
+
+Each window is updated with vectorized operations over all channels:
+
+    mean, variance, slope   running sums of the readings, their squares and their products with the sample time,
+                            relative to a recent center. Every sample adds one row to these sums, cumulated in a ring
+                            buffer sized for the longest window, and the sums of a window are the difference of two
+                            rows, so a sample costs the same for any number of windows. Every time the ring wraps the
+                            center moves to the newest readings and the sums are recomputed from the stored samples,
+                            so they neither grow nor collect rounding errors
+    min, max                the stream is cut in blocks of the window length. The window is the tail of the previous
+                            block plus the head of the current one, so it is the min/max of a stored suffix minimum
+                            of the previous block and a running prefix minimum of the current one
+                            (van Herk/Gil-Werman), O(1) amortized
+
+A missing reading (NaN or infinite, e.g. a sensor that did not answer) is left out of the figures of its channel: the
+sums count the finite readings of every channel and min/max skip NaN, so it costs one sample instead of turning the
+window NaN. Until a window is full its figures cover the samples so far.
+"""
+import numpy as np
+
+
+class StreamStats:
+    """Mean, std, min, max, slope and duty cycle of every channel over several sliding windows"""
+
+    def __init__(self, channels, windows=(20, 240, 2400), outputs=()):
+        self.channels = list(channels)
+        self.index = {name: k for k, name in enumerate(self.channels)}
+        self.outputs = [self.index[name] for name in outputs]     # on/off channels, reported as duty cycle
+        self.lengths = sorted(set(int(w) for w in windows))
+        self.row = {length: k for k, length in enumerate(self.lengths)}
+        shape = (len(self.lengths), len(self.channels))
+        self.prefix_min = np.full(shape, np.inf)
+        self.prefix_max = np.full(shape, -np.inf)
+        self.position = [0] * len(self.lengths)     # of the newest sample in the current block
+        # suffix min/max of the previous block of each window, the last row stays +-inf: 'nothing left'
+        self.suffix_min = [np.full((w + 1, len(self.channels)), np.inf) for w in self.lengths]
+        self.suffix_max = [np.full((w + 1, len(self.channels)), -np.inf) for w in self.lengths]
+        self.capacity = self.lengths[-1] + 1     # the longest window and the sample before it
+        # same mirrored ring as SampleLedger: the newest `capacity` samples are always one contiguous slice
+        self._ring = np.zeros((2 * self.capacity, len(self.channels) + 1))     # one row per sample, time first
+        # cumulated count, t, t*t, x, x*x and t*x of the finite readings of every channel, one row per sample
+        self._sums = np.zeros((self.capacity, 6, len(self.channels)))
+        self._terms = np.ones((6, len(self.channels)))     # the row of one sample without missing readings
+        self.center = np.zeros(len(self.channels) + 1)
+        self.origin = None     # times are kept relative to the first sample, epoch seconds would lose precision
+        self.count = 0
+
+    def add(self, time_stamp, values):
+        """Adds one sample, values in the order of self.channels"""
+        if self.origin is None:
+            self.origin = time_stamp
+        count = self.count
+        i = count % self.capacity
+        if i == 0 and count:
+            self._rebase()
+        y = self._ring[i]
+        y[0] = time_stamp - self.origin
+        y[1:] = values
+        z = y - self.center
+        if np.isfinite(z.sum()):
+            terms = self._terms
+            terms[1] = z[0]
+            terms[2] = z[0] * z[0]
+            terms[3] = z[1:]
+            np.multiply(z[1:], z[1:], out=terms[4])
+            np.multiply(z[1:], z[0], out=terms[5])
+        else:
+            y[1:][~np.isfinite(y[1:])] = np.nan     # an infinite reading is as missing as a NaN
+            terms = self._terms_of(y[None])[0]
+        self._ring[i + self.capacity] = y
+        np.add(self._sums[i - 1], terms, out=self._sums[i])     # row -1 is still zero for the very first sample
+        self.count += 1
+        # running min/max of the current block
+        x = y[1:]
+        np.fmin(self.prefix_min, x, out=self.prefix_min)
+        np.fmax(self.prefix_max, x, out=self.prefix_max)
+        end = i + self.capacity + 1
+        for k, length in enumerate(self.lengths):
+            position = self.position[k] = count % length
+            if position == 0:
+                self.prefix_min[k] = self.prefix_max[k] = x
+            if position == length - 1:
+                # the window is exactly the block that just completed, its suffix min/max for the next one
+                block = self._ring[end - length:end, 1:]
+                np.fmin.accumulate(block[::-1], axis=0, out=self.suffix_min[k][length - 1::-1])
+                np.fmax.accumulate(block[::-1], axis=0, out=self.suffix_max[k][length - 1::-1])
+
+    def _terms_of(self, rows):
+        # count, t, t*t, x, x*x and t*x of every channel and sample relative to the center, 0 for missing readings
+        z = rows - self.center
+        t = z[:, :1]
+        finite = ~np.isnan(z[:, 1:])
+        x = np.where(finite, z[:, 1:], 0.0)
+        return np.stack([finite, t * finite, t * t * finite, x, x * x, t * x], axis=1)
+
+    def _rebase(self):
+        # the ring is about to wrap: center on the newest readings and recompute the sums of the samples the windows
+        # can still reach, those at ring positions 1 .. capacity - 1
+        newest = self._ring[-1]
+        self.center = np.where(np.isnan(newest), self.center, newest)
+        self._sums[1:] = np.cumsum(self._terms_of(self._ring[self.capacity + 1:]), axis=0)
+
+    def _window(self, length):
+        # count, t, t*t, x, x*x and t*x summed over the finite readings of every channel in the window
+        self._row(length)
+        if not self.count:
+            return np.zeros(self._terms.shape)
+        newest = self.count - 1
+        sums = self._sums[newest % self.capacity]
+        if self.count > length:
+            sums = sums - self._sums[(newest - length) % self.capacity]
+        return sums
+
+    def _row(self, length):
+        try:
+            return self.row[length]
+        except KeyError:
+            raise KeyError('no {} sample window, the windows are {}'.format(length, self.lengths))
+
+    def samples(self, length):
+        """Number of samples in the window, less than its length until it has filled"""
+        self._row(length)
+        return min(self.count, length)
+
+    def mean(self, length):
+        sums = self._window(length)
+        n = sums[0]
+        if n.all():     # every channel has readings, the common case
+            return self.center[1:] + sums[3] / n
+        return self.center[1:] + _divide(sums[3], n, n > 0)
+
+    def std(self, length):
+        n, _, _, x, xx, _ = self._window(length)
+        variance = _divide(xx - x * _divide(x, n, n > 0), n - 1, n > 1)
+        return np.sqrt(np.maximum(variance, 0.0))
+
+    def min(self, length):
+        k = self._row(length)
+        low = np.fmin(self.suffix_min[k][self.position[k] + 1], self.prefix_min[k])
+        return np.where(np.isinf(low), np.nan, low)     # still +inf: no reading
+
+    def max(self, length):
+        k = self._row(length)
+        high = np.fmax(self.suffix_max[k][self.position[k] + 1], self.prefix_max[k])
+        return np.where(np.isinf(high), np.nan, high)
+
+    def slope(self, length):
+        """Least squares slope in units per second"""
+        n, t, tt, x, _, tx = self._window(length)
+        mean_t = _divide(t, n, n > 0)
+        m2_t = tt - t * mean_t
+        return _divide(tx - x * mean_t, m2_t, (n > 1) & (m2_t > 0))
+
+    def duty(self, length):
+        """{output channel: fraction of the window it was on}"""
+        mean = self.mean(length)
+        return {self.channels[k]: float(mean[k]) for k in self.outputs}
+
+    def summary(self, length=None):
+        """Json ready {window: {'samples': n, channel: {mean, std, min, max, slope[, duty]}}} of one or all windows"""
+        summary = {}
+        for w in (self.lengths if length is None else [length]):
+            figures = {'mean': self.mean(w), 'std': self.std(w), 'min': self.min(w), 'max': self.max(w),
+                       'slope': self.slope(w)}
+            entry = {'samples': self.samples(w)}
+            for k, name in enumerate(self.channels):
+                channel = {stat: _number(values[k]) for stat, values in figures.items()}
+                if k in self.outputs:
+                    channel['duty'] = channel.pop('mean')
+                entry[name] = channel
+            summary[w] = entry
+        return summary
+
+
+def _divide(a, b, where):
+    # a / b, NaN where `where` is False, e.g. for a channel without readings in the window
+    return np.divide(a, b, out=np.full(a.shape, np.nan), where=where)
+
+
+def _number(value):
+    # json has no NaN
+    value = float(value)
+    return None if value != value or value in (np.inf, -np.inf) else value
+
+
+if __name__ == '__main__':
+    # checks against numpy on the same data and the cost per sample
+    import time
+    import warnings
+    rng = np.random.default_rng(1)
+    n, channels = 5000, 6
+    times = np.cumsum(rng.uniform(0.2, 0.3, n)) + 1.7e9
+    data = np.cumsum(rng.normal(0, 1, (channels, n)), axis=1) - 100
+    data[4:] = rng.random((2, n)) < 0.3     # two relay channels
+    data[0, 2000] = data[1, 2001:2003] = np.nan     # dropped readings
+    data[2, 3000] = np.inf
+    data[3, 3500:3520] = np.nan
+    stats = StreamStats(['a', 'b', 'c', 'd', 'HeatF', 'HeatB'], windows=(1, 7, 240, 1000), outputs=['HeatF', 'HeatB'])
+    start = time.perf_counter()
+    worst = 0.0
+    for k in range(n):
+        stats.add(times[k], data[:, k])
+        if k % 97 == 0 or k == n - 1 or 2000 <= k <= 2010 or 3000 <= k <= 3010 or 3500 <= k <= 3530:
+            for w in stats.lengths:
+                lo = max(k + 1 - w, 0)
+                t, x = times[lo:k + 1], np.where(np.isfinite(data[:, lo:k + 1]), data[:, lo:k + 1], np.nan)
+                present = ~np.isnan(x)
+                expected, got = [], []
+                with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+                    warnings.simplefilter('ignore', RuntimeWarning)     # all-NaN slices
+                    expected += [np.nanmean(x, 1), np.nanmin(x, 1), np.nanmax(x, 1)]
+                    got += [stats.mean(w), stats.min(w), stats.max(w)]
+                    if x.shape[1] > 1:
+                        tc = np.where(present, t, np.nan) - np.nanmean(np.where(present, t, np.nan), 1)[:, None]
+                        fit = np.nansum(tc * (x - np.nanmean(x, 1)[:, None]), 1) / np.nansum(tc * tc, 1)
+                        expected += [np.nanstd(x, 1, ddof=1), np.where(present.sum(1) > 1, fit, np.nan)]
+                        got += [stats.std(w), stats.slope(w)]
+                    for a, b in zip(expected, got):     # NaN exactly where numpy has them
+                        same = (a == b) | (np.isnan(a) & np.isnan(b))
+                        worst = max(worst, np.max(np.where(same, 0.0, np.nan_to_num(np.abs(a - b), nan=np.inf))))
+    print('largest difference from numpy: {:.2e}'.format(worst))
+    start = time.perf_counter()
+    for k in range(n):
+        stats.add(times[k], data[:, k])
+    print('{:.1f} us per sample for {} windows of {} channels'.format(
+        (time.perf_counter() - start) / n * 1e6, len(stats.lengths), channels))
+    print(stats.summary(240)[240]['a'], stats.duty(240))
@@ -0,0 +1,240 @@
+"""
+Live telemetry service running inside the control process.
+
+The control loop publishes every sample (temperatures, PID outputs, relay states) into a TelemetryBuffer, an in
+memory ring buffer in which every sample has a sequence number. TelemetryServer serves it over plain HTTP from a
+background thread:
+
+    /          small live table, useful to check the stand from a browser
+    /latest    newest sample as JSON
+    /samples   JSON of the samples after ?since=<cursor>, with the cursor to ask for next time
+    /stream    server sent events, each event carries only the samples added since the previous one
+    /metrics   per-stage loop timings (see instrumentation.py), when the server was given the Instruments
+    /stats     mean, std, min, max, slope and duty cycle over the sliding windows of a StreamStats (see
+               stream_stats.py), all windows or ?window=<samples>, when the server was given one
+    /interlocks  trip latch, active alarm and interlock rules, recent events and evaluation time (see interlock.py)
+
+Every client keeps its own cursor (the SSE event id, resent by browsers as Last-Event-ID on reconnect), so any
+number of browsers or a Dash front panel can follow the stand without re-downloading history or touching the logs.
+A client that falls further behind than the buffer holds gets the oldest samples still kept and a 'dropped' count.
+
+Telemetry is only a viewer. The control scripts start it with start_telemetry(), which takes the port from
+SLOWCONTROL_TELEMETRY_PORT when that is set (0 picks a free one), and runs the loop without telemetry when the port
+cannot be bound, e.g. by a second stand, a replay next to a live run or a leftover process. It listens on 127.0.0.1,
+SLOWCONTROL_TELEMETRY_HOST=0.0.0.0 lets browsers on other machines watch the stand.
+"""
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from ledger import SampleLedger
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+MAX_BATCH = 5000     # samples per response or event, a client far behind catches up over several events
+
+PAGE = b"""<!doctype html><html><head><title>SlowControl telemetry</title></head><body>
+<table id="t" border="1" cellpadding="4"></table>
+<script>
+var source = new EventSource('/stream');
+source.onmessage = function (e) {
+  var d = JSON.parse(e.data), n = d.time.length - 1, rows = '<tr><td>time</td><td>' + new Date(d.time[n] * 1000).toLocaleTimeString() + '</td></tr>';
+  for (var k in d.channels) rows += '<tr><td>' + k + '</td><td>' + d.channels[k][n] + '</td></tr>';
+  document.getElementById('t').innerHTML = rows;
+};
+</script></body></html>"""
+
+
+def _clean(values):
+    # json has no NaN, a missing reading goes out as null
+    return [None if v != v else v for v in values]
+
+
+class TelemetryBuffer:
+    """Sequence numbered ring buffer of the newest `capacity` samples"""
+
+    def __init__(self, channels, capacity=3600):
+        self.ledger = SampleLedger(channels, capacity, dtype='float64')
+        self.channels = self.ledger.channels
+        self.changed = threading.Condition()
+
+    @property
+    def cursor(self):
+        """Sequence number the next sample will get"""
+        return self.ledger.count
+
+    def publish(self, time_stamp, values):
+        """Adds one sample, values in the same order as channels"""
+        with self.changed:
+            self.ledger.append(time_stamp, values)
+            self.changed.notify_all()
+
+    def since(self, cursor=0, limit=MAX_BATCH):
+        """Samples with a sequence number >= cursor, oldest first, as a json ready dict"""
+        with self.changed:
+            count = self.ledger.count
+            oldest = count - len(self.ledger)
+            start = min(max(int(cursor), oldest), count)
+            stop = min(count, start + limit)
+            times, data = self.ledger.window(count - start)
+            times, data = times[:stop - start].tolist(), data[:, :stop - start].tolist()
+        return {'cursor': stop, 'dropped': max(oldest - int(cursor), 0), 'time': times,
+                'channels': {name: _clean(row) for name, row in zip(self.channels, data)}}
+
+    def latest(self):
+        with self.changed:
+            if self.ledger.count == 0:
+                return {'cursor': 0, 'time': None, 'channels': {}}
+            time_stamp, values = self.ledger.latest()
+            return {'cursor': self.ledger.count, 'time': float(time_stamp),
+                    'channels': dict(zip(self.channels, _clean(values.tolist())))}
+
+    def wait(self, cursor, timeout):
+        """Blocks until a sample with sequence number >= cursor exists, returns False on timeout"""
+        with self.changed:
+            return self.changed.wait_for(lambda: self.ledger.count > cursor, timeout)
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass     # keeps the control loop console clean
+
+    def _send(self, body, content_type='application/json'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        buffer = self.server.buffer
+        if url.path == '/':
+            self._send(PAGE, 'text/html')
+        elif url.path == '/latest':
+            self._send(json.dumps(buffer.latest()).encode())
+        elif url.path == '/samples':
+            try:
+                cursor = int(query.get('since', ['0'])[0])
+            except ValueError as error:
+                self.send_error(400, str(error))
+                return
+            self._send(json.dumps(buffer.since(cursor)).encode())
+        elif url.path == '/metrics' and self.server.instruments is not None:
+            self._send(json.dumps(self.server.instruments.snapshot()).encode())
+        elif url.path == '/stats' and self.server.stats is not None:
+            window = query.get('window', [None])[0]
+            try:
+                self._send(json.dumps(self.server.stats.summary(None if window is None else int(window))).encode())
+            except (KeyError, ValueError) as error:
+                self.send_error(404, str(error))
+        elif url.path == '/interlocks' and self.server.interlocks is not None:
+            self._send(json.dumps(self.server.interlocks.status()).encode())
+        elif url.path == '/stream':
+            # a fresh client starts at the newest sample, a reconnecting one where it left off
+            cursor = self.headers.get('Last-Event-ID') or query.get('since', [None])[0]
+            try:
+                cursor = max(buffer.cursor - 1, 0) if cursor is None else int(cursor)
+            except ValueError as error:
+                self.send_error(400, str(error))
+                return
+            self._stream(buffer, cursor)
+        else:
+            self.send_error(404)
+
+    def _stream(self, buffer, cursor):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        try:
+            while not self.server.stopping.is_set():
+                if not buffer.wait(cursor, self.server.keepalive):
+                    self.wfile.write(b': keepalive\n\n')     # also notices clients that went away
+                    self.wfile.flush()
+                    continue
+                delta = buffer.since(cursor)
+                cursor = delta['cursor']
+                self.wfile.write('id: {}\ndata: {}\n\n'.format(cursor, json.dumps(delta)).encode())
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class TelemetryServer:
+    """HTTP/SSE server for a TelemetryBuffer, runs on a daemon thread"""
+
+    def __init__(self, buffer, host=DEFAULT_HOST, port=DEFAULT_PORT, keepalive=15.0, instruments=None, stats=None,
+                 interlocks=None):
+        self.buffer = buffer
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.buffer = buffer
+        self.httpd.keepalive = keepalive
+        self.httpd.instruments = instruments
+        self.httpd.stats = stats
+        self.httpd.interlocks = interlocks
+        self.httpd.stopping = threading.Event()
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='telemetry', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.stopping.set()
+        with self.buffer.changed:
+            self.buffer.changed.notify_all()     # wakes the streaming handlers so they return
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def start_telemetry(buffer, port=DEFAULT_PORT, host=DEFAULT_HOST, variable='SLOWCONTROL_TELEMETRY_PORT',
+                    host_variable='SLOWCONTROL_TELEMETRY_HOST', **options):
+    """A started TelemetryServer for the buffer, on the host and port in the environment variables if they are set, or
+    None (after saying why) if the port cannot be bound. options go to TelemetryServer"""
+    port = int(os.environ.get(variable) or port)
+    host = os.environ.get(host_variable) or host
+    try:
+        server = TelemetryServer(buffer, host=host, port=port, **options).start()
+    except OSError as error:
+        print('telemetry off, port {} unavailable: {}'.format(port, error))
+        return None
+    print('telemetry on http://{}:{}/'.format(*server.address))
+    return server
+
+
+if __name__ == '__main__':
+    # serves the simulated stand in real time, open http://127.0.0.1:8765/ while it runs
+    from thermal_sim import ThermalPlant, NODES, HEATERS, script_controllers
+    plant = ThermalPlant()
+    controllers = script_controllers()
+    buffer = TelemetryBuffer(NODES + ['MV1', 'Heat F', 'MV2', 'Heat B'])
+    server = TelemetryServer(buffer).start()
+    print('serving on http://{}:{}/'.format(*server.address))
+    loop_time = 0.25
+    heaters = [False, False]
+    try:
+        while True:
+            temps = plant.temperatures[:, 0]
+            outputs = []
+            for k, controller in enumerate(controllers):
+                controller.update(temps[NODES.index(HEATERS[k])])
+                heaters[k] = controller.output > 0
+                outputs += [controller.output, 11 if heaters[k] else 10]
+            buffer.publish(time.time(), list(temps) + outputs)
+            plant.step(heaters, loop_time * 20)     # 20x faster than real time so the cooldown is visible
+            time.sleep(loop_time)
+    except KeyboardInterrupt:
+        server.stop()
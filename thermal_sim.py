@@ -0,0 +1,167 @@
+"""
+Closed loop simulator of the small cryostat used to try out PID gains without running the real stand.
+
+The cryostat is modeled as a lumped thermal network (cold head, heat exchanger front and back, chamber)
+with the cryocooler pulling the cold head towards its base temperature, the chamber leaking heat from the lab,
+and two relay driven heaters on the heat exchanger. The existing PID.PID controllers are driven with an
+injected current_time so hours of cooldown run in seconds.
+"""
+import time
+import numpy as np
+import PID
+
+NODES = ['ColdHead', 'HeatExF', 'HeatExB', 'Chamber']
+HEATERS = ['HeatExF', 'HeatExB']     # node each heater relay warms, same order as HeaterF, HeaterB
+
+
+class ThermalPlant:
+    """Lumped thermal network of the cryostat
+
+    Temperatures are stored with shape (nodes, batch) so many independent copies of the plant,
+    e.g. one per candidate gain set, can be stepped at once.
+    """
+
+    def __init__(self, batch=1, initial=20.0, ambient=20.0, base_temp=-190.0):
+        self.batch = batch
+        self.nodes = NODES
+        self.ambient = ambient
+        self.base_temp = base_temp
+        self.capacity = np.array([1500.0, 600.0, 600.0, 4000.0])     # heat capacity of each node, J/K
+        self.links = {     # thermal conductance between nodes, W/K
+            ('ColdHead', 'HeatExF'): 0.8,
+            ('HeatExF', 'HeatExB'): 1.0,
+            ('HeatExB', 'Chamber'): 0.15,
+        }
+        self.cooler_conductance = 4.0     # W/K pulling the cold head towards base_temp
+        self.ambient_conductance = 0.08     # W/K leaking lab heat into the chamber
+        self.heater_power = np.array([60.0, 60.0])     # W delivered by each heater relay when closed
+        self.temperatures = np.full((len(NODES), batch), initial, dtype='float64')
+        self._build()
+
+    def _build(self):
+        n = len(NODES)
+        G = np.zeros((n, n))
+        for (a, b), g in self.links.items():
+            i, j = NODES.index(a), NODES.index(b)
+            G[i, j] += g
+            G[j, i] += g
+        # Laplacian of the network, dT/dt = (-L T + q) / C
+        self._laplacian = np.diag(G.sum(axis=1)) - G
+        self._laplacian[0, 0] += self.cooler_conductance
+        self._laplacian[3, 3] += self.ambient_conductance
+        self._fixed_heat = np.zeros((n, 1))
+        self._fixed_heat[0, 0] = self.cooler_conductance * self.base_temp
+        self._fixed_heat[3, 0] = self.ambient_conductance * self.ambient
+        self._heater_nodes = [NODES.index(node) for node in HEATERS]
+        self.max_step = 0.5 * np.min(self.capacity / np.diag(self._laplacian))     # explicit Euler stability limit
+
+    def step(self, heaters, dt):
+        """Advances the plant by dt seconds with heaters (shape (2,) or (2, batch)) closed where True"""
+        q = np.zeros_like(self.temperatures) + self._fixed_heat
+        q[self._heater_nodes] += np.asarray(heaters, dtype='float64').reshape(len(HEATERS), -1) * self.heater_power[:, None]
+        substeps = max(1, int(np.ceil(dt / self.max_step)))
+        h = dt / substeps
+        for _ in range(substeps):
+            self.temperatures += h * (q - self._laplacian @ self.temperatures) / self.capacity[:, None]
+        return self.temperatures
+
+
+class SimResult:
+    """Time series recorded by simulate() and the figures of merit computed from them"""
+
+    def __init__(self, times, temperatures, outputs, relays, setpoints, wall_time):
+        self.times = times     # shape (steps,)
+        self.temperatures = temperatures     # shape (steps, nodes)
+        self.outputs = outputs     # PID outputs, shape (steps, heaters)
+        self.relays = relays     # relay states, shape (steps, heaters)
+        self.setpoints = setpoints
+        self.wall_time = wall_time
+
+    def report(self, band=1.0):
+        """Settling time, overshoot and relay switching count of every controlled node"""
+        report = {'simulated_s': float(self.times[-1] - self.times[0]), 'wall_s': self.wall_time,
+                  'speedup': float(self.times[-1] - self.times[0]) / max(self.wall_time, 1e-9)}
+        for k, node in enumerate(HEATERS):
+            values = self.temperatures[:, NODES.index(node)]
+            report[node] = {
+                'settling_time_s': float(settling_time(self.times, values, self.setpoints[k], band)),
+                'overshoot_C': float(overshoot(values, self.setpoints[k])),
+                'relay_switches': int(switch_count(self.relays[:, k])),
+            }
+        return report
+
+
+def settling_time(times, values, setpoint, band=1.0):
+    """Time after which values stay within +-band of setpoint, NaN if they never settle.
+    values may carry extra trailing dimensions (e.g. one column per candidate)."""
+    outside = np.abs(values - setpoint) > band
+    n = len(times)
+    last_outside = n - 1 - np.argmax(outside[::-1], axis=0)
+    settle = np.where(outside.any(axis=0), last_outside + 1, 0)
+    return np.where(settle < n, times[np.minimum(settle, n - 1)], np.nan)
+
+
+def overshoot(values, setpoint):
+    """How far values went past setpoint on the side opposite to where they started"""
+    start = values[0]
+    return np.where(start > setpoint, setpoint - values.min(axis=0), values.max(axis=0) - setpoint).clip(min=0)
+
+
+def switch_count(relay):
+    """Number of times a relay changed state"""
+    return np.count_nonzero(np.diff(relay.astype('int8'), axis=0), axis=0)
+
+
+def simulate(controllers, duration, loop_time=1.0, plant=None, sensor_noise=0.0, seed=None):
+    """Runs the control loop of Temperature_Control_Only.py against a ThermalPlant
+
+    controllers is a pair of PID.PID objects driving HeaterF and HeaterB from the HeatExF and HeatExB
+    temperatures. Every loop the sensed temperatures are fed to controller.update with the simulated
+    time, and a heater is switched on when its controller output is above zero.
+    """
+    plant = plant if plant is not None else ThermalPlant()
+    rng = np.random.default_rng(seed)
+    steps = int(duration / loop_time)
+    sensed = [NODES.index(node) for node in HEATERS]
+    times = np.arange(steps) * loop_time
+    temperatures = np.empty((steps, len(NODES)))
+    outputs = np.empty((steps, len(HEATERS)))
+    relays = np.zeros((steps, len(HEATERS)), dtype='bool')
+    noise = rng.normal(0.0, sensor_noise, size=(steps, len(HEATERS))) if sensor_noise else np.zeros((steps, len(HEATERS)))
+    for controller in controllers:
+        controller.last_time = 0.0
+    heaters = [False, False]
+    start = time.perf_counter()
+    for step in range(steps):
+        now = times[step]
+        temps = plant.temperatures[:, 0]
+        temperatures[step] = temps
+        for k, controller in enumerate(controllers):
+            controller.update(temps[sensed[k]] + noise[step, k], now)
+            outputs[step, k] = controller.output
+            heaters[k] = controller.output > 0     # temp too low turn heater on
+        relays[step] = heaters
+        plant.step(heaters, loop_time)
+    wall_time = time.perf_counter() - start
+    return SimResult(times, temperatures, outputs, relays, [c.SetPoint for c in controllers], wall_time)
+
+
+def script_controllers(sample_time=0.5):
+    """PID controllers with the gains and setpoints used in Temperature_Control_Only.py"""
+    controllerF = PID.PID(0.2*0.6, 1.2*0.2/60, 3*0.2*60/40, current_time=0.0)
+    controllerF.SetPoint = -115
+    controllerF.setSampleTime(sample_time)
+    controllerB = PID.PID(0.2*0.6, 1.2*0.2/60, 3*0.2*60/40, current_time=0.0)
+    controllerB.SetPoint = -94.5
+    controllerB.setSampleTime(sample_time)
+    return [controllerF, controllerB]
+
+
+if __name__ == '__main__':
+    # full cooldown from room temperature with the gains currently used on the stand
+    result = simulate(script_controllers(), duration=12 * 3600, loop_time=1.0, sensor_noise=0.1, seed=0)
+    report = result.report()
+    print('simulated {:.0f} s in {:.2f} s ({:.0f}x real time)'.format(report['simulated_s'], report['wall_s'], report['speedup']))
+    for node in HEATERS:
+        print(node, report[node])
+    print('final temperatures', dict(zip(NODES, np.round(result.temperatures[-1], 2))))